@@ -1,17 +1,215 @@
-from pyteomics import mzml
 import os
 import time
 import numpy as np
 from pathlib import Path
-import sys
 import settings
 from tqdm import tqdm
+from spectrum_store import save_axis, save_spectrum, load_spectrum, export_csv
+from scan_store import cache_scans, store_path, open_reader
+from parallel import run_parallel, QueueProgress
+import kernels
+from manifest import is_current, mark_done, clear_done, load_record, axis_fingerprint
+from polarity import POLARITIES, output_name
+from composite_spectrum import CompositeAccumulator, load_accumulators, save_accumulators
+import instrumentation
 
-def average(path: str, mz_axis: np.ndarray) -> np.ndarray:
+def average_scans(scans, mz_axis: np.ndarray, n_spectra: int = None, pbar=None) -> dict:
+    '''
+    Averages a stream of MS1 scans over the resampled m/z axis, separately for every polarity: the intensities of every scan
+    are interpolated onto the axis and accumulated in float64 (see settings.INTENSITY_DTYPE) with the kernel of settings.BACKEND
+    (see kernels.py) into the sum of its polarity, which is divided by the number of MS1 scans of this polarity.
+    Scans of unknown polarity are skipped.
+    
+    Parameters
+    ----------
+    scans: iterable
+        (index, tic, rt, polarity, m/z array, intensity array) of every MS1 scan, e.g. as yielded by scan_store.decode_scans().
+    
+    mz_axis: NDArray
+        Numpy NDArray containing the resampled (linear or ppm) m/z axis to be interpolated over.
+    
+    n_spectra: int
+        Number of all spectra in the mzML file, to which the progress bar is completed.
+    
+    pbar: tqdm
+        Optional progress bar over all spectra, advanced by spectrum index.
+    
+    Returns
+    -------
+    avg_intensity: dict
+        The averaged intensities over the m/z axis of every polarity with at least one MS1 scan, keyed by "pos" and "neg".
+    '''
+    intensities, counts = {}, {}
+    interp_accumulate = kernels.accumulator()
+    done, skipped = 0, 0
+    for index, tic, rt, polarity, mz_array, intensity_array in scans:
+        if polarity:
+            if polarity not in intensities:
+                intensities[polarity], counts[polarity] = np.zeros(len(mz_axis)), 0
+            # Interpolate continuous intensity signal from discrete m/z and intensities over the new, linear m/z axis,
+            # touching only the part of the axis covered by the scan
+            interp_accumulate(intensities[polarity], mz_axis, mz_array, intensity_array)
+            counts[polarity] += 1
+        else:
+            skipped += 1
+        instrumentation.add(scans=1)
+        if pbar is not None:
+            pbar.update(index + 1 - done)   # Including the MS2 scans skipped since the previous MS1 scan
+        done = index + 1
+    if pbar is not None and n_spectra is not None:
+        pbar.update(n_spectra - done)
+    if skipped:
+        print(f"Warning: skipped {skipped} MS1 scans without polarity.")
+    # Average the signal of every polarity
+    return {polarity: intensities[polarity] / counts[polarity] for polarity in POLARITIES if polarity in intensities}
+
+def average_path(path: str, file: str, polarity: str) -> Path:
+    '''Returns the path to the averaged spectrum of one polarity of the given mzML file, avg_<sample>_<polarity>.npy on path.'''
+    return Path(path) / "avg_{}.npy".format(output_name(file, polarity))
+
+def averaged_polarities(path: str, file: str, mz_axis: np.ndarray) -> list:
+    '''
+    Checks whether the given mzML file was already averaged over the m/z axis with the current intensity data type
+    and has not changed since, according to its manifest record, and whether its averaged spectra exist.
+
+    Parameters
+    ----------
+    path: str
+        Directory of the averaged spectra.
+
+    file: str
+        Path to the mzML file.
+
+    mz_axis: NDArray
+        Resampled (linear or ppm) m/z axis.
+
+    Returns
+    -------
+    polarities: list
+        Polarities of the averaged spectra of the file if it is up to date, otherwise None.
+    '''
+    file = Path(file)
+    polarities = load_record(file.parent, file).get("stages", {}).get("average", {}).get("polarities")
+    if polarities is None or not all(average_path(path, file, polarity).exists() for polarity in polarities):
+        return None
+    if not is_current(file.parent, file, "average", axis=axis_fingerprint(mz_axis), dtype=np.dtype(settings.INTENSITY_DTYPE).name):
+        return None
+    return polarities
+
+def average_file(file: str, path: str, mz_axis: np.ndarray, csv: bool = False, progress=None) -> dict:
+    '''
+    Averages all MS1 scans of a single .mzml file over the resampled m/z axis, separately for every polarity of its scans
+    (see average_scans()), and saves the result as avg_<sample>_<polarity>.npy on path (see polarity.py), then records
+    the completion and the polarities in the file's manifest record. Runs either in the main process or in a 
+    worker process of average().
+    
+    Parameters
+    ----------
+    file: str
+        Path to the .mzml file.
+    
+    path: str
+        Directory in which the averaged spectra are saved.
+    
+    mz_axis: NDArray
+        Numpy NDArray containing the resampled (linear or ppm) m/z axis to be interpolated over.
+    
+    csv: bool
+        If True, additionally exports the averaged spectra to avg_<sample>_<polarity>.csv.
+    
+    progress: Queue
+        Queue for reporting progress to the parent process, if run in a worker process.
+        
+    Returns
+    -------
+    avg_intensity: dict
+        The averaged intensities of the file over the m/z axis, keyed by polarity.
+    '''
+    file, path = Path(file), Path(path)
+    
+    with instrumentation.span("average_file", profile=True, file=file.name) as measured:
+        clear_done(file.parent, file, "average")
+        mzml_path = open_reader(file)  # Instantiate the MzML reader object, leaving the binary arrays to decode_scans()
+        # The progress bar counts all spectra, of which only the MS1 scans are yielded
+        pbar = tqdm(total=len(mzml_path)) if progress is None else QueueProgress(progress, total=len(mzml_path))
+        with pbar:
+            # Stream the MS1 scans, decoding each of them once and caching them on disk
+            avg_intensity = average_scans(cache_scans(file, mzml_path), mz_axis, len(mzml_path), pbar)
+        
+        # Save background-corrected, resampled intensities
+        bytes_written = instrumentation.size(store_path(file))
+        for polarity, intensities in avg_intensity.items():
+            bytes_written += instrumentation.size(save_spectrum(average_path(path, file, polarity), intensities, dtype=settings.INTENSITY_DTYPE))
+            if csv:
+                export_csv(average_path(path, file, polarity).with_suffix(".csv"), mz_axis, intensities)
+        
+        mark_done(file.parent, file, "average", axis=axis_fingerprint(mz_axis), dtype=np.dtype(settings.INTENSITY_DTYPE).name,
+                  polarities=list(avg_intensity))
+        measured.add(bytes_read=instrumentation.size(file), bytes_written=bytes_written)
+    return avg_intensity
+
+def average_files(files: list, path: str, mz_axis: np.ndarray, csv: bool = False, progress=None, accumulators: dict = None) -> dict:
+    '''
+    Averages a batch of .mzml files one after another with average_file(). If accumulators are given, every averaged
+    spectrum is reduced into the composite accumulator of its polarity as soon as it is available, if it sorts after
+    the spectra already reduced (see CompositeAccumulator.follows()); the others are left to composite_spectrum().
+    Runs either in the main process or, for one file at a time, in a worker process of average().
+    
+    Parameters
+    ----------
+    files: list
+        Paths to the .mzml files.
+    
+    path: str
+        Directory in which the averaged spectra are saved.
+    
+    mz_axis: NDArray
+        Numpy NDArray containing the resampled (linear or ppm) m/z axis to be interpolated over.
+    
+    csv: bool
+        If True, additionally exports the averaged spectra to avg_<sample>_<polarity>.csv.
+    
+    progress: Queue
+        Queue for reporting progress to the parent process, if run in a worker process.
+    
+    accumulators: dict
+        CompositeAccumulator objects keyed by polarity ("pos", "neg"), or None.
+    
+    Returns
+    -------
+    averaged: dict
+        The averaged spectra of every polarity, {key: [size, modification time]} keyed by "pos" and "neg", where key
+        is the path of the spectrum relative to the data directory, as in composite_spectrum().
+    '''
+    path = Path(path)
+    averaged = {polarity: {} for polarity in POLARITIES}
+    counter = 0
+    for file in files:
+        counter += 1
+        if progress is None:
+            print(f"Averaging spectra for: {Path(file).name}, {counter} out of {len(files)}...")
+        for polarity, avg_intensity in average_file(file, path, mz_axis, csv, progress).items():
+            avg_path = average_path(path, file, polarity)
+            stat = os.stat(avg_path)
+            key = str(Path(path.name) / avg_path.name)
+            averaged[polarity][key] = [stat.st_size, stat.st_mtime_ns]
+            if accumulators is not None and accumulators[polarity].follows(key):
+                # Reduce the stored values, as they would be read from disk
+                accumulators[polarity].add(np.asarray(avg_intensity, dtype=settings.INTENSITY_DTYPE), key, averaged[polarity][key])
+    return averaged
+
+def average(path: str, mz_axis: np.ndarray, csv: bool = False, workers: int = 1, force: bool = False) -> list:
     '''
     Reads in .mzml files from path, using the Pyteomics library. Performs averaging of all spectral scans
-    by linearly interpolating their intensities over a resampled, linearly-spaced
-    m/z axis. Returns the averaged mass spectra in a 2-dimensional array: m/z, intensity.
+    by linearly interpolating their intensities over a resampled (linearly- or ppm-spaced,
+    see settings.AXIS_MODE) m/z axis, separately for the MS1 scans of every polarity (see polarity.py). The m/z axis is saved
+    once into path as mz_axis.npy, and every averaged spectrum is saved as a binary intensity vector avg_<sample>_<polarity>.npy,
+    which can be memory-mapped by later stages.
+    Every spectrum is decoded exactly once; the MS1 scans are cached in the scan store (see scan_store.py)
+    so that the time tracing can replay them without parsing the mzML file again.
+    The averaged spectra are reduced into the composite accumulators (see composite_spectrum.py) as they are
+    produced, so that the composite spectra do not need to read them again. Files that were already averaged over the same m/z axis and have not changed since, according to
+    the manifest (see manifest.py), are skipped.
     
     Parameters
     -----------
@@ -19,12 +217,21 @@ def average(path: str, mz_axis: np.ndarray) -> np.ndarray:
         .mzml path object to be read by pyteomics' MzML object constructor.
     
     mz_axis: NDArray
-        Numpy NDArray containing the linearly-spaced new m/z axis to be interpolated over.
+        Numpy NDArray containing the resampled (linear or ppm) m/z axis to be interpolated over.
+    
+    csv: bool
+        If True, additionally exports every averaged spectrum to avg_<sample>_<polarity>.csv (m/z value, average intensity).
+    
+    workers: int
+        Number of worker processes across which the files are distributed. 1 (default) processes them serially.
+    
+    force: bool
+        If True, all files are averaged again, even if they are unchanged according to the manifest.
         
     Returns
     -------
-    data_matrix: NDArray
-        2 x n (n = number of m/z values) matrix of averaged mass spectra in the format: m/z value, average intensity.
+    averaged: list
+        Paths to the .mzml files which were (re)averaged.
     '''
     
     path = Path(path)
@@ -35,37 +242,55 @@ def average(path: str, mz_axis: np.ndarray) -> np.ndarray:
     print(f"Executing on filepath: ${path}...")
     
     # Find and list all the mzML files found on path
-    filelist = [file for file in os.listdir(path.parent.absolute()) if file.lower().endswith(".mzml")]
+    filelist = sorted(file for file in os.listdir(path.parent.absolute()) if file.lower().endswith(".mzml"))
 
-    counter = 0
-    for file in filelist:
-        counter += 1
-        print(f"Averaging spectra for: {file}, {counter} out of {len(filelist)}...")
-        
-        mzml_path = mzml.MzML(str(path.parent.absolute() / file))  # Instantiate the MzML reader object
-        intensities = np.zeros(len(mz_axis))
-        with tqdm(total=len(mzml_path)) as pbar:
-            for j in range(0, len(mzml_path)):
-                if mzml_path[j]['ms level'] == 1:
-                    mz_array = np.ndarray.transpose(mzml_path[j]['m/z array'])                  # Get m/z values from the MzML path
-                    intensity_array = np.ndarray.transpose(mzml_path[j]['intensity array'])     # Get their intensities 
-                    int_interp = np.interp(mz_axis, mz_array, intensity_array, left=0, right=0) # Interpolate continuous intensity signal from discrete m/z 
-                    intensities += int_interp                                                   # and intensities over the new, linear m/z axis
-                else:
-                    continue
-                pbar.update(1)
-
-        print("Saving to file avg_{}.csv...".format(file).replace('.mzml', ""))
-        avg_intensity = intensities / len(mzml_path)   # Average the signal
-        data_matrix = np.array((mz_axis, avg_intensity), dtype=np.float64)
-        data_matrix = np.transpose(data_matrix)                      
-        
-        # Save background-corrected, resampled m/z-intensities
-        with open(path / "avg_{}.csv".format(file).replace('.mzml', ""), "w+") as average_csv:
-            np.savetxt(average_csv, data_matrix, delimiter=",", encoding='utf-8')
+    # The m/z axis is shared by all the averaged spectra, store it only once
+    save_axis(path, mz_axis)
 
+    # Only new or changed files, or files averaged over a different m/z axis or data type, need to be (re-)averaged
+    uptodate = [] if force else [file for file in filelist if averaged_polarities(path, path.parent.absolute() / file, mz_axis) is not None]
+    filelist = [file for file in filelist if file not in uptodate]
+    if uptodate:
+        print(f"Skipping {len(uptodate)} unchanged files...")
+
+    # Averaged spectra replacing ones already in the composite invalidate the running reductions of their polarity,
+    # which are then rebuilt by composite_spectrum(). If no file is averaged, the saved accumulators are left untouched
+    files = [path.parent.absolute() / file for file in filelist]
+    if files:
+        accumulators = load_accumulators(path.parent.absolute(), mz_axis)
+        replaced = {str(Path(path.name) / average_path("", file, polarity)) for file in filelist for polarity in POLARITIES}
+        for polarity, accumulator in accumulators.items():
+            if replaced & set(accumulator.members):
+                accumulators[polarity] = CompositeAccumulator(len(mz_axis))
+
+        if workers > 1:
+            # One job per file, so that the workers balance files of different sizes; the averaged spectra are then
+            # reduced in the sorted order of the files, as in a serial run
+            print(f"Averaging spectra for {len(filelist)} files on {workers} workers...")
+            jobs = [([file], path, mz_axis, csv) for file in files]
+            for averaged in run_parallel(average_files, jobs, workers, desc="Averaging spectra"):
+                for polarity, members in averaged.items():
+                    for key, stat in members.items():
+                        if accumulators[polarity].follows(key):
+                            accumulators[polarity].add(load_spectrum(path.parent.absolute() / key), key, stat)
+                            instrumentation.add(bytes_read=stat[0])
+        else:
+            average_files(files, path, mz_axis, csv, accumulators=accumulators)
+        save_accumulators(path.parent.absolute(), accumulators, mz_axis)
+
+    # Files of the same sample holding scans of the same polarity, e.g. sample1.mzML acquired with polarity switching
+    # next to sample1_pos.mzML, write the same outputs
+    sources = {}
+    for file in sorted(uptodate + filelist):
+        for polarity in averaged_polarities(path, path.parent.absolute() / file, mz_axis) or []:
+            sources.setdefault(output_name(file, polarity), []).append(file)
+    for name, clashing in sources.items():
+        if len(clashing) > 1:
+            print(f"Warning: {', '.join(clashing)} all hold the scans of {name}, only the last one averaged is kept. Rename the files.")
 
     # Print execution time 
     et = time.time()
     elapsed_time = et - st
     print("Averaged in: ", round(elapsed_time, 2), " seconds.")
+
+    return files
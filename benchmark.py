@@ -0,0 +1,142 @@
+'''
+Benchmarks the stages of the preprocessing pipeline on synthetic mzML files (see synthetic_mzml.py), so that
+performance regressions can be caught offline, without access to real measurements or the cluster.
+
+The stages average, composite_spectrum, peak_pick, time_trace and intensity_matrix are timed separately, on a fresh
+copy of the data set, and their throughput is reported in scans/s (MS1 scans processed) and MB/s (input bytes read,
+as counted by the stages themselves, see instrumentation.py),
+together with the peak resident set size (RSS) of the process and of its worker processes.
+On Linux, the peak RSS of the process is measured from the start of each stage (see instrumentation.peak_rss()), elsewhere
+it is a high-water mark over the whole run so far. The peak RSS of the workers is the largest of the stage's worker processes.
+
+Usage:
+    $ python3 benchmark.py --files 4 --scans 200 --points 5000 --peaks 50 --workers 2 --output benchmark.json
+'''
+
+import argparse, json, platform, shutil, sys, tempfile, time
+from pathlib import Path
+import numpy as np
+import settings
+from synthetic_mzml import write_dataset
+import instrumentation
+from average import average
+from composite_spectrum import composite_spectrum
+from time_trace import pick_peaks, time_trace
+from intensity_matrix import intensity_matrix
+import kernels
+
+def run_stage(name: str, function) -> tuple:
+    '''
+    Runs function() once within an instrumentation span (see instrumentation.py) and measures it. The scans processed
+    and bytes read are the counts added to the span by the stage itself, including those of its worker processes,
+    so that only the input actually read is counted, e.g. no averaged spectra already reduced during averaging.
+
+    Parameters
+    ----------
+    name: str
+        Name of the stage.
+
+    function: callable
+        Stage to be run, without arguments.
+
+    Returns
+    -------
+    result: dict
+        Stage name, wall time in seconds, MS1 scans processed and MB read, throughput in scans/s and MB/s, and peak RSS in MB.
+
+    value:
+        Return value of function().
+    '''
+    with instrumentation.span(name) as stage:
+        start = time.perf_counter()
+        value = function()
+        seconds = time.perf_counter() - start
+    return {"stage": name, "seconds": seconds, "scans": stage.scans, "MB": stage.bytes_read / 1e6,
+            "scans_per_s": stage.scans / seconds if stage.scans else None, "MB_per_s": stage.bytes_read / 1e6 / seconds,
+            "peak_rss_MB": {"self": stage.peak_rss_mb, "children": stage.peak_rss_children_mb}}, value
+
+def benchmark(path: Path, workers: int = 1) -> list:
+    '''
+    Runs and measures all stages of the pipeline on the mzML files on path, in the order of preprocess.main().
+
+    Parameters
+    ----------
+    path: Path
+        Directory containing the mzML files; the outputs of all stages are written there.
+
+    workers: int
+        Number of worker processes used for averaging and time tracing.
+
+    Returns
+    -------
+    results: list
+        One dict per stage, see run_stage().
+    '''
+    for directory in ("average", "time_traces", "scans", "manifest"):
+        (path / directory).mkdir(exist_ok=True)
+
+    results = []
+    results.append(run_stage("average", lambda: average(path / "average", settings.MZ_AXIS, workers=workers))[0])
+    results.append(run_stage("composite_spectrum", lambda: composite_spectrum(path, settings.MZ_AXIS))[0])
+    result, peaks = run_stage("peak_pick", lambda: pick_peaks(path / "time_traces", settings.MZ_AXIS))
+    results.append(result)
+    # Traced with the peaks picked above, so that the peak picking is not timed again
+    results.append(run_stage("time_trace", lambda: time_trace(path / "time_traces", settings.MZ_AXIS, workers=workers, peaks=peaks))[0])
+    results.append(run_stage("intensity_matrix", lambda: intensity_matrix(path))[0])
+    return results
+
+def report(results: list):
+    '''Prints the results of benchmark() as a table.'''
+    print("\n{:<20}{:>10}{:>12}{:>10}{:>14}{:>14}".format("stage", "seconds", "scans/s", "MB/s", "RSS self MB", "RSS child MB"))
+    for result in results:
+        rss = result["peak_rss_MB"]
+        print("{:<20}{:>10.3f}{:>12}{:>10.1f}{:>14}{:>14}".format(
+            result["stage"], result["seconds"],
+            "-" if result["scans_per_s"] is None else "{:.1f}".format(result["scans_per_s"]),
+            result["MB_per_s"],
+            "-" if rss["self"] is None else "{:.1f}".format(rss["self"]),
+            "-" if rss["children"] is None else "{:.1f}".format(rss["children"])))
+
+parser = argparse.ArgumentParser(description="Benchmarks the stages of the preprocessing pipeline on synthetic mzML files.")
+parser.add_argument("--files", type=int, default=2, help="number of samples, each written in both polarities (default: 2)")
+parser.add_argument("--scans", type=int, default=100, help="number of spectra per file (default: 100)")
+parser.add_argument("--points", type=int, default=2000, help="number of data points per scan (default: 2000)")
+parser.add_argument("--peaks", type=int, default=30, help="number of peaks per file (default: 30)")
+parser.add_argument("--noise", type=float, default=50.0, help="mean intensity of the noise (default: 50)")
+parser.add_argument("--ms2-every", type=int, default=0, metavar="N", help="make every N-th spectrum an MS2 scan (default: 0, MS1 only)")
+parser.add_argument("--elution-width", type=float, metavar="SCANS", help="elute every peak around its own apex with this width, e.g. for --config with trace_mode = \"windowed\" (default: all peaks over the whole run)")
+parser.add_argument("--switching", action="store_true", help="write every sample into one file with polarity switching instead of one file per polarity")
+parser.add_argument("--backend", choices=["numpy", "numba"], help="implementation of the interpolation and integration kernels, see kernels.py (default: from settings.py or --config)")
+parser.add_argument("--workers", type=int, default=1, metavar="N", help="number of worker processes (default: 1)")
+parser.add_argument("--config", type=Path, help="TOML file overriding the defaults in settings.py, see settings.load_config()")
+parser.add_argument("--dir", type=Path, help="directory in which the data set is written and processed (default: a temporary directory, removed afterwards)")
+parser.add_argument("--output", type=Path, help="JSON file into which the results are written")
+
+if __name__ == "__main__":
+    ARGS = parser.parse_args()
+    if ARGS.config:
+        settings.configure(**settings.load_config(ARGS.config))
+    settings.configure(backend=ARGS.backend)
+
+    PATH = Path(ARGS.dir if ARGS.dir else tempfile.mkdtemp(prefix="benchmark_"))
+    if ARGS.dir and PATH.exists() and any(PATH.iterdir()):
+        sys.exit(f"{PATH} is not empty, the benchmark needs a fresh directory.")
+    try:
+        print(f"Writing the synthetic data set into {PATH}...")
+        write_dataset(PATH, ARGS.files, switching=ARGS.switching, n_scans=ARGS.scans, n_points=ARGS.points, n_peaks=ARGS.peaks,
+                      noise=ARGS.noise, ms2_every=ARGS.ms2_every, elution_width=ARGS.elution_width)
+        RESULTS = benchmark(PATH, workers=ARGS.workers)
+    finally:
+        if not ARGS.dir:
+            shutil.rmtree(PATH, ignore_errors=True)
+
+    report(RESULTS)
+    if ARGS.output:
+        with open(ARGS.output, "w") as output:
+            json.dump({"data set": {"files": ARGS.files if ARGS.switching else 2 * ARGS.files, "switching": ARGS.switching, "scans": ARGS.scans, "points": ARGS.points, "peaks": ARGS.peaks,
+                                    "noise": ARGS.noise, "ms2_every": ARGS.ms2_every, "elution_width": ARGS.elution_width},
+                       "settings": settings.snapshot(),
+                       "workers": ARGS.workers, "python": platform.python_version(), "numpy": np.__version__,
+                       "numba": kernels.version(),
+                       "stages": RESULTS}, output, indent=1)
+        print(f"Results written to {ARGS.output}.")
@@ -1,28 +1,238 @@
 import numpy as np
+import json
 from pathlib import Path
-from peak_pick import peak_pick
+from spectrum_store import load_spectrum, save_spectrum, export_csv
+from manifest import write_json, axis_fingerprint
+from polarity import POLARITIES, split_name
 import settings
-import os, sys, time
+import instrumentation
+import os, time
 
-def composite_spectrum(path: str, MZ_AXIS: np.ndarray) -> np.ndarray:
+class CompositeAccumulator():
+    '''Streaming reduction of averaged spectra of one polarity into composite statistics. \n
+
+    Every averaged spectrum is added once, as soon as it is available; the composite spectrum and the 
+    extra reducers are then read off the accumulator without another pass over the averaged spectra.
+    The floating-point sum and the streaming median depend on the order in which the spectra are added, so they are
+    always added in the sorted order of their keys (see follows()): the reducers are then the same however the files
+    were distributed over worker processes or incremental runs. An accumulator cannot be extended by a spectrum
+    sorting before its members; it has to be rebuilt instead (see composite_spectrum()).
+    Without the median (median=False), the reducers are all sums and maxima, and partial accumulators over disjoint sets
+    of spectra, e.g. those of the shards in shard.py, can be combined with merge(), up to the floating-point summation order.
+
+    Properties:
+    -----------
+    members: dict
+        Averaged spectra added so far, keyed by their path relative to the data directory, with their [size, modification time].
+    sum: np.ndarray
+        Sum of the averaged intensities, always in float64. The other reducers are kept in the 
+        storage data type settings.INTENSITY_DTYPE.
+    max: np.ndarray
+        Maximum of the averaged intensities.
+    nonzero: np.ndarray
+        Number of averaged spectra in which each m/z bin is non-zero.
+    median: np.ndarray
+        Streaming estimate of the median of the averaged intensities (FAME: fast approximate median estimator),
+        fed with the spectra in the sorted order of their keys. None if the accumulator was created with median=False.
+    step: np.ndarray
+        Step size of the median estimator, or None.
+    '''
+
+    REDUCERS = ("sum", "max", "nonzero", "median", "step")
+    MERGEABLE = ("sum", "max", "nonzero")
+
+    def __init__(self, n_points: int, median: bool = True):
+        self.members = {}
+        self.sum = np.zeros(n_points)
+        self.max = np.zeros(n_points, dtype=settings.INTENSITY_DTYPE)
+        self.nonzero = np.zeros(n_points, dtype=np.int32)
+        self.median = np.zeros(n_points, dtype=settings.INTENSITY_DTYPE) if median else None
+        self.step = np.zeros(n_points, dtype=settings.INTENSITY_DTYPE) if median else None
+
+    @property
+    def count(self) -> int:
+        return len(self.members)
+
+    @property
+    def reducers(self) -> tuple:
+        '''Names of the reducers kept by this accumulator.'''
+        return self.REDUCERS if self.median is not None else self.MERGEABLE
+
+    def follows(self, key: str) -> bool:
+        '''Returns True if the averaged spectrum identified by key sorts after all members, i.e. can be added.'''
+        return not self.members or key > max(self.members)
+
+    def add(self, intensities: np.ndarray, key: str, stat: list):
+        '''
+        Adds one averaged spectrum, identified by key and stat, to all the reducers. The key must sort after
+        all members (see follows()), and the intensities must be the values stored in the storage data type
+        settings.INTENSITY_DTYPE, so that the reducers do not depend on whether a spectrum is added from memory or from disk.
+        '''
+        if not self.follows(key):
+            raise ValueError(f"{key} must be added before {max(self.members)}, rebuild the accumulator in sorted order.")
+        if self.median is not None and self.count == 0:
+            self.median[:] = intensities
+        elif self.median is not None:
+            # Move the median estimate one step towards the new value, starting with half the distance 
+            # in bins without a step yet, and halve the step once the estimate is within one step of the value
+            difference = intensities - self.median
+            np.copyto(self.step, np.abs(difference) / 2, where=self.step == 0)
+            self.median += self.step * np.sign(difference)
+            self.step[np.abs(intensities - self.median) < self.step] /= 2
+        self.sum += intensities
+        np.maximum(self.max, intensities, out=self.max)
+        self.nonzero += intensities != 0
+        self.members[key] = stat
+
+    def merge(self, other: "CompositeAccumulator"):
+        '''
+        Adds the reducers of another accumulator, over averaged spectra disjoint from the members, to this one.
+        Only defined for accumulators without the median, which cannot be combined.
+        '''
+        if self.median is not None or other.median is not None:
+            raise ValueError("Accumulators with a streaming median cannot be merged, create them with median=False.")
+        if set(self.members) & set(other.members):
+            raise ValueError(f"Averaged spectra reduced twice: {', '.join(sorted(set(self.members) & set(other.members)))}")
+        self.sum += other.sum
+        np.maximum(self.max, other.max, out=self.max)
+        self.nonzero += other.nonzero
+        self.members.update(other.members)
+
+    def mean(self) -> np.ndarray:
+        '''Returns the composite spectrum: the mean of all averaged spectra added. Only defined if at least one was added.'''
+        return self.sum / self.count
+
+def load_accumulators(path: str, MZ_AXIS: np.ndarray) -> dict:
+    '''
+    Loads the composite accumulators of both polarities saved on path by save_accumulators(). Empty accumulators
+    are returned if there are none, or if they were accumulated over a different m/z axis. Accumulators saved
+    without the median are loaded without it.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    MZ_AXIS: np.ndarray
+        Numpy NDArray containing the resampled (linear or ppm) m/z axis.
+
+    Returns
+    -------
+    accumulators: dict
+        CompositeAccumulator objects, keyed by polarity ("pos", "neg").
+    '''
+    path = Path(path)
+    accumulators = {polarity: CompositeAccumulator(len(MZ_AXIS)) for polarity in POLARITIES}
+    try:
+        with open(path / "composite_state.json") as state_json:
+            state = json.load(state_json)
+        if state.get("axis") != axis_fingerprint(MZ_AXIS):
+            return accumulators
+        for polarity in POLARITIES:
+            accumulator = accumulators[polarity] = CompositeAccumulator(len(MZ_AXIS), median=polarity in state.get("medians", POLARITIES))
+            for reducer in accumulator.reducers:
+                setattr(accumulator, reducer, np.load(path / "composite_{}_{}.npy".format(reducer, polarity)))
+            accumulator.members = state[polarity]
+    except (FileNotFoundError, KeyError, json.JSONDecodeError):
+        accumulators = {polarity: CompositeAccumulator(len(MZ_AXIS)) for polarity in POLARITIES}
+    return accumulators
+
+def save_accumulators(path: str, accumulators: dict, MZ_AXIS: np.ndarray):
+    '''
+    Saves the composite accumulators of both polarities on path: every reducer as composite_<reducer>_<polarity>.npy,
+    and the averaged spectra they contain in composite_state.json. The previous composite_state.json is removed before
+    the reducers are overwritten, and the new one is written last, so that an interrupted save leaves no state, which
+    load_accumulators() treats as empty accumulators, rather than new reducers paired with the old members.
+    The median files of accumulators without the median are removed.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    accumulators: dict
+        CompositeAccumulator objects, keyed by polarity ("pos", "neg").
+
+    MZ_AXIS: np.ndarray
+        Numpy NDArray containing the resampled (linear or ppm) m/z axis.
+
+    Returns
+    -------
+    None
+    '''
+    path = Path(path)
+    (path / "composite_state.json").unlink(missing_ok=True)
+    state = {"axis": axis_fingerprint(MZ_AXIS), "medians": [polarity for polarity, accumulator in accumulators.items() if accumulator.median is not None]}
+    for polarity, accumulator in accumulators.items():
+        for reducer in CompositeAccumulator.REDUCERS:
+            if reducer in accumulator.reducers:
+                np.save(path / "composite_{}_{}.npy".format(reducer, polarity), getattr(accumulator, reducer))
+            else:
+                (path / "composite_{}_{}.npy".format(reducer, polarity)).unlink(missing_ok=True)
+        state[polarity] = accumulator.members
+    write_json(path / "composite_state.json", state)
+
+def averaged_spectra(path: str) -> dict:
+    '''
+    Lists the averaged spectra of both polarities in all directories on path, avg_<sample>_<polarity>.npy (see polarity.py).
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    Returns
+    -------
+    avg_files: dict
+        Size and modification time (ns) of every averaged spectrum, keyed by polarity and by its path relative to path.
+    '''
+    path = Path(path)
+    avg_files = {polarity: {} for polarity in POLARITIES}
+    for root, dirs, files in os.walk(path):
+        for file in sorted(files):
+            polarity = split_name(Path(file).stem)[1]
+            if file.startswith('avg') and file.endswith('.npy') and polarity is not None:
+                file_path = Path(root) / file
+                stat = os.stat(file_path)
+                avg_files[polarity][str(file_path.relative_to(path))] = [stat.st_size, stat.st_mtime_ns]
+    return avg_files
+
+def composite_spectrum(path: str, MZ_AXIS: np.ndarray, csv: bool = False, force: bool = False) -> np.ndarray:
     '''
     Average all the averaged spectra into one composite spectrum for all mzML files on the given file path (for each polarity mode).
+    The composite spectra are saved as composite_spectrum_pos.npy and composite_spectrum_neg.npy on the given path,
+    next to the extra reducers composite_max_<polarity>.npy, composite_median_<polarity>.npy (streaming estimate)
+    and composite_nonzero_<polarity>.npy (number of samples in which each m/z bin is non-zero). The accumulators merged
+    from the shards of shard.py have no median, which is only restored when the accumulator is rebuilt (force).
+
+    The averaged spectra are reduced as they are produced by average() (see CompositeAccumulator), so this only
+    reads averaged spectra which are not part of the saved accumulators yet. If an averaged spectrum was changed 
+    or removed since it was accumulated, or sorts before the accumulated ones, the accumulator of its polarity
+    is rebuilt from all averaged spectra in sorted order.
     
     Parameters
     ----------
     path: str
-        Path to the averaged .csv files created from the mzML files. 
+        Path to the averaged .npy files created from the mzML files. 
     
     MZ_AXIS: np.ndarray
-        Numpy NDArray containing the linearly-spaced new m/z axis.
+        Numpy NDArray containing the resampled (linear or ppm) m/z axis.
+    
+    csv: bool
+        If True, additionally exports the composite spectra to .csv files (m/z value, intensity).
+    
+    force: bool
+        If True, the saved accumulators are discarded and rebuilt from all averaged spectra.
         
     Returns
     -------
     spectrum_pos: np.ndarray
-        An array containing the composite spectrum of all measurements found on the file path in the positive ion mode.
+        An array containing the composite spectrum of all measurements found on the file path in the positive ion mode,
+        or None if there are none.
     
     spectrum_neg: np.ndarray
-        An array containing the composite spectrum of all measurements found on the file path in the negative ion mode.
+        An array containing the composite spectrum of all measurements found on the file path in the negative ion mode,
+        or None if there are none.
     '''
     
     # Log script execution time
@@ -32,41 +242,45 @@ def composite_spectrum(path: str, MZ_AXIS: np.ndarray) -> np.ndarray:
     # Average the averaged spectra to create a composite spectrum of all mzML files on the file path
     print("Preparing the composite spectrum:", flush=True)
 
-    with open(path / "composite_spectrum_pos.csv", "w+") as spectrum_pos, open(path / "composite_spectrum_neg.csv", "w+") as spectrum_neg:
+    avg_files = averaged_spectra(path)
+    accumulators = {polarity: CompositeAccumulator(len(MZ_AXIS)) for polarity in POLARITIES} if force else load_accumulators(path, MZ_AXIS)
+    composites, changed = [], force
+    for polarity in POLARITIES:
+        accumulator, current = accumulators[polarity], avg_files[polarity]
+        missing = sorted(key for key in current if key not in accumulator.members)
         
-        # Prepare arrays for intensity values
-        avg_int_pos = np.zeros(len(MZ_AXIS))
-        num_pos = 0
-        avg_int_neg = np.zeros(len(MZ_AXIS))
-        num_neg = 0
+        if not all(current.get(key) == stat for key, stat in accumulator.members.items()) or (missing and not accumulator.follows(missing[0])):
+            # An averaged spectrum was changed or removed, or sorts before the reduced ones, start the reduction afresh
+            accumulator = accumulators[polarity] = CompositeAccumulator(len(MZ_AXIS))
+            missing = sorted(current)
+            changed = True
+        changed = changed or bool(missing)
         
-        # Process all directories
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if 'avg' in file:
-                    file_path = Path(root) / file
-                    print(f"Processing file {file_path}...", flush=True)
-                    data = np.genfromtxt(file_path, delimiter=',')
-                    corr_intensity = data.transpose()[1]
-                    if 'pos' in file:
-                        num_pos += 1
-                        avg_int_pos += corr_intensity
-                    elif 'neg' in file:
-                        num_neg += 1
-                        avg_int_neg += corr_intensity
-       
-        avg_int_pos /= num_pos
-        avg_int_neg /= num_neg
-        composite_pos = np.array((MZ_AXIS, avg_int_pos))
-        composite_neg = np.array((MZ_AXIS, avg_int_neg))
-        composite_pos = np.transpose(composite_pos)
-        composite_neg = np.transpose(composite_neg)
+        # Add the averaged spectra that were not reduced during averaging, in sorted order
+        for key in missing:
+            print(f"Processing file {path / key}...", flush=True)
+            accumulator.add(load_spectrum(path / key), key, current[key])
+            instrumentation.add(bytes_read=current[key][0])
         
-        np.savetxt(spectrum_pos, composite_pos, delimiter=",", encoding='utf-8')
-        np.savetxt(spectrum_neg, composite_neg, delimiter=",", encoding='utf-8')
-        
-        # Print execution time 
-        et = time.time()
-        elapsed_time = et - st
-        print("Composite spectrum created in: ", round(elapsed_time, 2), " seconds.")
+        if accumulator.count == 0:
+            # No averaged spectra of this polarity, e.g. a data set measured in one mode only: there is no composite spectrum
+            print(f"No averaged spectra in the {polarity} mode, skipping its composite spectrum.")
+            (path / "composite_spectrum_{}.npy".format(polarity)).unlink(missing_ok=True)
+            composites.append(None)
+            continue
+        avg_intensity = accumulator.mean()
+        save_spectrum(path / "composite_spectrum_{}.npy".format(polarity), avg_intensity, dtype=settings.INTENSITY_DTYPE)
+        if csv:
+            export_csv(path / "composite_spectrum_{}.csv".format(polarity), MZ_AXIS, avg_intensity)
+        composites.append(avg_intensity)
+    
+    # The saved accumulators are only rewritten if a spectrum was added to them
+    if changed:
+        save_accumulators(path, accumulators, MZ_AXIS)
     
+    # Print execution time 
+    et = time.time()
+    elapsed_time = et - st
+    print("Composite spectrum created in: ", round(elapsed_time, 2), " seconds.")
+
+    return tuple(composites)
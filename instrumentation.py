@@ -0,0 +1,254 @@
+'''
+Lightweight instrumentation of the pipeline. Stages and files are wrapped in named spans, which record
+their wall time, CPU time, number of scans processed, bytes read and written, and peak memory use.
+Every closed span is appended as one JSON line to the run report (run_report.ndjson, next to the intensity matrix),
+so that the files and stages dominating the runtime can be found, e.g. with pandas.read_json(file, lines=True).
+
+Spans closed in worker processes (see parallel.py) are sent to the main process, which writes them into
+the run report and adds their counts to the span open there, e.g. the span of the stage.
+If profiling is enabled, every span opened with profile=True is additionally profiled with cProfile,
+and the statistics are dumped into the profile directory, one <span>.prof file per span, e.g. one per stage,
+and one per file for the files processed in worker processes.
+
+On Linux, the peak resident memory of every span is measured from its start: the high-water mark of the process
+is reset (/proc/self/clear_refs) when a span starts, after folding it into the spans already open. Elsewhere, it is
+the high-water mark since the start of the process. The peak memory of the worker processes of a span is the largest
+peak of the worker spans collected into it.
+
+Usage:
+    with span("average") as stage:
+        ...
+        stage.add(scans=n, bytes_read=size)
+'''
+
+import cProfile, json, os, sys, time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+# Name of the run report and of the profile directory, written next to the intensity matrix
+REPORT_FILE = "run_report.ndjson"
+PROFILE_DIR = "profile"
+
+_report = None      # Path to the run report, in the main process
+_profile = None     # Path to the profile directory, if profiling is enabled
+_queue = None       # Queue to the main process, in worker processes
+_stack = []         # Currently open spans, innermost last
+
+def peak_rss() -> tuple:
+    '''
+    Returns the peak resident set size of this process and of its terminated child processes (e.g. workers), in MB,
+    or None where it cannot be measured. On Linux, the peak of this process is the high-water mark since the last
+    reset_peak_rss(); otherwise, both are high-water marks since the start of the process.
+    '''
+    if resource is None:
+        return None, None
+    # ru_maxrss is given in kilobytes on Linux, but in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1e6
+    try:
+        with open("/proc/self/status") as status:
+            rss = next(int(line.split()[1]) * 1024 / 1e6 for line in status if line.startswith("VmHWM:"))
+    except (OSError, StopIteration, ValueError):
+        pass
+    return rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1e6
+
+def reset_peak_rss() -> bool:
+    '''Resets the high-water mark of the resident set size of this process, on Linux. Returns False where it cannot be reset.'''
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+class Span():
+    '''A named, measured section of the pipeline, e.g. a stage or the processing of one file. \n
+
+    Properties:
+    -----------
+    name: str
+        Name of the span, e.g. "average".
+    attrs: dict
+        Additional fields of the span's record, e.g. the name of the processed file.
+    parent: str
+        Name of the enclosing span, if any.
+    scans: int
+        Number of scans processed.
+    bytes_read: int
+        Number of bytes read.
+    bytes_written: int
+        Number of bytes written.
+    peak_rss_mb: float
+        Peak resident set size of this process during the span, in MB, or None where it cannot be measured.
+    peak_rss_children_mb: float
+        Largest peak resident set size of the worker processes whose spans were collected into the span, in MB,
+        or None if there were none.
+    '''
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.parent = _stack[-1].name if _stack else None
+        self.scans = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.profiled = False
+        self.peak_rss_mb = None
+        self.peak_rss_children_mb = None
+
+    def add(self, scans: int = 0, bytes_read: int = 0, bytes_written: int = 0):
+        '''Adds to the counts of the span.'''
+        self.scans += scans
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def start(self):
+        # The peak so far is kept by all open spans before it is reset for this one
+        rss = peak_rss()[0]
+        for open_span in _stack:
+            if open_span is not self:
+                open_span.track_rss(rss)
+        reset_peak_rss()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        # CPU time of terminated child processes, e.g. the workers of a process pool that was shut down
+        times = os.times()
+        self.cpu_children = times.children_user + times.children_system
+
+    def track_rss(self, rss: float, children: bool = False):
+        '''Raises the peak resident set size of the span, or of its worker processes, to rss (in MB) if it is larger.'''
+        attr = "peak_rss_children_mb" if children else "peak_rss_mb"
+        if rss is not None:
+            setattr(self, attr, max(getattr(self, attr) or 0, rss))
+
+    def stop(self) -> dict:
+        '''Returns the record of the span, measured since start().'''
+        times = os.times()
+        wall = time.perf_counter() - self.wall
+        self.track_rss(peak_rss()[0])
+        return {"type": "span", "name": self.name, "parent": self.parent, **self.attrs, "pid": os.getpid(),
+                "wall_s": wall, "cpu_s": time.process_time() - self.cpu,
+                "cpu_children_s": times.children_user + times.children_system - self.cpu_children,
+                "scans": self.scans, "bytes_read": self.bytes_read, "bytes_written": self.bytes_written,
+                "scans_per_s": self.scans / wall if wall > 0 else None,
+                "MB_read_per_s": self.bytes_read / 1e6 / wall if wall > 0 else None,
+                "peak_rss_mb": self.peak_rss_mb, "peak_rss_children_mb": self.peak_rss_children_mb}
+
+def start_run(file: str, profile_dir: str = None, **info):
+    '''
+    Starts a new run report in the main process, replacing any previous one, and records the run's start.
+
+    Parameters
+    ----------
+    file: str
+        Path to the run report (NDJSON, one record per line).
+
+    profile_dir: str
+        Directory into which the cProfile statistics of the spans are dumped. None (default) disables profiling.
+
+    **info:
+        Additional fields of the run record, e.g. the settings.
+
+    Returns
+    -------
+    None
+    '''
+    global _report, _profile
+    _report = Path(file)
+    _profile = Path(profile_dir) if profile_dir else None
+    if _profile:
+        _profile.mkdir(parents=True, exist_ok=True)
+    with open(_report, "w") as report:
+        report.write(json.dumps({"type": "run", "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "argv": sys.argv,
+                                 "pid": os.getpid(), **info}, default=str) + "\n")
+
+def state() -> dict:
+    '''Returns the instrumentation state to be passed on to worker processes, see worker().'''
+    return {"profile_dir": str(_profile) if _profile else None}
+
+def worker(queue, profile_dir: str = None):
+    '''
+    Configures a worker process to send the records of its spans through queue to the main process,
+    where they are handled by collect(), instead of writing them into the run report itself.
+    '''
+    global _queue, _profile, _report
+    _queue = queue
+    _report = None
+    _stack.clear()      # Spans open in the parent when it forked the worker
+    _profile = Path(profile_dir) if profile_dir else None
+
+def collect(record: dict):
+    '''
+    Handles the record of a closed span: its counts are added to the innermost open span,
+    and it is written into the run report, or sent to the main process from a worker process.
+    '''
+    if _stack:
+        _stack[-1].add(record["scans"], record["bytes_read"], record["bytes_written"])
+        # The peak of a worker span is a worker's peak, that of a span of this process holds the peak of its workers
+        _stack[-1].track_rss(record["peak_rss_mb"] if record["pid"] != os.getpid() else record["peak_rss_children_mb"], children=True)
+        record["parent"] = record["parent"] or _stack[-1].name
+    if _queue is not None:
+        _queue.put(("span", record))
+    elif _report is not None:
+        with open(_report, "a") as report:
+            report.write(json.dumps(record, default=str) + "\n")
+
+def add(scans: int = 0, bytes_read: int = 0, bytes_written: int = 0):
+    '''Adds to the counts of the innermost open span, if any.'''
+    if _stack:
+        _stack[-1].add(scans, bytes_read, bytes_written)
+
+@contextmanager
+def span(name: str, profile: bool = False, **attrs):
+    '''
+    Opens a span for the enclosed block, see Span.
+
+    Parameters
+    ----------
+    name: str
+        Name of the span, e.g. "average".
+
+    profile: bool
+        If True and profiling is enabled, the block is profiled with cProfile into <profile_dir>/<name>[_<file>].prof,
+        unless an enclosing span is already profiled.
+
+    **attrs:
+        Additional fields of the span's record, e.g. file="sample_pos.mzML".
+
+    Yields
+    ------
+    span: Span
+        The open span, whose counts can be added to with Span.add().
+    '''
+    current = Span(name, **attrs)
+    # Only one profiler can be active at a time, nested spans are covered by the enclosing span's profile
+    profiler = cProfile.Profile() if profile and _profile and not any(open_span.profiled for open_span in _stack) else None
+    current.profiled = profiler is not None
+    _stack.append(current)
+    current.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield current
+    finally:
+        if profiler:
+            profiler.disable()
+        _stack.pop()
+        record = current.stop()
+        if profiler:
+            stats = _profile / "{}.prof".format("_".join([name] + ([str(attrs["file"])] if "file" in attrs else [])))
+            profiler.dump_stats(stats)
+            record["profile"] = str(stats)
+        collect(record)
+
+def size(path: str) -> int:
+    '''Returns the size in bytes of a file, or the total size of all files in a directory.'''
+    path = Path(path)
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+    return path.stat().st_size if path.exists() else 0
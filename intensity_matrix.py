@@ -1,90 +1,241 @@
-import os, time
+import os, time, zipfile
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from pandas.errors import EmptyDataError
-from tic_correlation import tic_correlate
+from tic_correlation import tic_correlate_batch, pearson_windows
+import settings
+from trace_store import load_trace, features_path, is_sparse, SPARSE_COLUMNS
+from polarity import split_name
+import instrumentation
 
-# Log script execution time
-st = time.time()
+# Polarities in the order of their features in the intensity matrix, with the sign of their m/z labels
+POLARITIES = (("pos", "+"), ("neg", "-"))
 
-def intensity_matrix(path: str):
+def _feature_table(trace_dir: Path, filelist: list) -> dict:
+    # Sorted m/z values of the features of every polarity, from the feature lists saved by time_trace().
+    # Traces written without a feature list contribute the union of their m/z values instead.
+    mz = {}
+    for polarity, sign in POLARITIES:
+        if features_path(trace_dir, polarity).exists():
+            mz[polarity] = np.unique(np.load(features_path(trace_dir, polarity)))
+        else:
+            traces = [load_trace(trace_dir / file, columns=("mz",))["mz"] for file in filelist if split_name(file)[1] == polarity]
+            mz[polarity] = np.unique(np.concatenate(traces)) if traces else np.empty(0)
+    return mz
+
+def _labels(table_mz: dict) -> tuple:
+    # One feature ID per distinct m/z label: the features of both polarities, back to back
+    offsets, labels = {}, []
+    for polarity, sign in POLARITIES:
+        offsets[polarity] = len(labels)
+        labels += [sign + f'{mz_value}' for mz_value in table_mz[polarity]]
+    return offsets, np.asarray(labels, dtype=str)
+
+def _feature_ids(table_mz: np.ndarray, mz: np.ndarray) -> np.ndarray:
+    # Position of every m/z value in the sorted feature list, -1 for values missing from it
+    if not len(table_mz):
+        return np.full(len(mz), -1)
+    ids = np.searchsorted(table_mz, mz).clip(max=len(table_mz) - 1)
+    return np.where(table_mz[ids] == mz, ids, -1)
+
+def _merge_duplicates(ids: np.ndarray, values: np.ndarray) -> tuple:
+    # Features sharing an m/z label: the first one is kept, and every following one with a greater
+    # mean intensity is added onto it (avoids overlapping features with the same m/z)
+    unique_ids, first, counts = np.unique(ids, return_index=True, return_counts=True)
+    merged = values[first].astype(np.float64)
+    for k in np.flatnonzero(counts > 1):
+        for value in values[ids == unique_ids[k]][1:]:
+            if value > merged[k]:
+                merged[k] += value
+    return unique_ids, merged
+
+def _feature_stats(trace: dict) -> tuple:
+    # Mean intensity of every feature, and whether it correlates with the TIC; sparse time traces
+    # (see time_trace.trace_windowed()) only within the elution window of every feature
+    if "values" not in trace:
+        return np.round(np.mean(trace["intensity"], axis=1)), tic_correlate_batch(trace["tic"], trace["intensity"])
+    counts = np.diff(trace["offsets"])
+    rows = np.repeat(np.arange(len(counts)), counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.bincount(rows, np.asarray(trace["values"], dtype=np.float64), len(counts)) / counts
+        correlated = pearson_windows(trace["tic"], trace["values"], trace["start"], trace["offsets"]) > settings.MIN_TIC_CORRELATION
+    return np.round(means), correlated
+
+def _chunks(n: int, size: int):
+    # At least one, possibly empty, chunk, so that headers are also written for empty matrices
+    for start in range(0, max(n, 1), size):
+        yield slice(start, min(start + size, n))
+
+def _save_npz(file: str, features: np.ndarray, samples: np.ndarray, matrix: np.ndarray, columns: np.ndarray, chunk: int):
+    # Same layout as np.savez(file, features=..., samples=..., intensity=...), but the transposed, filled
+    # intensity matrix is streamed into the archive chunk by chunk instead of being copied as a whole
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as npz:
+        for name, array in (("features", features), ("samples", samples)):
+            with npz.open(name + ".npy", "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, array)
+        with npz.open("intensity.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array_header_2_0(f, {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+                                                     "fortran_order": False, "shape": (len(columns), len(samples))})
+            for rows in _chunks(len(columns), chunk):
+                f.write(np.nan_to_num(matrix[:, columns[rows]].T, nan=1).tobytes())
+
+def _save_csv(file: str, features: np.ndarray, samples: np.ndarray, matrix: np.ndarray, columns: np.ndarray, chunk: int):
+    with open(file, "w", newline='') as matrix_csv:
+        for i, rows in enumerate(_chunks(len(columns), chunk)):
+            block = pd.DataFrame(np.nan_to_num(matrix[:, columns[rows]].T, nan=1), index=features[rows], columns=samples)
+            block.to_csv(matrix_csv, header=(i == 0))
+
+def fill_matrix(names: list, traces, table_mz: dict, max_memory: int = 2**30, tmp: str = None) -> tuple:
     '''
-    Creates a Pandas DataFrame and writes it into a .csv file containing an intensity matrix
-    of shape n x m, where n - samples (files), m - features. The file is saved in the same path
-    as the timetraces provided through path.
+    Fills the intensity matrix of shape n x m, where n - samples, m - features, from the time traces of the files.
+    Every feature gets an integer ID from the sorted feature list of its polarity, and the matrix is filled directly 
+    into a preallocated NumPy array, which is memory-mapped to tmp if it would take more than max_memory bytes.
+    Features with a mean intensity below settings.MIN_INTENSITY or a Pearson's correlation with the total ion current
+    of at most settings.MIN_TIC_CORRELATION are left out. Sparse time traces are averaged and correlated with
+    the total ion current only within the elution window of every feature.
+    
+    Parameters
+    ----------
+    names: list
+        Names of the time traces, <sample>_<polarity>_trace (see polarity.py), from which the sample name and polarity
+        of every time trace are derived. The time traces of both polarities of a sample fill the same row.
+    
+    traces: iterable
+        Time traces (dicts holding the arrays mz, tic and intensity, or start, offsets and values if sparse)
+        in the order of names, e.g. loaded one by one by a generator.
+    
+    table_mz: dict
+        Sorted m/z values of the features of every polarity, keyed by "pos" and "neg".
+    
+    max_memory: int
+        Size in bytes above which the matrix is memory-mapped instead of held in memory.
+    
+    tmp: str
+        Path to the .npy file backing the memory-mapped matrix. If None, the matrix is always held in memory.
+    
+    Returns
+    -------
+    features, samples, matrix, columns: tuple
+        m/z labels of the kept features, sample names, the n x m matrix of mean intensities (NaN where missing)
+        and the indices of the kept features among its columns.
+    '''
+    # Get the sample name of every file, and the row of every sample
+    sample_names = [split_name(name)[0] for name in names]
+    samples = np.asarray(sorted(set(sample_names)), dtype=str)
+    rows = np.searchsorted(samples, sample_names)
+    
+    offsets, labels = _labels(table_mz)
+    
+    # Preallocate the matrix, missing values are NaN
+    shape = (len(samples), len(labels))
+    if tmp is not None and shape[0] * shape[1] * 8 > max_memory:
+        matrix = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float64, shape=shape)
+        matrix[:] = np.nan
+    else:
+        matrix = np.full(shape, np.nan)
+    
+    for name, row, trace in zip(names, rows, traces):
+        polarity = split_name(name)[1]
+        if polarity is None:
+            continue
+        instrumentation.add(bytes_read=sum(array.nbytes for array in trace.values()))
+        if not len(trace["mz"]):
+            continue
+        # compute the mean intensities and TIC correlations of all the features at once
+        intensities, correlated = _feature_stats(trace)
+        keep = (intensities >= settings.MIN_INTENSITY) & correlated
+        ids = _feature_ids(table_mz[polarity], np.asarray(trace["mz"]))
+        if np.any(ids[keep] < 0):
+            print(f"Warning: {name} holds features missing from the feature list, these are skipped.")
+        keep &= ids >= 0
+        ids, values = _merge_duplicates(ids[keep] + offsets[polarity], intensities[keep])
+        # A later file of the same sample overwrites the values of the features they share
+        matrix[row, ids] = values
+    
+    # Save only those features that appear in more than X% of all samples, default 0
+    threshold = max(round(0.0 * len(samples)), 1)
+    columns = np.flatnonzero(np.count_nonzero(~np.isnan(matrix), axis=0) >= threshold)
+    return labels[columns], samples, matrix, columns
+
+def save_matrix(path: str, features: np.ndarray, samples: np.ndarray, matrix: np.ndarray, columns: np.ndarray, csv: bool = False):
+    '''
+    Writes the intensity matrix returned by fill_matrix() transposed (features x samples), with missing values filled with 1,
+    into intensity_matrix.npz on path, with the arrays features (m/z labels), samples (sample names) and intensity,
+    and optionally into intensity_matrix.csv. The matrix is written in chunks of about 64 MB.
+    
+    Parameters
+    ----------
+    path: str
+        Directory in which the intensity matrix is written.
+    
+    features, samples, matrix, columns:
+        As returned by fill_matrix().
+    
+    csv: bool
+        If True, additionally writes the intensity matrix into intensity_matrix.csv.
+    
+    Returns
+    -------
+    None
+    '''
+    path = Path(path)
+    chunk = max(2**23 // max(len(samples), 1), 1)
+    _save_npz(path / "intensity_matrix.npz", features, samples, matrix, columns, chunk)
+    if csv:
+        _save_csv(path / "intensity_matrix.csv", features, samples, matrix, columns, chunk)
+    instrumentation.add(bytes_written=instrumentation.size(path / "intensity_matrix.npz")
+                        + (instrumentation.size(path / "intensity_matrix.csv") if csv else 0))
+
+def intensity_matrix(path: str, csv: bool = False, max_memory: int = 2**30):
+    '''
+    Creates an intensity matrix of shape n x m, where n - samples (files), m - features, and writes it transposed
+    (features x samples) into intensity_matrix.npz, with the arrays features (m/z labels), samples (sample names) 
+    and intensity. The file is saved in the same path as the timetraces provided through path.
+    Every feature gets an integer ID from the feature lists shared by all time traces of a polarity (see time_trace.py),
+    and the matrix is filled directly into a preallocated NumPy array, which is memory-mapped to a temporary file on path
+    if it would take more than max_memory bytes (see fill_matrix()). Only the m/z values, total ion current and intensities 
+    of the time traces are read, as memory maps. Features with a mean intensity below settings.MIN_INTENSITY or a Pearson's 
+    correlation with the total ion current of at most settings.MIN_TIC_CORRELATION are filtered out.
     
     Parameters
     ----------
     path: str 
         String containing the path to timetraces of processed features. 
     
+    csv: bool
+        If True, additionally writes the intensity matrix into intensity_matrix.csv.
+    
+    max_memory: int
+        Size in bytes above which the matrix is memory-mapped instead of held in memory.
+    
     Returns
     -------
     None
     '''
     
+    # Log script execution time
+    st = time.time()
+    
     print(f"Running intensity matrix on {path}...")
     
-    samples = {}
-
-    filelist_csv = [timetrace for timetrace in os.listdir(path / "time_traces") if timetrace.endswith("_trace.csv") and not timetrace.startswith("~")]
-    for file in filelist_csv:
-        features = {}
-        try:
-            if "pos" in file or "neg" in file:
-                # read contents
-                data = np.genfromtxt(path / "time_traces" / file, delimiter=",") 
-                # iterate through all the features
-                for i in range(0, len(data)-2):    # skip 2 first lines: 1st is scan ID, 2nd is TIC
-                    feature = data[i+2]
-                    # pre-compute the intensity 
-                    intensity = round(np.mean(feature[1:]))
-                    if intensity < 10e2:
-                        continue
-                    # check for TIC correlation 
-                    if not tic_correlate(data[1][1:], feature[1:]):
-                        continue
-                    # pre-compute the m/z which is on index 0 of the feature's time trace
-                    mz = "+" + f'{feature[0]}' if "pos" in file else "-" + f'{feature[0]}'
-                    try:
-                        if intensity > features[mz]: 
-                            # and if the mean feature intensity is greater than the curent value for this feature
-                            # (avoids overlapping features with the same m/z)
-                            features[mz] += intensity
-                        else:
-                            continue
-                    except(KeyError):   # if the feature hasn't been added to the dict yet
-                        features[mz] = intensity
-        except EmptyDataError:
-            continue  # Skip empty files
-        if "pos" in file:
-            sample_name = os.path.basename(file).split("_pos")[0]  # Get the last folder as the sample name
-        else:
-            sample_name = os.path.basename(file).split("_neg")[0]
-        if sample_name not in samples:
-            samples[sample_name] = features
-        else:
-            samples[sample_name].update(features)
-
-    samples = {k: v for k, v in sorted(samples.items())} 
-    intensity_matrix = pd.DataFrame.from_dict(data=samples, orient='index')
-
-    # Sort the DataFrame by index (m/z values)
-    intensity_matrix.sort_index(inplace=True)
-    # Save only those features that appear in more than X% of all samples, default 0
-    threshold = round(0.0 * len(intensity_matrix))    
-    intensity_matrix.dropna(thresh=threshold, axis=1, inplace=True)
-    intensity_matrix.fillna(value=1, inplace=True)
-    intensity_matrix=intensity_matrix.T
-    # Write the DataFrame to a .csv file
-    intensity_matrix.to_csv(os.path.join(path, "intensity_matrix.csv"))
-
-print("Done.")
-
-# Print execution time 
-et = time.time()
-elapsed_time = et - st
-print("Intensity matrix constructed in: ", round(elapsed_time, 2), " seconds.")
+    path = Path(path)
+    trace_dir = path / "time_traces"
+    filelist = sorted(timetrace for timetrace in os.listdir(trace_dir) if timetrace.endswith("_trace") and not timetrace.startswith("~"))
+    table_mz = _feature_table(trace_dir, filelist)
+    
+    # memory-map only the arrays needed, one file at a time
+    traces = (load_trace(trace_dir / file, columns=("mz", "tic") + (SPARSE_COLUMNS if is_sparse(trace_dir / file) else ("intensity",)))
+              for file in filelist)
+    tmp = path / "intensity_matrix.tmp.npy"
+    features, samples, matrix, columns = fill_matrix(filelist, traces, table_mz, max_memory, tmp)
+    save_matrix(path, features, samples, matrix, columns, csv)
+    if isinstance(matrix, np.memmap):
+        del matrix
+        os.remove(tmp)
 
+    print("Done.")
 
+    # Print execution time 
+    et = time.time()
+    elapsed_time = et - st
+    print("Intensity matrix constructed in: ", round(elapsed_time, 2), " seconds.")
@@ -0,0 +1,159 @@
+import numpy as np
+
+def interp_accumulate(intensities: np.ndarray, mz_axis: np.ndarray, mz_array: np.ndarray, intensity_array: np.ndarray) -> np.ndarray:
+    '''
+    Linearly interpolates the intensities of a single scan over the resampled m/z axis and adds them onto intensities, in place.
+    Equivalent to intensities += np.interp(mz_axis, mz_array, intensity_array, left=0, right=0), but only the axis indices
+    covered by the scan's m/z range are touched; these are found by binary search (np.searchsorted) of the sorted axis.
+
+    Parameters
+    ----------
+    intensities: np.ndarray
+        Accumulator array of the same length as mz_axis.
+
+    mz_axis: np.ndarray
+        Numpy NDArray containing the resampled m/z axis.
+
+    mz_array: np.ndarray
+        Sorted m/z values of the scan.
+
+    intensity_array: np.ndarray
+        Intensities of the scan.
+
+    Returns
+    -------
+    intensities: np.ndarray
+        The updated accumulator array.
+    '''
+    if len(mz_array) == 0:
+        return intensities
+    lo = np.searchsorted(mz_axis, mz_array[0], side='left')
+    hi = np.searchsorted(mz_axis, mz_array[-1], side='right')
+    intensities[lo:hi] += np.interp(mz_axis[lo:hi], mz_array, intensity_array)
+    return intensities
+
+def window_union(windows: list) -> tuple:
+    '''
+    Merges index windows [left, right) of the m/z axis into one sorted array of unique axis indices, so that
+    the interpolation only needs to be evaluated once per index, even for overlapping windows.
+
+    Parameters
+    ----------
+    windows: list
+        List of [left, right) index pairs, e.g. the peak boundaries of a PeakTable.
+
+    Returns
+    -------
+    union: np.ndarray
+        Sorted, unique axis indices covered by at least one window.
+
+    starts: np.ndarray
+        Position of every window's first index within union. Since windows are contiguous on the axis,
+        window k corresponds to union[starts[k]:starts[k] + right - left].
+    '''
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    if len(windows) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    union = np.unique(np.concatenate([np.arange(left, right) for left, right in windows]))
+    starts = np.searchsorted(union, windows[:, 0])
+    return union, starts
+
+def interp_windows(mz_window: np.ndarray, mz_array: np.ndarray, intensity_array: np.ndarray) -> np.ndarray:
+    '''
+    Linearly interpolates the intensities of a single scan only at the m/z values of the feature windows
+    (MZ_AXIS[union], see window_union()), instead of over the full m/z axis.
+
+    Parameters
+    ----------
+    mz_window: np.ndarray
+        m/z values at which the intensity is evaluated.
+
+    mz_array: np.ndarray
+        Sorted m/z values of the scan.
+
+    intensity_array: np.ndarray
+        Intensities of the scan.
+
+    Returns
+    -------
+    int_interp: np.ndarray
+        Interpolated intensities at mz_window, zero for scans without data points.
+    '''
+    if len(mz_array) == 0:
+        return np.zeros(len(mz_window))
+    return np.interp(mz_window, mz_array, intensity_array)
+
+def trapezoid_pairs(windows: list, starts: np.ndarray) -> tuple:
+    '''
+    Precomputes the index arrays needed by integrate_windows(), once per feature list. Every window [left, right)
+    is integrated with the trapezoidal rule over its right - left - 1 pairs of consecutive points; the pairs of all
+    windows are laid out back to back, so that every window is one contiguous segment.
+
+    Parameters
+    ----------
+    windows: list
+        List of [left, right) index pairs, e.g. the peak boundaries of a PeakTable.
+
+    starts: np.ndarray
+        Position of every window's first index within the union of windows, as returned by window_union().
+
+    Returns
+    -------
+    pairs: tuple
+        (pair_index, segment_starts, nonempty): position of the first point of every pair within the union of windows,
+        position of every non-empty segment within pair_index, and a boolean mask of windows with at least one pair.
+    '''
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    n_pairs = np.maximum(windows[:, 1] - windows[:, 0] - 1, 0)
+    offsets = np.concatenate(([0], np.cumsum(n_pairs)))
+    pair_index = np.repeat(np.asarray(starts, dtype=np.int64) - offsets[:-1], n_pairs) + np.arange(offsets[-1])
+    nonempty = n_pairs > 0
+    return pair_index, offsets[:-1][nonempty], nonempty
+
+def integrate_windows(int_interp: np.ndarray, pairs: tuple) -> np.ndarray:
+    '''
+    Integrates the interpolated intensity over all windows at once with the trapezoidal rule (unit spacing),
+    matching scipy.integrate.trapezoid(int_interp[window]) for every window within floating-point tolerance.
+
+    Parameters
+    ----------
+    int_interp: np.ndarray
+        Interpolated intensities on the union of windows, as returned by interp_windows().
+
+    pairs: tuple
+        Index arrays precomputed by trapezoid_pairs().
+
+    Returns
+    -------
+    integrals: np.ndarray
+        Integrated intensity of every window, zero for windows narrower than two points.
+    '''
+    pair_index, segment_starts, nonempty = pairs
+    integrals = np.zeros(len(nonempty))
+    if len(pair_index):
+        areas = (int_interp[pair_index] + int_interp[pair_index + 1]) / 2.0
+        integrals[nonempty] = np.add.reduceat(areas, segment_starts)
+    return integrals
+
+def scan_integrator(mz_window: np.ndarray, pairs: tuple):
+    '''
+    Returns a function integrating all windows of one scan at once: it interpolates the scan's intensities on the union
+    of windows (see interp_windows()) and integrates them (see integrate_windows()) into out. The NumPy reference
+    of kernels.scan_integrator().
+
+    Parameters
+    ----------
+    mz_window: np.ndarray
+        m/z values of the union of windows, see window_union().
+
+    pairs: tuple
+        Index arrays precomputed by trapezoid_pairs().
+
+    Returns
+    -------
+    integrate: function
+        integrate(mz_array, intensity_array, out), writing the integrated intensity of every window into out.
+    '''
+    def integrate(mz_array: np.ndarray, intensity_array: np.ndarray, out: np.ndarray):
+        out[:] = integrate_windows(interp_windows(mz_window, mz_array, intensity_array), pairs)
+    return integrate
@@ -0,0 +1,150 @@
+'''
+Compiled kernels of the interpolation and integration hot loops, selected with settings.BACKEND ("numpy" or "numba").
+
+The NumPy kernels (see interpolate.py) evaluate every step of a scan as a separate array operation: np.interp() into
+a temporary array, then the trapezoid areas of all windows into another one, then their sums. The Numba kernels fuse
+these steps into a single pass over the scan, without temporary arrays: interp_accumulate() adds the interpolated
+intensities directly onto the accumulator, and scan_integrator() integrates the windows as the areas are computed.
+They perform the same floating-point operations in the same order as the NumPy kernels (np.interp(), and the pairwise
+summation of np.add.reduceat()), so that both backends give the same results; validate() checks this.
+
+Numba is optional: if it is not installed, a warning is printed and the NumPy kernels are used. The compiled kernels are
+in numba_kernels.py, which is only imported when the Numba backend is first used.
+'''
+import time
+import numpy as np
+import settings
+import interpolate
+
+_kernels = None     # The numba_kernels module, once imported by enabled()
+_warned = False
+
+def enabled() -> bool:
+    '''Returns True if the Numba kernels are selected (settings.BACKEND) and available. Numba is only imported here.'''
+    global _kernels, _warned
+    if settings.BACKEND != "numba":
+        return False
+    if _kernels is None and not _warned:
+        try:
+            import numba_kernels
+            _kernels = numba_kernels
+        except ImportError:
+            print("Warning: Numba is not installed, falling back to the NumPy backend.")
+            _warned = True
+    return _kernels is not None
+
+def version() -> str:
+    '''Returns the version of Numba if the Numba kernels are enabled, otherwise None.'''
+    return _kernels.numba.__version__ if enabled() else None
+
+def accumulator():
+    '''
+    Returns the interpolate-and-accumulate kernel of the selected backend, with the signature and result
+    of interpolate.interp_accumulate().
+    '''
+    return _kernels.interp_accumulate if enabled() else interpolate.interp_accumulate
+
+def scan_integrator(mz_window: np.ndarray, pairs: tuple):
+    '''
+    Returns the kernel of the selected backend integrating all windows of one scan at once, see interpolate.scan_integrator().
+    The Numba kernel interpolates into a scratch buffer allocated once, and integrates the windows without temporary arrays.
+
+    Parameters
+    ----------
+    mz_window: np.ndarray
+        m/z values of the union of windows, see interpolate.window_union().
+
+    pairs: tuple
+        Index arrays precomputed by interpolate.trapezoid_pairs().
+
+    Returns
+    -------
+    integrate: function
+        integrate(mz_array, intensity_array, out), writing the integrated intensity of every window into out.
+    '''
+    if not enabled():
+        return interpolate.scan_integrator(mz_window, pairs)
+    pair_index, segment_starts, nonempty = pairs
+    mz_window = np.ascontiguousarray(mz_window, dtype=np.float64)
+    rows = np.flatnonzero(nonempty)
+    scratch = np.empty(len(mz_window))
+    def integrate(mz_array: np.ndarray, intensity_array: np.ndarray, out: np.ndarray):
+        _kernels.integrate_scan(out, scratch, mz_window, mz_array, intensity_array, pair_index, segment_starts, rows)
+    return integrate
+
+def _random_scans(mz_axis: np.ndarray, n_scans: int, points: int, rng: np.random.Generator) -> list:
+    # Sorted scans with duplicate m/z values, zero intensities and scans reaching beyond the axis, as float64 and float32
+    scans = []
+    for i in range(n_scans):
+        mz_array = np.sort(rng.uniform(mz_axis[0] - 1, mz_axis[-1] + 1, points if i % 10 else 0))
+        mz_array[1::17] = mz_array[:-1:17]
+        intensity_array = rng.exponential(1000, len(mz_array)) * (rng.random(len(mz_array)) > 0.3)
+        scans.append((mz_array, intensity_array.astype(np.float32) if i % 2 else intensity_array))
+    return scans
+
+def validate(n_scans: int = 200, points: int = 20000, n_features: int = 300, seed: int = 0) -> dict:
+    '''
+    Compares the Numba kernels with the NumPy kernels on random scans, and times both.
+
+    Parameters
+    ----------
+    n_scans, points: int
+        Number of random scans and data points per scan.
+
+    n_features: int
+        Number of random, partly overlapping feature windows integrated on every scan.
+
+    seed: int
+        Seed of the random scans.
+
+    Returns
+    -------
+    report: dict
+        Maximum absolute difference of the accumulated spectra and of the integrated windows between both backends,
+        and the time taken by every kernel and backend, in seconds.
+    '''
+    backend = settings.BACKEND
+    try:
+        settings.BACKEND = "numba"
+        if not enabled():
+            raise RuntimeError("Numba is not installed.")
+    finally:
+        settings.BACKEND = backend
+    rng = np.random.default_rng(seed)
+    mz_axis = np.linspace(100, 110, 1000000)
+    scans = _random_scans(mz_axis, n_scans, points, rng)
+    left = np.sort(rng.integers(0, len(mz_axis) - 200, n_features))
+    windows = np.stack([left, left + rng.integers(0, 200, n_features)], axis=1)
+    union, starts = interpolate.window_union(windows)
+    pairs = interpolate.trapezoid_pairs(windows, starts)
+    backend, report, results = settings.BACKEND, {}, {}
+    try:
+        for name in ("numpy", "numba"):
+            settings.BACKEND = name
+            accumulate, integrate = accumulator(), scan_integrator(mz_axis[union], pairs)
+            # Compile (or load from the cache) for float32 and float64 intensities before timing
+            for mz_array, intensity_array in scans[1:3]:
+                accumulate(np.zeros(len(mz_axis)), mz_axis, mz_array, intensity_array)
+                integrate(mz_array, intensity_array, np.empty(n_features))
+
+            st = time.time()
+            intensities = np.zeros(len(mz_axis))
+            for mz_array, intensity_array in scans:
+                accumulate(intensities, mz_axis, mz_array, intensity_array)
+            report[f"accumulate_{name}_s"] = time.time() - st
+
+            st = time.time()
+            integrals = np.empty((n_scans, n_features))
+            for j, (mz_array, intensity_array) in enumerate(scans):
+                integrate(mz_array, intensity_array, integrals[j])
+            report[f"integrate_{name}_s"] = time.time() - st
+            results[name] = intensities, integrals
+    finally:
+        settings.BACKEND = backend
+    report["accumulate_max_diff"] = float(np.abs(results["numpy"][0] - results["numba"][0]).max())
+    report["integrate_max_diff"] = float(np.abs(results["numpy"][1] - results["numba"][1]).max())
+    return report
+
+if __name__ == "__main__":
+    for key, value in validate().items():
+        print(f"{key}: {value:.6g}")
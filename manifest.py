@@ -0,0 +1,253 @@
+import os, json, hashlib, time
+import numpy as np
+from pathlib import Path
+import settings
+
+# Name of the directory, next to the mzML files, holding one processing record per mzML file
+MANIFEST_DIR = "manifest"
+
+def processing_settings() -> dict:
+    '''
+    Returns the settings that determine the output of the pipeline, as recorded in the manifest.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    settings: dict
+        m/z axis definition, intensity data type and peak picking thresholds from settings.py.
+    '''
+    return {"MZ_MIN": settings.MZ_MIN, "MZ_MAX": settings.MZ_MAX, "RES": settings.RES,
+            "AXIS_MODE": settings.AXIS_MODE, "PPM": settings.PPM,
+            "INTENSITY_DTYPE": np.dtype(settings.INTENSITY_DTYPE).name,
+            "PEAK_HEIGHT": settings.PEAK_HEIGHT, "PEAK_DISTANCE": settings.PEAK_DISTANCE,
+            "PEAK_REL_HEIGHT": settings.PEAK_REL_HEIGHT, "PEAK_DISTANCE_PPM": settings.PEAK_DISTANCE_PPM,
+            "PEAK_WIDTH_PPM": settings.PEAK_WIDTH_PPM}
+
+def window_settings() -> dict:
+    '''Returns the settings of the elution windows of the time traces (see time_trace.trace_windowed()), None for full time traces.'''
+    if settings.TRACE_MODE != "windowed":
+        return None
+    return {"stride": settings.RT_STRIDE, "threshold": settings.RT_THRESHOLD, "margin": settings.RT_MARGIN}
+
+def axis_fingerprint(mz_axis: np.ndarray) -> list:
+    '''Returns the first, middle and last value and the length of the m/z axis, which identify a resampled (linear or ppm) axis.'''
+    return [float(mz_axis[0]), float(mz_axis[len(mz_axis)//2]), float(mz_axis[-1]), len(mz_axis)]
+
+def peaks_hash(peaklist) -> str:
+    '''
+    Returns a hash of the peak boundaries of a peak table, which changes whenever the peak picking result changes.
+
+    Parameters
+    ----------
+    peaklist: PeakTable
+        Peak table, see peak_pick.py.
+
+    Returns
+    -------
+    hash: str
+        SHA-256 hex digest of the peak indices and boundaries.
+    '''
+    peaks = np.stack([peaklist.apex, peaklist.left, peaklist.right], axis=1).astype(np.int64)
+    return hashlib.sha256(peaks.tobytes()).hexdigest()
+
+def file_hash(file: str, chunk_size: int = 2**24) -> str:
+    '''Returns the SHA-256 hex digest of a file's content, read in chunks of chunk_size bytes.'''
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_json(file: str, obj: dict):
+    '''
+    Atomically writes obj as JSON into file: the content is written into a temporary file first,
+    which then replaces file, so that readers never see a partially written file.
+    '''
+    file = Path(file)
+    tmp = file.with_name(file.name + ".tmp")
+    with open(tmp, "w") as tmp_json:
+        json.dump(obj, tmp_json, indent=1)
+    os.replace(tmp, file)
+
+def record_path(path: str, file: str) -> Path:
+    '''Returns the path to the manifest record of the given mzML file, in the manifest directory on path.'''
+    return Path(path) / MANIFEST_DIR / "{}.json".format(Path(file).name)
+
+def load_record(path: str, file: str) -> dict:
+    '''
+    Loads the manifest record of the given mzML file.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    file: str
+        Path to or name of the mzML file.
+
+    Returns
+    -------
+    record: dict
+        Recorded size, modification time, hash, settings and completed stages of the file. Empty if there is no record.
+    '''
+    try:
+        with open(record_path(path, file)) as record_json:
+            return json.load(record_json)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _same_input(record: dict, file: Path) -> bool:
+    # Unchanged size and modification time are trusted; otherwise, the content hash decides
+    if not record:
+        return False
+    stat = os.stat(file)
+    if stat.st_size != record["size"]:
+        return False
+    if stat.st_mtime_ns == record["mtime_ns"]:
+        return True
+    return file_hash(file) == record["sha256"]
+
+def is_current(path: str, file: str, stage: str, **expected) -> bool:
+    '''
+    Checks whether a stage was already completed for the given mzML file, with the file's current content
+    and the expected stage parameters (e.g. m/z axis or peak list).
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    file: str
+        Path to the mzML file.
+
+    stage: str
+        Name of the processing stage, e.g. "average" or "trace".
+
+    **expected:
+        Stage parameters that have to match the recorded ones.
+
+    Returns
+    -------
+    True if the stage does not need to be rerun for this file. Otherwise returns False.
+    '''
+    record = load_record(path, file)
+    info = record.get("stages", {}).get(stage)
+    if info is None or not _same_input(record, Path(file)):
+        return False
+    return all(info.get(key) == value for key, value in expected.items())
+
+def mark_done(path: str, file: str, stage: str, **info):
+    '''
+    Records the completion of a stage for the given mzML file. If the file is new or its content has changed,
+    the record is started afresh, invalidating all the stages completed on its previous content.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    file: str
+        Path to the mzML file.
+
+    stage: str
+        Name of the processing stage, e.g. "average" or "trace".
+
+    **info:
+        Stage parameters to be recorded (e.g. m/z axis or peak list).
+
+    Returns
+    -------
+    None
+    '''
+    file = Path(file)
+    record = load_record(path, file)
+    stat = os.stat(file)
+    if not _same_input(record, file):
+        record = {"source": file.name, "sha256": file_hash(file), "stages": {}}
+    record.update({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "settings": processing_settings()})
+    record["stages"][stage] = info
+    record_path(path, file).parent.mkdir(parents=True, exist_ok=True)
+    write_json(record_path(path, file), record)
+
+def clear_done(path: str, file: str, stage: str):
+    '''
+    Removes a stage from the manifest record of an mzML file before its outputs are rewritten, so that they are
+    not taken as current if the stage is interrupted.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    file: str
+        Path to the mzML file.
+
+    stage: str
+        Name of the processing stage, e.g. "average" or "trace".
+
+    Returns
+    -------
+    None
+    '''
+    record = load_record(path, file)
+    if stage in record.get("stages", {}):
+        del record["stages"][stage]
+        write_json(record_path(path, file), record)
+
+def stages_path(path: str) -> Path:
+    '''Returns the path to the stage markers of the pipeline runs on path, in the manifest directory.'''
+    return Path(path) / MANIFEST_DIR / "stages.json"
+
+def load_stages(path: str) -> dict:
+    '''
+    Loads the stage markers of the pipeline runs on path.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    Returns
+    -------
+    stages: dict
+        Recorded completion time and parameters of every completed stage, keyed by stage name. Empty if there are none.
+    '''
+    try:
+        with open(stages_path(path)) as stages_json:
+            return json.load(stages_json)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def mark_stage(path: str, stage: str, **info):
+    '''
+    Atomically records the completion of a pipeline stage over all files on path, together with its parameters
+    (e.g. the settings it ran with), see pipeline.py.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    stage: str
+        Name of the pipeline stage, e.g. "composite".
+
+    **info:
+        Stage parameters to be recorded.
+
+    Returns
+    -------
+    None
+    '''
+    stages = load_stages(path)
+    stages[stage] = {"completed": time.strftime("%Y-%m-%dT%H:%M:%S"), **info}
+    stages_path(path).parent.mkdir(parents=True, exist_ok=True)
+    write_json(stages_path(path), stages)
+
+def clear_stages(path: str, stages: list):
+    '''Atomically removes the markers of the given pipeline stages on path, so that they are rerun by the next run.'''
+    markers = load_stages(path)
+    if any(stage in markers for stage in stages):
+        write_json(stages_path(path), {stage: info for stage, info in markers.items() if stage not in stages})
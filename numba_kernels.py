@@ -0,0 +1,111 @@
+'''
+Numba kernels of the interpolation and integration hot loops, see kernels.py. This module requires Numba, and is only
+imported by kernels.enabled() once the Numba backend is selected, so that the NumPy backend does not import Numba.
+'''
+import numba
+import numpy as np
+
+@numba.njit(cache=True, nogil=True, error_model="numpy")
+def _interval(xp, j, value):
+    # Index j of the interval xp[j] <= value < xp[j + 1], for xp[0] <= value < xp[-1], searched onwards from the
+    # previous interval: most steps stay within the interval or move to the next one, larger ones are bisected
+    if xp[j + 1] > value:
+        return j
+    if xp[j + 2] > value:
+        return j + 1
+    return j + np.searchsorted(xp[j + 1:], value, side='right')
+
+@numba.njit(cache=True, nogil=True, error_model="numpy")
+def _interp_into(out, x, xp, fp, accumulate):
+    # Writes (or adds) np.interp(x, xp, fp) into out for sorted x, with the same floating-point operations as NumPy.
+    # The slope of an interval is computed once, when the first value of x falls into it
+    n = len(xp)
+    first, last = np.float64(fp[0]), np.float64(fp[n - 1])
+    j, current = 0, -1
+    left = right = slope = 0.0
+    for i in range(len(x)):
+        value = x[i]
+        if value < xp[0]:
+            result = first
+        elif value >= xp[n - 1]:
+            result = last
+        else:
+            j = _interval(xp, j, value)
+            if j != current:
+                current = j
+                left, right = np.float64(fp[j]), np.float64(fp[j + 1])
+                slope = (right - left) / (xp[j + 1] - xp[j])
+            if xp[j] == value:
+                result = left
+            else:
+                result = slope * (value - xp[j]) + left
+                if np.isnan(result):
+                    result = slope * (value - xp[j + 1]) + right
+                    if np.isnan(result) and left == right:
+                        result = left
+        if accumulate:
+            out[i] += result
+        else:
+            out[i] = result
+
+@numba.njit(cache=True, nogil=True, error_model="numpy")
+def interp_accumulate(intensities, mz_axis, mz_array, intensity_array):
+    if len(mz_array) == 0:
+        return intensities
+    lo = np.searchsorted(mz_axis, mz_array[0], side='left')
+    hi = np.searchsorted(mz_axis, mz_array[-1], side='right')
+    _interp_into(intensities[lo:hi], mz_axis[lo:hi], mz_array, intensity_array, True)
+    return intensities
+
+@numba.njit(cache=True, nogil=True, error_model="numpy")
+def _area(values, pair_index, k):
+    p = pair_index[k]
+    return (values[p] + values[p + 1]) / 2.0
+
+@numba.njit(cache=True, nogil=True, error_model="numpy")
+def _pairwise(values, pair_index, first, n):
+    # Sum of the areas first, ..., first + n - 1 in the order of NumPy's pairwise summation
+    if n < 8:
+        total = 0.0
+        for k in range(first, first + n):
+            total += _area(values, pair_index, k)
+        return total
+    if n <= 128:
+        r0 = _area(values, pair_index, first)
+        r1 = _area(values, pair_index, first + 1)
+        r2 = _area(values, pair_index, first + 2)
+        r3 = _area(values, pair_index, first + 3)
+        r4 = _area(values, pair_index, first + 4)
+        r5 = _area(values, pair_index, first + 5)
+        r6 = _area(values, pair_index, first + 6)
+        r7 = _area(values, pair_index, first + 7)
+        blocks = n - n % 8
+        for k in range(first + 8, first + blocks, 8):
+            r0 += _area(values, pair_index, k)
+            r1 += _area(values, pair_index, k + 1)
+            r2 += _area(values, pair_index, k + 2)
+            r3 += _area(values, pair_index, k + 3)
+            r4 += _area(values, pair_index, k + 4)
+            r5 += _area(values, pair_index, k + 5)
+            r6 += _area(values, pair_index, k + 6)
+            r7 += _area(values, pair_index, k + 7)
+        total = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        for k in range(first + blocks, first + n):
+            total += _area(values, pair_index, k)
+        return total
+    half = n // 2
+    half -= half % 8
+    return _pairwise(values, pair_index, first, half) + _pairwise(values, pair_index, first + half, n - half)
+
+@numba.njit(cache=True, nogil=True, error_model="numpy")
+def integrate_scan(out, scratch, mz_window, mz_array, intensity_array, pair_index, segment_starts, rows):
+    out[:] = 0.0
+    if len(mz_array) == 0:
+        return
+    _interp_into(scratch, mz_window, mz_array, intensity_array, False)
+    n_segments = len(segment_starts)
+    for s in range(n_segments):
+        first = segment_starts[s]
+        end = segment_starts[s + 1] if s + 1 < n_segments else len(pair_index)
+        # np.add.reduceat() adds the pairwise sum of the rest of the segment onto its first element
+        out[rows[s]] = _area(scratch, pair_index, first) + _pairwise(scratch, pair_index, first + 1, end - first - 1)
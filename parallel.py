@@ -0,0 +1,103 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Manager
+from queue import Empty
+from tqdm import tqdm
+import settings
+import instrumentation
+
+class QueueProgress():
+    '''Minimal stand-in for a tqdm progress bar inside worker processes. \n
+
+    Updates are buffered and sent in batches to the parent process through a queue, where
+    they are aggregated into one progress bar for all workers.
+
+    Properties:
+    -----------
+    queue: Queue
+        Queue shared with the parent process.
+    batch: int
+        Number of updates buffered before they are sent.
+    '''
+
+    def __init__(self, queue, total: int = 0, batch: int = 100):
+        self.queue = queue
+        self.batch = batch
+        self.pending = 0
+        if total:
+            self.queue.put(("total", total))
+
+    def update(self, n: int = 1):
+        self.pending += n
+        if self.pending >= self.batch:
+            self.queue.put(("update", self.pending))
+            self.pending = 0
+
+    def close(self):
+        if self.pending:
+            self.queue.put(("update", self.pending))
+            self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _configure(config: dict, queue, instrumentation_state: dict):
+    # Worker processes may start from a fresh import of settings.py (e.g. with the spawn start method)
+    settings.configure(**config)
+    # Spans closed in the worker are sent to the parent process through the progress queue
+    instrumentation.worker(queue, **instrumentation_state)
+
+def _drain(queue, pbar: tqdm):
+    while True:
+        try:
+            kind, n = queue.get_nowait()
+        except Empty:
+            return
+        if kind == "total":
+            pbar.total = (pbar.total or 0) + n
+            pbar.refresh()
+        elif kind == "span":
+            instrumentation.collect(n)
+        else:
+            pbar.update(n)
+
+def run_parallel(function, jobs: list, workers: int, desc: str = None) -> list:
+    '''
+    Runs function(*job, progress=...) for every job on a pool of worker processes, and aggregates
+    the progress reported by all workers into a single tqdm progress bar. The workers are configured
+    with the current settings of the parent process (see settings.configure()), and the spans closed
+    in the workers are collected into the parent's run report (see instrumentation.py).
+
+    Parameters
+    ----------
+    function: callable
+        Picklable, module-level function processing one job. It receives a QueueProgress object
+        through the progress keyword argument, which it should use like a tqdm progress bar.
+
+    jobs: list
+        List of argument tuples, one per job (e.g. one per mzML file).
+
+    workers: int
+        Number of worker processes.
+
+    desc: str
+        Description of the aggregated progress bar.
+
+    Returns
+    -------
+    results: list
+        Return values of function, in the order of jobs.
+    '''
+    with Manager() as manager:
+        queue = manager.Queue()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_configure,
+                                 initargs=(settings.snapshot(), queue, instrumentation.state())) as executor, tqdm(total=0, desc=desc) as pbar:
+            futures = [executor.submit(function, *job, progress=queue) for job in jobs]
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                _drain(queue, pbar)
+            _drain(queue, pbar)
+            return [future.result() for future in futures]
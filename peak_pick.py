@@ -1,81 +1,173 @@
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from scipy.signal import find_peaks, peak_widths, peak_prominences
-import matplotlib.pyplot as plt
+import settings
+
+class PeakTable():
+    '''Array-backed table of the peaks picked on a composite spectrum, one row per peak. \n
 
-class Peak():
-    '''Support class for Peak objects. \n
-    
     Properties:
     -----------
+    apex: np.ndarray
+        Index of the peak centroid on the m/z axis.
+    left, right: np.ndarray
+        Peak boundaries [left, right) on the m/z axis, calculated at settings.PEAK_REL_HEIGHT of the peak prominence.
+    apex_mz: np.ndarray
+        m/z value of the peak centroid.
     mz: np.ndarray
-        Numpy array of mz values computed from indices of intensity axis, returned by scipy.find_peaks().
-    index: int
-        Index of the peak centroid. 
-    width: list 
-        Peak boundaries calculated at 0.9 of peak amplitude.
+        m/z value of the feature: the median m/z value within the peak boundaries, rounded to 4 decimals.
+    height: np.ndarray
+        Intensity of the peak centroid.
+    prominence: np.ndarray
+        Prominence of the peak, see scipy.signal.peak_prominences().
         '''
 
-    def __init__(self, index: int, mz: np.ndarray, width: list):
-        self.index = index
-        self.mz = mz
-        self.width = width
+    COLUMNS = ("apex", "left", "right", "apex_mz", "mz", "height", "prominence")
+
+    def __init__(self, apex: np.ndarray, left: np.ndarray, right: np.ndarray, apex_mz: np.ndarray,
+                 mz: np.ndarray, height: np.ndarray, prominence: np.ndarray):
+        self.apex = np.asarray(apex, dtype=np.int64)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.apex_mz = np.asarray(apex_mz, dtype=np.float64)
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.height = np.asarray(height, dtype=np.float64)
+        self.prominence = np.asarray(prominence, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.apex)
 
     def __str__(self):
-        return f"Feature with m/z range: {self.mz} and intensity range: {self.int_range} "
+        return f"Peak table of {len(self)} features with m/z range: {self.mz.min() if len(self) else None}-{self.mz.max() if len(self) else None}"
+
+    @property
+    def windows(self) -> np.ndarray:
+        '''n x 2 array of the peak boundaries [left, right) on the m/z axis.'''
+        return np.stack([self.left, self.right], axis=1)
+
+    def save(self, file: str):
+        '''Saves the peak table into a .npz file, one array per column.'''
+        np.savez(file, **{column: getattr(self, column) for column in self.COLUMNS})
+
+    @classmethod
+    def load(cls, file: str) -> "PeakTable":
+        '''Loads a peak table saved with save().'''
+        with np.load(file) as table:
+            return cls(**{column: table[column] for column in cls.COLUMNS})
+
+def _window_median(MZ_AXIS: np.ndarray, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    # Median of the sorted slices MZ_AXIS[left:right], as np.median() would compute it, rounded to 4 decimals; NaN for empty slices
+    n = right - left
+    valid = n > 0
+    lower = MZ_AXIS[np.where(valid, left + (n - 1) // 2, 0)]
+    upper = MZ_AXIS[np.where(valid, left + n // 2, 0)]
+    return np.where(valid, np.round((lower + upper) / 2, 4), np.nan)
+
+def _segments(intensity: np.ndarray, n_segments: int, height: float, distance: int) -> list:
+    # Splits the spectrum into up to n_segments [start, stop] ranges which share their boundary points. A boundary must lie on
+    # the minimum of the whole spectrum, so that the prominences and widths of the peaks, which are found by searching outwards
+    # from the peaks down to the lowest point, do not change, and no point within distance of it may reach the peak height,
+    # so that no two peaks on either side of it compete in the distance condition. If no such points exist, the spectrum
+    # is processed as a whole.
+    n = len(intensity)
+    if n_segments <= 1 or n < 3:
+        return [(0, n)]
+    candidates = np.flatnonzero(intensity <= intensity.min())
+    high = np.concatenate(([0], np.cumsum(intensity >= height)))
+    candidates = candidates[high[np.minimum(candidates + distance + 1, n)] == high[np.maximum(candidates - distance, 0)]]
+    if not len(candidates):
+        return [(0, n)]
+    # Boundaries closest to evenly spaced targets
+    targets = np.arange(1, n_segments) * n // n_segments
+    nearest = np.clip(np.searchsorted(candidates, targets), 1, len(candidates)) - 1
+    closer = np.clip(nearest + 1, None, len(candidates) - 1)
+    nearest = np.where(np.abs(candidates[closer] - targets) < np.abs(candidates[nearest] - targets), closer, nearest)
+    bounds = np.unique(np.concatenate(([0], candidates[nearest], [n - 1])))
+    return [(int(start), int(stop) + 1) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def _pick_segment(intensity: np.ndarray, start: int, stop: int, height: float, distance: int, min_width: float, rel_height: float) -> tuple:
+    # Picks the peaks of one segment, returning their apex, boundaries, heights and prominences on the whole m/z axis
+    segment = np.ascontiguousarray(intensity[start:stop], dtype=np.float64)
+    # Find peaks by cutting off at a given intensity to remove noise
+    apex, properties = find_peaks(segment, height=height, distance=distance, width=min_width)
+    # Find widths at the base of the peak
+    prominence = peak_prominences(segment, apex)
+    widths, width_heights, left, right = peak_widths(segment, apex, rel_height=rel_height, prominence_data=prominence)
+    return (apex + start, np.floor(left).astype(np.int64) + start, np.ceil(right).astype(np.int64) + start,
+            properties["peak_heights"], prominence[0])
 
-def peak_pick(spectrum: np.ndarray, MZ_AXIS: np.ndarray) -> list:
+def peak_pick(spectrum: np.ndarray, MZ_AXIS: np.ndarray, height: float = None, distance: float = None, rel_height: float = None,
+              distance_ppm: float = None, width_ppm: float = None, segments: int = None, threads: int = None) -> PeakTable:
     '''
     Using the SciPy find_peaks() function, performs peak picking and integration of peaks from average mass spectra.
-        
+    The spectrum can be split into segments (m/z chunks), picked in parallel on a thread pool; it is only split at points
+    where this cannot change the result (see _segments()), so that the peak table is the same as with a single segment.
+
     Parameters
     ----------
     spectrum: np.ndarray
-        Composite spectrum on which to pick peaks.
-    
+        Composite spectrum on which to pick peaks, either as an intensity vector over MZ_AXIS
+        (e.g. memory-mapped from composite_spectrum_*.npy) or as a 2-dimensional array: m/z, intensity.
+
     MZ_AXIS: np.ndarray
-        Linear m/z axis as the reference for peak width and intensity.
-    
+        Linear or ppm m/z axis (see settings.AXIS_MODE) as the reference for peak width and intensity.
+
+    height, distance, rel_height, distance_ppm, width_ppm: float
+        Peak picking thresholds, by default settings.PEAK_HEIGHT, PEAK_DISTANCE, PEAK_REL_HEIGHT, PEAK_DISTANCE_PPM
+        and PEAK_WIDTH_PPM. distance (in points) applies to a linear axis, distance_ppm and width_ppm to a ppm axis.
+
+    segments: int
+        Number of m/z chunks the spectrum is split into, by default settings.PEAK_SEGMENTS.
+
+    threads: int
+        Number of threads picking the segments, by default the number of CPUs.
+
     Returns
     -------
-    
-    peaklist: list 
-        List of Peak objects.
+
+    peaks: PeakTable
+        Table of the picked peaks, sorted by m/z.
     '''
+    height = settings.PEAK_HEIGHT if height is None else height
+    rel_height = settings.PEAK_REL_HEIGHT if rel_height is None else rel_height
+    segments = settings.PEAK_SEGMENTS if segments is None else segments
+    threads = (os.cpu_count() or 1) if threads is None else threads
 
-    peaklist = []
+    # Get the intensity array, transposing into rows if the m/z values are included
+    corr_intensity = spectrum if spectrum.ndim == 1 else spectrum.transpose()[1]
+    # On a ppm axis, every point spans the same relative m/z width, so distances and widths
+    # given in ppm translate into a constant number of points
+    if settings.AXIS_MODE == "ppm":
+        distance_ppm = settings.PEAK_DISTANCE_PPM if distance_ppm is None else distance_ppm
+        width_ppm = settings.PEAK_WIDTH_PPM if width_ppm is None else width_ppm
+        ppm_per_point = (MZ_AXIS[1] / MZ_AXIS[0] - 1) * 1e6
+        distance = max(1, round(distance_ppm / ppm_per_point))
+        min_width = None if width_ppm is None else width_ppm / ppm_per_point
+    else:
+        distance, min_width = settings.PEAK_DISTANCE if distance is None else distance, None
 
-    # Transpose into rows and get the intensity array
+    bounds = _segments(corr_intensity, segments, height, distance)
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(bounds)))) as executor:
+        picked = list(executor.map(lambda bound: _pick_segment(corr_intensity, *bound, height, distance, min_width, rel_height), bounds))
+    apex, left, right, heights, prominence = (np.concatenate(column) for column in zip(*picked))
 
-    # Transpose into rows and get the intensity array
-    corr_intensity = spectrum.transpose()[1]
-    # Find peaks by cutting off at a given intensity to remove noise
-    peaks = find_peaks(corr_intensity, height=1000, distance=50)
+    peaks = PeakTable(apex, left, right, MZ_AXIS[apex], _window_median(MZ_AXIS, left, right), heights, prominence)
 
-    # Find widths at the base of the peak 
-    widths, width_heights, left, right = peak_widths(corr_intensity, peaks[0], rel_height=0.9)
-    counter = 0
-    # For all peaks found, extract their properties and append the Peak to peaklist
-    for peak_idx in peaks[0]:
-        mz = MZ_AXIS[int(np.floor(left[counter])):int(np.ceil(right[counter]))]   # m/z range
-        width = [int(np.floor(left[counter])), int(np.ceil(right[counter]))]      # left and right base
-        peak = Peak(peak_idx, mz, width)
-        counter += 1
-        peaklist.append(peak)
-
-    print(f"Found {len(peaklist)} peaks.")
+    print(f"Found {len(peaks)} peaks.")
 
     '''
     Graphing interface for debugging purposes
 
+    import matplotlib.pyplot as plt
     print(peaks)
     fig = plt.figure()
     ax = fig.subplots()
     plt.plot(MZ_AXIS, corr_intensity)
-    ax.scatter(MZ_AXIS[peaks[0]], peaks[1]['peak_heights'], color = 'r', s=15)
+    ax.scatter(peaks.apex_mz, peaks.height, color = 'r', s=15)
     ax.legend()
     ax.grid()
     plt.show()
     '''
 
-    return peaklist
-
+    return peaks
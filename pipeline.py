@@ -0,0 +1,354 @@
+'''
+Runs the stages of the preprocessing pipeline in order, resuming interrupted runs and skipping completed work:
+
+    average -> composite -> peaks -> trace -> matrix
+
+Within the average and trace stages, every file is a unit of work whose completion is recorded in its manifest record
+(see manifest.py), so that a rerun only processes new or changed files and the files not completed before an interruption.
+The completion of every stage over all files is recorded in the stage markers (manifest/stages.json), which are written
+atomically after the stage. A stage is skipped if its marker matches the current settings and no earlier stage changed
+its output in this run; the average stage always runs, as only it can detect new or changed mzML files.
+Before any other stage runs, its own marker and the markers of all later stages are removed, so that an interruption
+during the stage cannot leave them matching its partial output, and the later ones are removed again when the stage
+changes its output. Likewise, a file's completion of the average or trace stage is removed from its manifest record
+before its outputs are rewritten.
+The composite marker also records the averaged spectra it was built from, so that averaged spectra written by an
+interrupted average stage are reduced by the next run.
+
+A single stage, or all stages from a given stage onwards, can be forced to rerun, e.g. only the peak picking or only
+the intensity matrix after tuning their thresholds, without touching the averaging output. A forced stage reprocesses
+all files, ignoring their manifest records (average, trace) and the saved composite accumulators (composite).
+
+To embed the preprocessing, e.g. in a service, Pipeline runs the same stages in memory: every stage passes its NumPy arrays
+on to the next one instead of writing files which the next one reads back, and writing the results to disk is optional.
+Importing this module has no side effects; the settings (see settings.py) are read when a Pipeline is created.
+'''
+
+import shutil
+from pathlib import Path
+import numpy as np
+import settings
+import instrumentation
+from average import average, average_scans
+from composite_spectrum import composite_spectrum, averaged_spectra, CompositeAccumulator
+from peak_pick import peak_pick
+from scan_store import open_reader, decode_scans, MemoryScans, select_polarity, scan_polarities
+from spectrum_store import save_axis, save_spectrum, export_csv
+from time_trace import pick_peaks, load_peaks, time_trace, trace as trace_scans, trace_windowed
+from trace_store import trace_name, save_trace, save_peaks, save_features, export_csv as export_trace_csv
+from intensity_matrix import intensity_matrix, fill_matrix, save_matrix
+from manifest import processing_settings, window_settings, peaks_hash, load_stages, mark_stage, clear_stages
+from polarity import POLARITIES, file_polarity, output_name, split_name
+
+STAGES = ("average", "composite", "peaks", "trace", "matrix")
+
+# Settings (see manifest.processing_settings()) that determine the output of each stage
+AXIS_SETTINGS = ("MZ_MIN", "MZ_MAX", "RES", "AXIS_MODE", "PPM", "INTENSITY_DTYPE")
+
+def stage_params(stage: str, csv: bool = False) -> dict:
+    '''
+    Returns the parameters which determine the output of a stage, as recorded in its stage marker.
+
+    Parameters
+    ----------
+    stage: str
+        Name of the stage, out of STAGES.
+
+    csv: bool
+        Whether the .csv exports are written.
+
+    Returns
+    -------
+    params: dict
+        Settings of the stage, and for the intensity matrix, its filtering thresholds and the .csv export.
+    '''
+    config = processing_settings()
+    if stage in ("average", "composite"):
+        return {"settings": {key: config[key] for key in AXIS_SETTINGS}}
+    if stage == "peaks":
+        return {"settings": config}
+    if stage == "trace":
+        return {"settings": config, "windows": window_settings()}
+    return {"settings": {**config, "MIN_INTENSITY": settings.MIN_INTENSITY, "MIN_TIC_CORRELATION": settings.MIN_TIC_CORRELATION},
+            "csv": csv}
+
+def select_stages(from_stage: str = None, only_stage: str = None) -> tuple:
+    '''
+    Returns the stages to run and the stages forced to rerun.
+
+    Parameters
+    ----------
+    from_stage: str
+        Stage from which on all stages are run, the earlier ones are skipped; it is forced to rerun.
+
+    only_stage: str
+        Single stage to be run; it is forced to rerun.
+
+    Returns
+    -------
+    selected, forced: tuple
+        Names of the stages to run, in order, and of the stages forced to rerun.
+    '''
+    for stage in (from_stage, only_stage):
+        if stage is not None and stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}, use one of {', '.join(STAGES)}.")
+    if from_stage is not None and only_stage is not None:
+        raise ValueError("Use either from_stage or only_stage, not both.")
+    if only_stage is not None:
+        return (only_stage,), {only_stage}
+    if from_stage is not None:
+        return STAGES[STAGES.index(from_stage):], {from_stage}
+    return STAGES, set()
+
+def run(path: str, csv: bool = False, workers: int = 1, profile: bool = False, from_stage: str = None, only_stage: str = None):
+    '''
+    Runs the pipeline on the mzML files on path, see the module docstring.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files to be processed.
+
+    csv: bool
+        If True, the averaged and composite spectra, time traces and intensity matrix are additionally exported to .csv files.
+
+    workers: int
+        Number of worker processes used for averaging and time tracing.
+
+    profile: bool
+        If True, every stage is profiled with cProfile, see instrumentation.py.
+
+    from_stage: str
+        Stage from which on all stages are run, forcing it to rerun; the earlier stages are not run.
+
+    only_stage: str
+        Single stage to be run, forcing it to rerun.
+
+    Returns
+    -------
+    None
+    '''
+    path = Path(path)
+    selected, forced = select_stages(from_stage, only_stage)
+
+    # Prepare the directory structure
+    for directory in ("average", "time_traces", "scans", "manifest"):
+        (path / directory).mkdir(exist_ok=True)
+
+    # Record the time, CPU time, throughput and memory use of every stage and file in the run report
+    instrumentation.start_run(path / instrumentation.REPORT_FILE, profile_dir=path / instrumentation.PROFILE_DIR if profile else None,
+                              settings=settings.snapshot(), workers=workers, stages=list(selected))
+
+    changed = False     # Whether an earlier stage changed its output in this run
+    peaks = None
+    for stage in selected:
+        marker = load_stages(path).get(stage)
+        params = stage_params(stage, csv)
+        if stage == "composite":
+            params["spectra"] = averaged_spectra(path)
+        current = marker is not None and all(marker.get(key) == value for key, value in params.items())
+        if stage != "average" and stage not in forced and current and not changed:
+            print(f"Skipping stage {stage}, completed on {marker['completed']}...")
+            continue
+        if stage != "average":
+            clear_stages(path, STAGES[STAGES.index(stage):])
+
+        with instrumentation.span(stage, profile=True):
+            if stage == "average":
+                stage_changed = bool(average(path / "average", settings.MZ_AXIS, csv=csv, workers=workers, force=stage in forced))
+            elif stage == "composite":
+                # Average the averaged spectra to create a composite spectrum of all mzML files on the file path,
+                # only new or changed averaged spectra are added to the running sums
+                composite_spectrum(path, settings.MZ_AXIS, csv=csv, force=stage in forced)
+                stage_changed = True
+            elif stage == "peaks":
+                peaks = pick_peaks(path / "time_traces", settings.MZ_AXIS)
+                params["hashes"] = {polarity: peaks_hash(table) for polarity, table in peaks.items()}
+                stage_changed = marker is None or marker.get("hashes") != params["hashes"]
+            elif stage == "trace":
+                # Construct the respective time traces with the peak tables of this run, or of the last one
+                peaks = peaks or load_peaks(path / "time_traces")
+                stage_changed = bool(time_trace(path / "time_traces", settings.MZ_AXIS, csv=csv, workers=workers, peaks=peaks, force=stage in forced))
+            else:
+                # Write the intensity matrix of all samples and all peaks
+                intensity_matrix(path, csv=csv)
+                stage_changed = True
+
+        mark_stage(path, stage, **params)
+        if stage_changed:
+            changed = True
+            clear_stages(path, STAGES[STAGES.index(stage) + 1:])
+
+class Pipeline():
+    '''In-memory preprocessing pipeline, running the stages of run() on a list of mzML files without file round-trips. \n
+
+    The MS1 scans of every file are decoded once and kept in memory, the averaged spectra are reduced into the composite
+    accumulators in the sorted order of their names, as by run(), and the peak tables, time traces and intensity matrix
+    are passed on as arrays.
+    If sink is given, every stage additionally saves its results into the sink directory, in the layout written by run().
+    Unlike run(), nothing is resumed or skipped, and all decoded scans are held in memory, so that large data sets
+    are better processed by run().
+
+    Usage:
+        pipeline = Pipeline()
+        matrix = pipeline.run(["sample1_pos.mzML", "sample1_neg.mzML"])
+        matrix["intensity"]     # features x samples
+
+    Properties:
+    -----------
+    mz_axis: np.ndarray
+        Resampled (linear or ppm) m/z axis, settings.MZ_AXIS by default.
+    sink: Path
+        Directory into which the results of every stage are saved. None (default) keeps them in memory only.
+    csv: bool
+        If True, the results saved into sink are additionally exported to .csv files.
+    scans: dict
+        MS1 scans of every file (see scan_store.MemoryScans), keyed by file name.
+    averaged: dict
+        Averaged spectrum of every polarity of every file, keyed by <sample>_<polarity> (see polarity.output_name()).
+    accumulators: dict
+        CompositeAccumulator of every polarity ("pos", "neg").
+    composites: dict
+        Composite spectrum of every polarity with at least one file.
+    peaks: dict
+        PeakTable of every polarity with a composite spectrum.
+    traces: dict
+        Time traces of every polarity of every file (see time_trace.trace() and trace_windowed()),
+        keyed by <sample>_<polarity>_trace (see trace_store.trace_name()).
+    matrix: dict
+        Intensity matrix, with the arrays features (m/z labels), samples (sample names) and intensity (features x samples)
+        as in intensity_matrix.npz.
+    '''
+
+    def __init__(self, mz_axis: np.ndarray = None, sink: str = None, csv: bool = False):
+        self.mz_axis = settings.MZ_AXIS if mz_axis is None else np.asarray(mz_axis, dtype=np.float64)
+        self.sink = None if sink is None else Path(sink)
+        self.csv = csv
+        self.scans = {}
+        self.averaged = {}
+        self._stats = {}
+        self.accumulators = {polarity: CompositeAccumulator(len(self.mz_axis)) for polarity in POLARITIES}
+        self.composites = {}
+        self.peaks = {}
+        self.traces = {}
+        self.matrix = None
+
+    def _sink(self, directory: str = "") -> Path:
+        # Directory of the sink in which a stage saves its results
+        path = self.sink / directory
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def average(self, files: list) -> dict:
+        '''
+        Decodes the MS1 scans of every mzML file, keeps them for the time traces, and averages the scans of every polarity
+        over the m/z axis (see average.average_scans()). The averaged spectra are reduced into the composite accumulators by composite().
+
+        Parameters
+        ----------
+        files: list
+            Paths to the mzML files.
+
+        Returns
+        -------
+        averaged: dict
+            Averaged spectrum of every polarity of every file, see Pipeline.averaged.
+        '''
+        for file in map(Path, files):
+            print(f"Averaging spectra for: {file.name}...")
+            with open_reader(file) as reader:
+                scans = MemoryScans(len(reader))
+                averaged = average_scans(scans.record(decode_scans(reader, polarity=file_polarity(file))), self.mz_axis, len(reader))
+            self.scans[file.name] = scans
+            stat = file.stat()
+            for polarity, avg_intensity in averaged.items():
+                name = output_name(file, polarity)
+                self.averaged[name] = avg_intensity
+                self._stats[name] = [stat.st_size, stat.st_mtime_ns]
+                if self.sink is not None:
+                    save_axis(self._sink("average"), self.mz_axis)
+                    save_spectrum(self._sink("average") / "avg_{}.npy".format(name), avg_intensity, dtype=settings.INTENSITY_DTYPE)
+                    if self.csv:
+                        export_csv(self._sink("average") / "avg_{}.csv".format(name), self.mz_axis, avg_intensity)
+        return self.averaged
+
+    def composite(self) -> dict:
+        '''
+        Reduces the averaged spectra into the composite accumulators in the sorted order of their names, so that the composite
+        spectra do not depend on the order of the files (see composite_spectrum.CompositeAccumulator), and returns the composite
+        spectrum of every polarity with at least one averaged file, read off its accumulator.
+        '''
+        self.accumulators = {polarity: CompositeAccumulator(len(self.mz_axis)) for polarity in POLARITIES}
+        for name in sorted(self.averaged):
+            intensities = np.asarray(self.averaged[name], dtype=settings.INTENSITY_DTYPE)
+            self.accumulators[split_name(name)[1]].add(intensities, name, self._stats[name])
+        for polarity, accumulator in self.accumulators.items():
+            if accumulator.count == 0:
+                continue
+            self.composites[polarity] = accumulator.mean()
+            if self.sink is not None:
+                save_spectrum(self._sink() / "composite_spectrum_{}.npy".format(polarity), self.composites[polarity], dtype=settings.INTENSITY_DTYPE)
+                if self.csv:
+                    export_csv(self._sink() / "composite_spectrum_{}.csv".format(polarity), self.mz_axis, self.composites[polarity])
+        return self.composites
+
+    def pick_peaks(self) -> dict:
+        '''Picks the peaks on the composite spectrum of every polarity, see peak_pick.peak_pick(). Returns the PeakTable of every polarity.'''
+        for polarity, composite in self.composites.items():
+            self.peaks[polarity] = peak_pick(composite, self.mz_axis)
+            if self.sink is not None:
+                save_peaks(self._sink("time_traces"), polarity, self.peaks[polarity])
+                save_features(self._sink("time_traces"), polarity, self.peaks[polarity].mz)
+        return self.peaks
+
+    def trace(self) -> dict:
+        '''
+        Computes the time traces of the scans of every polarity of every file with the peak table of the polarity, replaying them from memory,
+        only within the elution windows of the features with settings.TRACE_MODE "windowed" (see time_trace.trace_windowed()).
+        '''
+        trace = trace_windowed if settings.TRACE_MODE == "windowed" else trace_scans
+        for file, scans in self.scans.items():
+            print(f"Finding time traces for: {file}...")
+            for polarity in scan_polarities(scans):
+                if polarity not in self.peaks:
+                    continue
+                name = trace_name(file, polarity)
+                self.traces[name] = trace(select_polarity(scans, polarity), self.peaks[polarity], self.mz_axis)
+                if self.sink is not None:
+                    trace_dir = self._sink("time_traces") / name
+                    shutil.rmtree(trace_dir, ignore_errors=True)
+                    save_trace(trace_dir, **self.traces[name])
+                    if self.csv:
+                        export_trace_csv(trace_dir.with_suffix(".csv"), self.traces[name])
+        return self.traces
+
+    def build_matrix(self) -> dict:
+        '''Fills the intensity matrix of all samples and features from the time traces, see intensity_matrix.fill_matrix().'''
+        # Samples are named after their time traces, as in run()
+        names = sorted(self.traces)
+        table_mz = {polarity: np.unique(self.peaks[polarity].mz) if polarity in self.peaks else np.empty(0) for polarity in POLARITIES}
+        features, samples, matrix, columns = fill_matrix(names, (self.traces[name] for name in names), table_mz)
+        self.matrix = {"features": features, "samples": samples, "intensity": np.nan_to_num(matrix[:, columns].T, nan=1)}
+        if self.sink is not None:
+            save_matrix(self._sink(), features, samples, matrix, columns, self.csv)
+        return self.matrix
+
+    def run(self, files: list) -> dict:
+        '''
+        Runs all stages on the given mzML files: average -> composite -> peaks -> trace -> matrix.
+
+        Parameters
+        ----------
+        files: list
+            Paths to the mzML files.
+
+        Returns
+        -------
+        matrix: dict
+            Intensity matrix, see Pipeline.matrix.
+        '''
+        self.average(files)
+        self.composite()
+        self.pick_peaks()
+        self.trace()
+        return self.build_matrix()
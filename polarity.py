@@ -0,0 +1,72 @@
+'''
+Ion polarity of the scans, and the names of the outputs of every polarity of an mzML file.
+
+Every MS1 scan is routed by its own polarity, given by the cvParams "positive scan" (MS:1000130) or "negative scan"
+(MS:1000129) of the mzML spectrum, so that a file acquired with polarity switching yields averaged spectra and time traces
+in both polarities. Only scans without these cvParams fall back to the polarity in the file name, its "_pos" or "_neg" token.
+
+The outputs of one polarity of a file are named <sample>_<polarity>, where the sample name is the file name without its
+extension and without a "_pos" or "_neg" token, e.g. sample1_pos.mzML -> sample1_pos, switching file sample1.mzML -> sample1_pos
+and sample1_neg. The intensity matrix has one row per sample, holding the features of both polarities.
+'''
+import re
+from pathlib import Path
+
+# Polarities, in the order of their composite spectra and of their features in the intensity matrix
+POLARITIES = ("pos", "neg")
+# Names of the polarity cvParams of an mzML spectrum, as parsed by pyteomics
+CV_TERMS = {"positive scan": "pos", "negative scan": "neg"}
+
+# "_pos" or "_neg" token of a file name, followed by another token or the end of the name, e.g. sample1_pos or QC_neg_2
+_TOKEN = re.compile(r"_(pos|neg)(?=_|$)")
+_NAME = re.compile(r"^(.*)_(pos|neg)(?:_trace)?$")
+
+def spectrum_polarity(spectrum: dict, default: str = None) -> str:
+    '''
+    Returns the polarity of an mzML spectrum.
+
+    Parameters
+    ----------
+    spectrum: dict
+        Spectrum as parsed by pyteomics.
+
+    default: str
+        Polarity of a spectrum without polarity cvParam, e.g. from the file name (see file_polarity()).
+
+    Returns
+    -------
+    polarity: str
+        "pos", "neg", or default.
+    '''
+    for term, polarity in CV_TERMS.items():
+        if term in spectrum:
+            return polarity
+    return default
+
+def file_polarity(file: str) -> str:
+    '''
+    Returns the polarity in the name of an mzML file, "pos" or "neg", from the same token that sample_name() removes,
+    or None if it holds neither.
+    '''
+    match = _TOKEN.search(Path(file).stem)
+    return match.group(1) if match else None
+
+def sample_name(file: str) -> str:
+    '''Returns the sample name of an mzML file: its name without extension and without a "_pos" or "_neg" token.'''
+    return _TOKEN.sub("", Path(file).stem, count=1)
+
+def output_name(file: str, polarity: str) -> str:
+    '''Returns the name of the outputs of one polarity of an mzML file, <sample>_<polarity>.'''
+    return "{}_{}".format(sample_name(file), polarity)
+
+def split_name(name: str) -> tuple:
+    '''
+    Splits the name of an output, e.g. sample1_pos or the time traces sample1_pos_trace, into sample name and polarity.
+
+    Returns
+    -------
+    sample, polarity: tuple
+        Sample name and polarity, or name and None if it does not end with a polarity.
+    '''
+    match = _NAME.match(name)
+    return (match.group(1), match.group(2)) if match else (name, None)
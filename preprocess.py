@@ -27,23 +27,32 @@ Python Code of Cedric Wüthrich
 https://pyteomics.readthedocs.io/en/latest/index.html
 '''
 
-import os, time
+import os, time, argparse
 from pathlib import Path
-import numpy as np
-import csv
-from average import average
-from peak_pick import peak_pick
-from time_trace import time_trace
-from composite_spectrum import composite_spectrum
-from settings import MZ_AXIS
-from intensity_matrix import intensity_matrix
-
-# Log script execution time
-st = time.time()
+import settings
+import instrumentation
+from pipeline import run, STAGES
 
 # Defined when executing the script from a batch module or the console
-PATH = Path(os.sys.argv[1])   
-print(f"Found path ${PATH}...")
+parser = argparse.ArgumentParser(description="Preprocessing of untargeted metabolomics data in the mzML file format.")
+parser.add_argument("path", type=Path, help="path to the directory containing the .mzml files to be processed")
+parser.add_argument("--csv", action="store_true", help="additionally export spectra, time traces and the intensity matrix to .csv files")
+parser.add_argument("--workers", type=int, default=1, metavar="N", help="number of worker processes across which the mzML files are distributed (default: 1)")
+parser.add_argument("--config", type=Path, help="TOML file overriding the defaults in settings.py, see settings.load_config()")
+parser.add_argument("--mz-min", type=float, help=f"lower end of the m/z axis (default: {settings.MZ_MIN})")
+parser.add_argument("--mz-max", type=float, help=f"upper end of the m/z axis (default: {settings.MZ_MAX})")
+parser.add_argument("--res", type=float, help=f"spacing of the linear m/z axis (default: {settings.RES})")
+parser.add_argument("--axis", choices=["linear", "ppm"], help=f"linear or ppm-constant spacing of the m/z axis (default: {settings.AXIS_MODE})")
+parser.add_argument("--ppm", type=float, help=f"relative bin width of the ppm m/z axis, in ppm (default: {settings.PPM})")
+parser.add_argument("--min-intensity", type=float, help=f"minimum mean intensity of a feature in the intensity matrix (default: {settings.MIN_INTENSITY})")
+parser.add_argument("--min-tic-correlation", type=float, help=f"minimum Pearson's correlation of a feature with the TIC (default: {settings.MIN_TIC_CORRELATION})")
+parser.add_argument("--decode-threads", type=int, metavar="N", help=f"number of threads decoding the scans of a file while it is averaged (default: {settings.DECODE_THREADS})")
+parser.add_argument("--profile", action="store_true", help=f"profile every stage with cProfile into {instrumentation.PROFILE_DIR}/<stage>.prof")
+parser.add_argument("--from-stage", choices=STAGES, help="rerun this stage, reprocessing all files, and all later ones, without running the earlier ones")
+parser.add_argument("--only-stage", choices=STAGES, help="rerun only this stage, reprocessing all files, e.g. peaks or matrix after tuning their thresholds")
+parser.add_argument("--trace-mode", choices=["full", "windowed"], help=f"integrate the features over all scans, or only within their elution windows (default: {settings.TRACE_MODE})")
+parser.add_argument("--backend", choices=["numpy", "numba"], help=f"implementation of the interpolation and integration kernels; numba requires Numba (default: {settings.BACKEND})")
+parser.add_argument("--dtype", choices=["float32", "float64"], help="storage data type of intensities; float32 halves memory and disk use (default: float64)")
 
 def clear():
     '''
@@ -62,16 +71,32 @@ def clear():
     else:
         os.system('cls')
 
-def main(path):
+def main(path, csv=False, workers=1, profile=False, from_stage=None, only_stage=None):
     """
     Main function to process mzML files, generate composite spectra, calculate time traces, 
-    and construct an intensity matrix. It ensures the necessary directory structure is in place, 
-    performs file cleanup, and invokes various processing steps.
+    and construct an intensity matrix. The processing steps are run by pipeline.run(), which resumes
+    interrupted runs and skips the files and stages that were already completed.
 
     Parameters
     ----------
     path: Path
         Path to the directory containing mzML files to be processed.
+    
+    csv: bool
+        If True, the averaged and composite spectra, time traces and intensity matrix are additionally exported to .csv files.
+    
+    workers: int
+        Number of worker processes used for averaging and time tracing.
+
+    profile: bool
+        If True, every stage (and every file processed in a worker process) is profiled with cProfile
+        into the profile directory on path.
+
+    from_stage: str
+        Stage from which on all stages are rerun, see pipeline.STAGES. The earlier stages are not run.
+
+    only_stage: str
+        Single stage to be rerun, see pipeline.STAGES.
 
     Returns
     -------
@@ -86,36 +111,29 @@ def main(path):
     Disclaimer: This workload is computationally intensive and not designed for consumer hardware.
     The pipeline should be run on a high-performance computing cluster.\n""")
 
-    # Prepare the directory structure
-    if "average" in os.listdir(path.absolute()):
-        pass
-    else:
-        os.mkdir(path.absolute() / "average")
-    if "time_traces" in os.listdir(path.absolute()):
-        pass
-    else:
-        os.mkdir(path.absolute() / "time_traces")
+    run(path, csv=csv, workers=workers, profile=profile, from_stage=from_stage, only_stage=only_stage)
 
-    average(path / "average", MZ_AXIS)
+# Instantiate the script, guarded so that worker processes can safely import this module
+if __name__ == "__main__":
+    # Log script execution time
+    st = time.time()
 
-    # Average the averaged spectra to create a composite spectrum of all mzML files on the file path
-    if "composite_spectrum" in os.listdir(path.parent.absolute()):
-        pass
-    else:
-        composite_spectrum(path, MZ_AXIS)
-    
-    # Construct the respective time traces 
-    time_trace(path / "time_traces", MZ_AXIS)
+    ARGS = parser.parse_args()
+    PATH = ARGS.path
+    print(f"Found path ${PATH}...")
 
-    # Write the intensity matrix of all samples and all peaks
-    intensity_matrix(path)
+    # Settings are taken from settings.py, overridden by the configuration file, overridden by the command line
+    if ARGS.config:
+        settings.configure(**settings.load_config(ARGS.config))
+    settings.configure(mz_min=ARGS.mz_min, mz_max=ARGS.mz_max, res=ARGS.res, dtype=ARGS.dtype, axis=ARGS.axis, ppm=ARGS.ppm,
+                       min_intensity=ARGS.min_intensity, min_tic_correlation=ARGS.min_tic_correlation,
+                       decode_threads=ARGS.decode_threads, trace_mode=ARGS.trace_mode, backend=ARGS.backend)
 
-# Instantiate the script 
-main(PATH)
+    main(PATH, csv=ARGS.csv, workers=ARGS.workers, profile=ARGS.profile, from_stage=ARGS.from_stage, only_stage=ARGS.only_stage)
 
-# Print execution time 
-et = time.time()
-elapsed_time = et - st
-print("Execution time: ", round(elapsed_time, 2), " seconds.")
+    # Print execution time 
+    et = time.time()
+    elapsed_time = et - st
+    print("Execution time: ", round(elapsed_time, 2), " seconds.")
 
 
@@ -0,0 +1,343 @@
+from pyteomics import mzml
+import os, json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pathlib import Path
+import settings
+from polarity import POLARITIES, spectrum_polarity, file_polarity
+
+# Name of the directory, next to the mzML files, holding the decoded scans of every file
+SCAN_STORE_DIR = "scans"
+# Layout version of the scan stores; stores written with an older layout (e.g. without retention times or polarities) are rebuilt
+STORE_VERSION = 3
+
+class ScanStore():
+    '''Read-only, memory-mapped replay of the MS1 scans decoded from one mzML file by cache_scans(). \n
+
+    Properties:
+    -----------
+    path: Path
+        Directory of the scan store.
+    n_spectra: int
+        Number of all spectra (of any MS level) in the source mzML file.
+    index: np.ndarray
+        Spectrum index of every cached MS1 scan in the source mzML file.
+    tic: np.ndarray
+        Total ion current of every cached MS1 scan.
+    rt: np.ndarray
+        Retention time (scan start time) of every cached MS1 scan, in minutes.
+    polarity: np.ndarray
+        Polarity of every cached MS1 scan, "pos", "neg", or "" if unknown.
+    '''
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        with open(self.path / "meta.json") as meta_json:
+            meta = json.load(meta_json)
+        self.n_spectra = meta["n_spectra"]
+        self.index = np.load(self.path / "index.npy")
+        self.tic = np.load(self.path / "tic.npy")
+        self.rt = np.load(self.path / "rt.npy")
+        self.polarity = np.load(self.path / "polarity.npy")
+        self._offsets = np.load(self.path / "offsets.npy")
+        self._mz = np.memmap(self.path / "mz.bin", dtype=meta["mz_dtype"], mode='r') if self._offsets[-1] else np.empty(0)
+        self._intensity = np.memmap(self.path / "intensity.bin", dtype=meta["intensity_dtype"], mode='r') if self._offsets[-1] else np.empty(0)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> tuple:
+        start, stop = self._offsets[i], self._offsets[i+1]
+        return self._mz[start:stop], self._intensity[start:stop]
+
+    def __iter__(self):
+        '''Yields (index, tic, rt, polarity, m/z array, intensity array) of every cached MS1 scan, as zero-copy views.'''
+        for i in range(len(self)):
+            mz_array, intensity_array = self[i]
+            yield int(self.index[i]), float(self.tic[i]), float(self.rt[i]), str(self.polarity[i]) or None, mz_array, intensity_array
+
+class MemoryScans():
+    '''In-memory counterpart of ScanStore, holding the MS1 scans of one mzML file as they are decoded,
+    e.g. by pipeline.Pipeline, so that they can be replayed without writing a scan store. \n
+
+    Properties:
+    -----------
+    n_spectra: int
+        Number of all spectra (of any MS level) in the source mzML file.
+    index: list
+        Spectrum index of every MS1 scan in the source mzML file.
+    tic: list
+        Total ion current of every MS1 scan.
+    rt: list
+        Retention time (scan start time) of every MS1 scan, in minutes.
+    polarity: list
+        Polarity of every MS1 scan, "pos", "neg", or None if unknown.
+    '''
+
+    def __init__(self, n_spectra: int = 0):
+        self.n_spectra = n_spectra
+        self.index = []
+        self.tic = []
+        self.rt = []
+        self.polarity = []
+        self._mz = []
+        self._intensity = []
+
+    def append(self, index: int, tic: float, rt: float, polarity: str, mz_array: np.ndarray, intensity_array: np.ndarray):
+        '''Adds one scan; the intensities are kept with the data type settings.INTENSITY_DTYPE, as in the scan store.'''
+        self.index.append(index)
+        self.tic.append(tic)
+        self.rt.append(rt)
+        self.polarity.append(polarity)
+        self._mz.append(mz_array)
+        self._intensity.append(intensity_array.astype(settings.INTENSITY_DTYPE, copy=False))
+
+    def record(self, scans):
+        '''Passes on the scans yielded by scans, e.g. by decode_scans(), appending every one of them.'''
+        for scan in scans:
+            self.append(*scan)
+            yield scan
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> tuple:
+        return self._mz[i], self._intensity[i]
+
+    def __iter__(self):
+        '''Yields (index, tic, rt, polarity, m/z array, intensity array) of every MS1 scan.'''
+        yield from zip(self.index, self.tic, self.rt, self.polarity, self._mz, self._intensity)
+
+class PolarityScans():
+    '''View of the MS1 scans of one polarity of a ScanStore or MemoryScans, with the same interface,
+    e.g. to trace one polarity of a file acquired with polarity switching. \n
+
+    Properties:
+    -----------
+    n_spectra: int
+        Number of all spectra (of any MS level) in the source mzML file.
+    index, tic, rt, polarity: np.ndarray
+        Spectrum index, total ion current, retention time and polarity of every MS1 scan of the polarity.
+    '''
+
+    def __init__(self, scans, polarity: str):
+        self._scans = scans
+        self._positions = np.flatnonzero(np.asarray(scans.polarity, dtype=object) == polarity)
+        self.n_spectra = scans.n_spectra
+        self.index = np.asarray(scans.index, dtype=np.int64)[self._positions]
+        self.tic = np.asarray(scans.tic, dtype=np.float64)[self._positions]
+        self.rt = np.asarray(scans.rt, dtype=np.float64)[self._positions]
+        self.polarity = np.full(len(self._positions), polarity)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, i: int) -> tuple:
+        return self._scans[self._positions[i]]
+
+    def __iter__(self):
+        '''Yields (index, tic, rt, polarity, m/z array, intensity array) of every MS1 scan of the polarity.'''
+        for i in range(len(self)):
+            yield (int(self.index[i]), float(self.tic[i]), float(self.rt[i]), str(self.polarity[i])) + tuple(self[i])
+
+def select_polarity(scans, polarity: str):
+    '''
+    Returns the MS1 scans of one polarity of a ScanStore or MemoryScans, see PolarityScans.
+
+    Parameters
+    ----------
+    scans: ScanStore
+        MS1 scans of one file, of any polarities.
+
+    polarity: str
+        "pos" or "neg".
+
+    Returns
+    -------
+    scans: ScanStore
+        scans itself if all of its scans have this polarity, otherwise a PolarityScans view of the scans of this polarity.
+    '''
+    if all(scan_polarity == polarity for scan_polarity in scans.polarity):
+        return scans
+    return PolarityScans(scans, polarity)
+
+def scan_polarities(scans) -> list:
+    '''Returns the polarities of the MS1 scans of a ScanStore or MemoryScans, in the order of polarity.POLARITIES.'''
+    present = set(str(polarity) for polarity in scans.polarity)
+    return [polarity for polarity in POLARITIES if polarity in present]
+
+def store_path(file: str) -> Path:
+    '''
+    Returns the directory of the scan store belonging to the given mzML file.
+
+    Parameters
+    ----------
+    file: str
+        Path to the source mzML file.
+
+    Returns
+    -------
+    path: Path
+        <directory of the mzML file>/scans/<mzML file name without extension>
+    '''
+    file = Path(file)
+    return file.parent.absolute() / SCAN_STORE_DIR / file.stem
+
+def _source_stat(file: Path) -> dict:
+    stat = os.stat(file)
+    return {"source": file.name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def is_cached(file: str) -> bool:
+    '''
+    Checks whether a complete scan store exists for the given mzML file and whether it is up to date
+    with the file's size and modification time, and with the intensity data type in settings.py.
+
+    Parameters
+    ----------
+    file: str
+        Path to the source mzML file.
+
+    Returns
+    -------
+    True if the scan store can be replayed instead of parsing the mzML file. Otherwise returns False.
+    '''
+    file = Path(file)
+    try:
+        with open(store_path(file) / "meta.json") as meta_json:
+            meta = json.load(meta_json)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    if meta.get("version") != STORE_VERSION or meta.get("intensity_dtype") != np.dtype(settings.INTENSITY_DTYPE).name:
+        return False
+    return all(meta.get(key) == value for key, value in _source_stat(file).items())
+
+def open_reader(file: str) -> mzml.MzML:
+    '''
+    Returns an MzML reader of the given file which leaves the binary arrays encoded, so that they can be decoded
+    by decode_scans(), in parallel and only for the MS1 scans.
+    '''
+    return mzml.MzML(str(file), decode_binary=False)
+
+def _retention_time(spectrum: dict) -> float:
+    # Scan start time of the spectrum in minutes, NaN if it is not given
+    scans = spectrum.get('scanList', {}).get('scan', [])
+    rt = scans[0].get('scan start time') if scans else None
+    if rt is None:
+        return np.nan
+    return float(rt) / 60 if getattr(rt, 'unit_info', None) == 'second' else float(rt)
+
+def _decode(spectrum: dict, polarity: str = None) -> tuple:
+    # Arrays left encoded by the reader are decoded here (base64, decompression), arrays decoded by the reader are kept
+    arrays = [spectrum[key].decode() if hasattr(spectrum[key], "decode") else spectrum[key] for key in ("m/z array", "intensity array")]
+    return (spectrum['index'], spectrum['total ion current'], _retention_time(spectrum), spectrum_polarity(spectrum, polarity),
+            np.asarray(arrays[0], dtype=np.float64), np.asarray(arrays[1], dtype=np.float64))
+
+def decode_scans(reader: mzml.MzML, threads: int = None, prefetch: int = None, polarity: str = None):
+    '''
+    Iterates over the MS1 scans of an mzML reader and decodes their binary arrays. With several threads, the next
+    scans are decoded on a thread pool (zlib and NumPy release the GIL) while the current scan is being processed
+    by the caller. At most prefetch scans are decoded ahead, which bounds the memory held by the queue.
+
+    Parameters
+    ----------
+    reader: mzml.MzML
+        MzML reader, preferably with decode_binary=False (see open_reader()).
+
+    threads: int
+        Number of decoding threads, by default settings.DECODE_THREADS. 1 decodes serially.
+
+    prefetch: int
+        Maximum number of scans decoded ahead, by default settings.PREFETCH_SCANS.
+
+    polarity: str
+        Polarity of the scans without polarity cvParam, e.g. from the file name (see polarity.file_polarity()).
+
+    Yields
+    ------
+    scan: tuple
+        (index, tic, rt, polarity, m/z array, intensity array) of every MS1 scan, in the order of the file; rt in minutes,
+        polarity "pos", "neg" or None (see polarity.spectrum_polarity()).
+    '''
+    threads = settings.DECODE_THREADS if threads is None else threads
+    prefetch = settings.PREFETCH_SCANS if prefetch is None else prefetch
+    ms1 = (spectrum for spectrum in reader if spectrum['ms level'] == 1)
+    if threads <= 1:
+        yield from (_decode(spectrum, polarity) for spectrum in ms1)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for spectrum in ms1:
+            pending.append(executor.submit(_decode, spectrum, polarity))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def cache_scans(file: str, reader: mzml.MzML = None):
+    '''
+    Parses the mzML file once, decoding every MS1 scan exactly one time (see decode_scans()), and streams the MS1 scans
+    to the caller while writing them into the on-disk scan store. Scans without polarity cvParam take the polarity
+    in the file name, if any. The intensities are stored with the data type
+    settings.INTENSITY_DTYPE, but yielded as decoded. The store's meta.json is written last,
+    so an interrupted run never leaves behind a store that is_cached() would accept.
+
+    Parameters
+    ----------
+    file: str
+        Path to the source mzML file.
+
+    reader: mzml.MzML
+        Optional, already instantiated MzML reader object of the file.
+
+    Yields
+    ------
+    scan: tuple
+        (index, tic, rt, polarity, m/z array, intensity array) of every MS1 scan.
+    '''
+    file = Path(file)
+    path = store_path(file)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "meta.json").unlink(missing_ok=True)   # Invalidate a previous store until this one is complete
+    reader = open_reader(file) if reader is None else reader
+
+    index, tic, rt, polarity, offsets = [], [], [], [], [0]
+    with open(path / "mz.bin", "wb") as mz_bin, open(path / "intensity.bin", "wb") as intensity_bin:
+        for scan_index, scan_tic, scan_rt, scan_polarity, mz_array, intensity_array in decode_scans(reader, polarity=file_polarity(file)):
+            mz_array.tofile(mz_bin)
+            intensity_array.astype(settings.INTENSITY_DTYPE, copy=False).tofile(intensity_bin)
+            index.append(scan_index)
+            tic.append(scan_tic)
+            rt.append(scan_rt)
+            polarity.append(scan_polarity or "")
+            offsets.append(offsets[-1] + len(mz_array))
+            yield scan_index, scan_tic, scan_rt, scan_polarity, mz_array, intensity_array
+
+    np.save(path / "index.npy", np.array(index, dtype=np.int64))
+    np.save(path / "tic.npy", np.array(tic, dtype=np.float64))
+    np.save(path / "rt.npy", np.array(rt, dtype=np.float64))
+    np.save(path / "polarity.npy", np.array(polarity, dtype="<U3"))
+    np.save(path / "offsets.npy", np.array(offsets, dtype=np.int64))
+    meta = {"version": STORE_VERSION, "n_spectra": len(reader), "mz_dtype": "float64", "intensity_dtype": np.dtype(settings.INTENSITY_DTYPE).name, **_source_stat(file)}
+    with open(path / "meta.json", "w") as meta_json:
+        json.dump(meta, meta_json)
+
+def open_scans(file: str) -> ScanStore:
+    '''
+    Returns the scan store of the given mzML file, parsing the file and building the store first
+    if it does not exist yet or is out of date.
+
+    Parameters
+    ----------
+    file: str
+        Path to the source mzML file.
+
+    Returns
+    -------
+    store: ScanStore
+        Memory-mapped MS1 scans of the file.
+    '''
+    if not is_cached(file):
+        for _ in cache_scans(file):
+            pass
+    return ScanStore(store_path(file))
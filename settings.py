@@ -1,13 +1,231 @@
 import numpy as np
+import tomllib
 
-# Define the hard-coded m/z axis, used throughout the whole script
+# Define the default m/z axis, used throughout the whole script
 MZ_MIN = 50
 MZ_MAX = 500 
 RES = 0.0001
 DATA_POINTS = int((MZ_MAX - MZ_MIN)/RES)
+# The m/z axis itself, settings.MZ_AXIS, is only built on first access (see __getattr__()), so that importing
+# the settings, e.g. to embed the pipeline (see pipeline.Pipeline), does not allocate it
 
-global MZ_AXIS
+# Spacing of the m/z axis: "linear" bins of RES Th, or "ppm" bins of constant relative width PPM (in ppm),
+# which follow the constant-ppm resolution of the instrument instead of oversampling low m/z
+AXIS_MODE = "linear"
+PPM = 1.0
 
-MZ_AXIS = np.linspace(MZ_MIN, MZ_MAX, DATA_POINTS, dtype=np.float64)
+# Storage data type of the intensity vectors (scan store, averaged and composite spectra). 
+# Intensities are always accumulated in float64 and only rounded to INTENSITY_DTYPE when stored,
+# so float32 halves the memory and disk footprint without accumulating rounding errors over scans.
+INTENSITY_DTYPE = np.float64
 
+# Peak picking thresholds on the composite spectra, see peak_pick.py. On a "ppm" axis, the minimum
+# distance between peaks and the (optional) minimum peak width are given in ppm instead of axis points
+PEAK_HEIGHT = 1000
+PEAK_DISTANCE = 50
+PEAK_REL_HEIGHT = 0.9
+PEAK_DISTANCE_PPM = 10
+PEAK_WIDTH_PPM = None
+# Number of m/z chunks the composite spectra are split into for peak picking, picked in parallel
+PEAK_SEGMENTS = 16
+
+# Feature filtering thresholds of the intensity matrix, see intensity_matrix.py: minimum mean intensity 
+# of a feature's time trace, and minimum Pearson's correlation coefficient with the total ion current
+MIN_INTENSITY = 1000
+MIN_TIC_CORRELATION = 0.5
+
+# Number of scans traced per batch, see time_trace.py: only the integrated intensities of one batch of scans
+# are held in memory before they are written to disk, whatever the length of the acquisition
+SCAN_BATCH = 256
+
+# Number of threads decoding (base64, zlib) the binary arrays of the scans while they are being averaged,
+# see scan_store.py, and maximum number of scans decoded ahead of the one being averaged. 
+# 1 decodes serially; with several worker processes, DECODE_THREADS x workers should not exceed the number of cores
+DECODE_THREADS = 1
+PREFETCH_SCANS = 16
+
+# Extraction of the time traces, see time_trace.py: "full" integrates every feature over every scan, "windowed" only within
+# the feature's elution window, detected per file from a first pass over every RT_STRIDE-th scan as the scans around its apex
+# exceeding RT_THRESHOLD of its height above the baseline, widened by RT_MARGIN minutes of retention time on both sides.
+# Windowed time traces are stored sparsely, and averaged and correlated with the TIC only within the window
+TRACE_MODE = "full"
+RT_STRIDE = 8
+RT_THRESHOLD = 0.05
+RT_MARGIN = 0.1
+
+# Implementation of the interpolation and integration kernels, see kernels.py: "numpy", or "numba" for compiled kernels
+# fusing the interpolation with the accumulation and integration. Numba is optional; without it, the NumPy kernels are used
+BACKEND = "numpy"
+
+def configure(mz_min: float = None, mz_max: float = None, res: float = None, dtype: str = None,
+              axis: str = None, ppm: float = None, peak_height: float = None, peak_distance: int = None, 
+              peak_rel_height: float = None, peak_distance_ppm: float = None, peak_width_ppm: float = None, peak_segments: int = None,
+              min_intensity: float = None, min_tic_correlation: float = None, scan_batch: int = None,
+              decode_threads: int = None, prefetch_scans: int = None, trace_mode: str = None, rt_stride: int = None,
+              rt_threshold: float = None, rt_margin: float = None, backend: str = None):
+    '''
+    Overrides the default settings and rebuilds the m/z axis. Arguments left as None keep their current value.
+
+    Parameters
+    ----------
+    mz_min, mz_max: float
+        Range of the m/z axis.
+
+    res: float
+        Spacing of the linear m/z axis.
+
+    dtype: str
+        Storage data type of the intensity vectors, "float32" or "float64".
+
+    axis: str
+        Spacing of the m/z axis, "linear" or "ppm".
+
+    ppm: float
+        Relative bin width of the "ppm" m/z axis, in ppm.
+
+    peak_height, peak_distance, peak_rel_height, peak_distance_ppm, peak_width_ppm: float
+        Peak picking thresholds, see peak_pick.py.
+
+    peak_segments: int
+        Number of m/z chunks picked in parallel, see peak_pick.py.
+
+    min_intensity, min_tic_correlation: float
+        Feature filtering thresholds, see intensity_matrix.py.
+
+    scan_batch: int
+        Number of scans traced per batch, see time_trace.py.
+
+    decode_threads, prefetch_scans: int
+        Number of threads decoding the scans, and number of scans decoded ahead, see scan_store.py.
+
+    trace_mode: str
+        Extraction of the time traces, "full" or "windowed", see time_trace.py.
+
+    rt_stride, rt_threshold, rt_margin: float
+        Detection of the elution windows of the "windowed" time traces: stride of the first pass in scans,
+        fraction of the feature's height above the baseline, and margin in minutes.
+
+    backend: str
+        Implementation of the interpolation and integration kernels, "numpy" or "numba", see kernels.py.
+
+    Returns
+    -------
+    None
+    '''
+    global MZ_MIN, MZ_MAX, RES, DATA_POINTS, INTENSITY_DTYPE, AXIS_MODE, PPM
+    global PEAK_HEIGHT, PEAK_DISTANCE, PEAK_REL_HEIGHT, PEAK_DISTANCE_PPM, PEAK_WIDTH_PPM, MIN_INTENSITY, MIN_TIC_CORRELATION, SCAN_BATCH
+    global DECODE_THREADS, PREFETCH_SCANS, PEAK_SEGMENTS, TRACE_MODE, RT_STRIDE, RT_THRESHOLD, RT_MARGIN, BACKEND
+    
+    MZ_MIN = MZ_MIN if mz_min is None else mz_min
+    MZ_MAX = MZ_MAX if mz_max is None else mz_max
+    RES = RES if res is None else res
+    if dtype is not None:
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError(f"Unsupported intensity data type: {dtype}, use float32 or float64.")
+        INTENSITY_DTYPE = np.dtype(dtype).type
+    PEAK_HEIGHT = PEAK_HEIGHT if peak_height is None else peak_height
+    PEAK_DISTANCE = PEAK_DISTANCE if peak_distance is None else peak_distance
+    PEAK_REL_HEIGHT = PEAK_REL_HEIGHT if peak_rel_height is None else peak_rel_height
+    PEAK_DISTANCE_PPM = PEAK_DISTANCE_PPM if peak_distance_ppm is None else peak_distance_ppm
+    PEAK_WIDTH_PPM = PEAK_WIDTH_PPM if peak_width_ppm is None else peak_width_ppm
+    PEAK_SEGMENTS = PEAK_SEGMENTS if peak_segments is None else peak_segments
+    MIN_INTENSITY = MIN_INTENSITY if min_intensity is None else min_intensity
+    MIN_TIC_CORRELATION = MIN_TIC_CORRELATION if min_tic_correlation is None else min_tic_correlation
+    AXIS_MODE = AXIS_MODE if axis is None else axis
+    PPM = PPM if ppm is None else ppm
+    SCAN_BATCH = SCAN_BATCH if scan_batch is None else scan_batch
+    DECODE_THREADS = DECODE_THREADS if decode_threads is None else decode_threads
+    PREFETCH_SCANS = PREFETCH_SCANS if prefetch_scans is None else prefetch_scans
+    TRACE_MODE = TRACE_MODE if trace_mode is None else trace_mode
+    RT_STRIDE = RT_STRIDE if rt_stride is None else rt_stride
+    RT_THRESHOLD = RT_THRESHOLD if rt_threshold is None else rt_threshold
+    RT_MARGIN = RT_MARGIN if rt_margin is None else rt_margin
+    BACKEND = BACKEND if backend is None else backend
+
+    if PEAK_SEGMENTS < 1:
+        raise ValueError(f"Invalid number of peak picking segments: {PEAK_SEGMENTS}, must be at least 1.")
+    if SCAN_BATCH < 1:
+        raise ValueError(f"Invalid scan batch size: {SCAN_BATCH}, must be at least 1.")
+    if DECODE_THREADS < 1 or PREFETCH_SCANS < 1:
+        raise ValueError(f"Invalid decoding: {DECODE_THREADS} threads, {PREFETCH_SCANS} scans ahead, both must be at least 1.")
+    if TRACE_MODE not in ("full", "windowed"):
+        raise ValueError(f"Unsupported trace mode: {TRACE_MODE}, use full or windowed.")
+    if RT_STRIDE < 1 or not 0 <= RT_THRESHOLD < 1 or RT_MARGIN < 0:
+        raise ValueError(f"Invalid elution windows: stride {RT_STRIDE} (at least 1), threshold {RT_THRESHOLD} (0 to 1), margin {RT_MARGIN} (at least 0).")
+    if BACKEND not in ("numpy", "numba"):
+        raise ValueError(f"Unsupported backend: {BACKEND}, use numpy or numba.")
+    if MZ_MAX <= MZ_MIN or MZ_MIN <= 0 or RES <= 0 or PPM <= 0:
+        raise ValueError(f"Invalid m/z axis: {MZ_MIN}-{MZ_MAX} with resolution {RES} Th or {PPM} ppm.")
+    if AXIS_MODE == "linear":
+        DATA_POINTS = int((MZ_MAX - MZ_MIN)/RES)
+    elif AXIS_MODE == "ppm":
+        # Geometric spacing: every bin is PPM ppm wider than the previous one
+        DATA_POINTS = int(np.log(MZ_MAX/MZ_MIN) / np.log1p(PPM*1e-6))
+    else:
+        raise ValueError(f"Unsupported m/z axis mode: {AXIS_MODE}, use linear or ppm.")
+    # The m/z axis is rebuilt from the new settings on its next access
+    globals().pop("MZ_AXIS", None)
+
+def __getattr__(name: str):
+    # Builds settings.MZ_AXIS on its first access after import or configure(), and keeps it as a module global
+    if name != "MZ_AXIS":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    global MZ_AXIS
+    if AXIS_MODE == "ppm":
+        MZ_AXIS = np.geomspace(MZ_MIN, MZ_MAX, DATA_POINTS, dtype=np.float64)
+    else:
+        MZ_AXIS = np.linspace(MZ_MIN, MZ_MAX, DATA_POINTS, dtype=np.float64)
+    return MZ_AXIS
+
+def load_config(file: str) -> dict:
+    '''
+    Reads settings from a TOML configuration file, e.g.:
+
+        mz_min = 50
+        mz_max = 1000
+        res = 0.0002
+        dtype = "float32"
+        axis = "linear"   # or "ppm", with e.g. ppm = 1.0
+        min_intensity = 1000
+        min_tic_correlation = 0.5
+        scan_batch = 256
+        decode_threads = 4
+        trace_mode = "windowed"
+        rt_stride = 8
+        backend = "numba"
+
+        [peaks]
+        height = 1000
+        distance = 50
+        rel_height = 0.9
+        distance_ppm = 10
+        segments = 16
+
+    Parameters
+    ----------
+    file: str
+        Path to the .toml configuration file.
+
+    Returns
+    -------
+    config: dict
+        Keyword arguments for configure().
+    '''
+    with open(file, "rb") as config_toml:
+        config = tomllib.load(config_toml)
+    peaks = config.pop("peaks", {})
+    config.update({"peak_" + key: value for key, value in peaks.items()})
+    unknown = set(config) - set(snapshot())
+    if unknown:
+        raise ValueError(f"Unknown settings in {file}: {', '.join(sorted(unknown))}")
+    return config
+
+def snapshot() -> dict:
+    '''Returns the current settings as keyword arguments for configure(), e.g. to apply them in worker processes.'''
+    return {"mz_min": MZ_MIN, "mz_max": MZ_MAX, "res": RES, "dtype": np.dtype(INTENSITY_DTYPE).name,
+            "axis": AXIS_MODE, "ppm": PPM, "peak_height": PEAK_HEIGHT, "peak_distance": PEAK_DISTANCE, 
+            "peak_rel_height": PEAK_REL_HEIGHT, "peak_distance_ppm": PEAK_DISTANCE_PPM, "peak_width_ppm": PEAK_WIDTH_PPM,
+            "peak_segments": PEAK_SEGMENTS, "min_intensity": MIN_INTENSITY, "min_tic_correlation": MIN_TIC_CORRELATION, "scan_batch": SCAN_BATCH,
+            "decode_threads": DECODE_THREADS, "prefetch_scans": PREFETCH_SCANS, "trace_mode": TRACE_MODE, "rt_stride": RT_STRIDE,
+            "rt_threshold": RT_THRESHOLD, "rt_margin": RT_MARGIN, "backend": BACKEND}
 
@@ -0,0 +1,312 @@
+'''
+Sharded execution of the preprocessing pipeline on multiple nodes, e.g. as SLURM array jobs. The jobs only coordinate
+through the shared file system: the mzML files on path, sorted by name, are split into n shards (file k belongs to shard
+k mod n), and every step reads the outputs of the previous one from path.
+
+    $ python3 shard.py average path --shard i/n     # for every i in 0..n-1: average the shard's files, and reduce their
+                                                    # averaged spectra into partial sums in shards/average_<i>of<n>/
+    $ python3 shard.py reduce path --shards n       # merge the partial sums into the composite spectra, pick the peaks once
+    $ python3 shard.py trace path --shard i/n       # for every i in 0..n-1: trace the shard's files with the shared peak tables
+    $ python3 shard.py matrix path                  # check that all files are traced, write the intensity matrix
+
+    $ python3 shard.py local path --shards n        # run all the steps above on this machine, n processes at a time
+
+For example, with SLURM:
+
+    $ sbatch --array=0-99 --wrap "python3 shard.py average data --shard \\$SLURM_ARRAY_TASK_ID/100 --config config.toml"
+
+The partial sums, maxima and non-zero counts of the shards are merged by reduce() without reading the averaged spectra
+again. The streaming median cannot be merged, so the composite spectra of a sharded run have no median, and their sums
+only match those of preprocess.py up to the floating-point summation order.
+
+All jobs must use the same settings, i.e. the same --config file. The steps record their completion in the manifest
+like pipeline.py, so a later run of preprocess.py on the same path resumes from the sharded results.
+'''
+
+import argparse, os, subprocess, sys
+from pathlib import Path
+import settings
+import instrumentation
+from average import average_files, average_path, averaged_polarities
+from composite_spectrum import CompositeAccumulator, composite_spectrum, averaged_spectra, load_accumulators, save_accumulators
+from spectrum_store import load_spectrum
+from spectrum_store import save_axis
+from parallel import run_parallel
+from time_trace import pick_peaks, load_peaks, time_trace, is_traced
+from intensity_matrix import intensity_matrix
+from manifest import peaks_hash, mark_stage, clear_stages
+from polarity import POLARITIES
+from pipeline import stage_params
+
+# Directory, next to the mzML files, holding the partial results and run reports of the shards
+SHARD_DIR = "shards"
+
+def parse_shard(shard: str) -> tuple:
+    '''Parses a shard given as "i/n" into (i, n), with 0 <= i < n.'''
+    try:
+        i, n = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard: {shard}, use i/n, e.g. 0/4.")
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"Invalid shard: {shard}, i must be in 0..n-1.")
+    return i, n
+
+def shard_files(path: str, shard: int, n_shards: int) -> list:
+    '''Returns the paths to the mzML files on path belonging to the given shard.'''
+    filelist = sorted(file for file in os.listdir(path) if file.lower().endswith(".mzml"))
+    return [Path(path) / file for file in filelist[shard::n_shards]]
+
+def partial_path(path: str, shard: int, n_shards: int) -> Path:
+    '''Returns the directory holding the partial composite accumulators of the given averaging shard.'''
+    return Path(path) / SHARD_DIR / "average_{}of{}".format(shard, n_shards)
+
+def _prepare(path: Path, report: str):
+    for directory in ("average", "time_traces", "scans", "manifest", SHARD_DIR):
+        (path / directory).mkdir(exist_ok=True)
+    # Every job writes its own run report, see instrumentation.py
+    instrumentation.start_run(path / SHARD_DIR / "{}.ndjson".format(report), settings=settings.snapshot(), argv=sys.argv)
+
+def average_shard(path: str, shard: int, n_shards: int, csv: bool = False, workers: int = 1):
+    '''
+    Averages the mzML files of one shard (see average.average_files()), skipping the files already averaged with the
+    current settings, and reduces the averaged spectra of all the shard's files, in sorted order, into partial composite
+    accumulators without the median (see composite_spectrum.CompositeAccumulator), saved in partial_path() and merged
+    by reduce().
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    shard, n_shards: int
+        Index of the shard, and number of shards.
+
+    csv: bool
+        If True, additionally exports the averaged spectra to .csv files.
+
+    workers: int
+        Number of worker processes used for averaging the shard's files.
+
+    Returns
+    -------
+    None
+    '''
+    path = Path(path)
+    _prepare(path, "average_{}of{}".format(shard, n_shards))
+    partial = partial_path(path, shard, n_shards)
+    partial.mkdir(exist_ok=True)
+    (partial / "composite_state.json").unlink(missing_ok=True)   # Invalidate the previous partial sums until these are complete
+    save_axis(path / "average", settings.MZ_AXIS)
+
+    files = shard_files(path, shard, n_shards)
+    done = {file: averaged_polarities(path / "average", file, settings.MZ_AXIS) for file in files}
+    done = {file: polarities for file, polarities in done.items() if polarities is not None}
+    todo = [file for file in files if file not in done]
+    print(f"Shard {shard}/{n_shards}: averaging {len(todo)} files, {len(done)} already averaged...")
+
+    with instrumentation.span("average", profile=True):
+        if workers > 1 and len(todo) > 1:
+            results = run_parallel(average_files, [([file], path / "average", settings.MZ_AXIS, csv) for file in todo], workers, desc="Averaging spectra")
+        else:
+            results = [average_files(todo, path / "average", settings.MZ_AXIS, csv)]
+        averaged = {polarity: {} for polarity in POLARITIES}
+        for result in results:
+            for polarity, members in result.items():
+                averaged[polarity].update(members)
+        # The files averaged by an earlier run
+        for file, polarities in done.items():
+            for polarity in polarities:
+                avg_path = average_path(path / "average", file, polarity)
+                stat = os.stat(avg_path)
+                averaged[polarity][str(Path("average") / avg_path.name)] = [stat.st_size, stat.st_mtime_ns]
+        # The partial sums over the shard's averaged spectra, which were just written or are read once more
+        accumulators = {polarity: CompositeAccumulator(len(settings.MZ_AXIS), median=False) for polarity in POLARITIES}
+        for polarity, members in averaged.items():
+            for key in sorted(members):
+                accumulators[polarity].add(load_spectrum(path / key), key, members[key])
+                instrumentation.add(bytes_read=members[key][0])
+    save_accumulators(partial, accumulators, settings.MZ_AXIS)
+
+def reduce(path: str, n_shards: int, csv: bool = False):
+    '''
+    Checks that all averaging shards have completed, and merges their partial accumulators into the composite spectra
+    (see composite_spectrum.composite_spectrum()), then picks the peaks on them once and saves the peak tables shared
+    by all tracing shards (see time_trace.pick_peaks()). The composite spectra equal those of preprocess.py up to
+    the floating-point summation order, and have no median.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    n_shards: int
+        Number of averaging shards.
+
+    csv: bool
+        If True, additionally exports the composite spectra to .csv files.
+
+    Returns
+    -------
+    None
+    '''
+    path = Path(path)
+    _prepare(path, "reduce")
+    missing = [shard for shard in range(n_shards) if not (partial_path(path, shard, n_shards) / "composite_state.json").exists()]
+    if missing:
+        raise RuntimeError(f"Averaging shards {', '.join(map(str, missing))} of {n_shards} have not completed.")
+
+    # The markers of the reduced stages and all later ones are only written back once the peaks are picked
+    clear_stages(path, ["composite", "peaks", "trace", "matrix"])
+    with instrumentation.span("composite", profile=True):
+        # Merge the partial sums of the shards; those over a different m/z axis are loaded empty
+        accumulators = {polarity: CompositeAccumulator(len(settings.MZ_AXIS), median=False) for polarity in POLARITIES}
+        for shard in range(n_shards):
+            for polarity, accumulator in load_accumulators(partial_path(path, shard, n_shards), settings.MZ_AXIS).items():
+                if accumulator.count:
+                    accumulators[polarity].merge(accumulator)
+        listed = {key for accumulator in accumulators.values() for key in accumulator.members}
+        # The averaged spectra of every polarity of every file, as recorded when it was averaged
+        expected, absent = set(), set()
+        for file in shard_files(path, 0, 1):
+            polarities = averaged_polarities(path / "average", file, settings.MZ_AXIS)
+            if polarities is None:
+                absent.add(file.name)
+            else:
+                expected |= {str(Path("average") / average_path("", file, polarity)) for polarity in polarities}
+        absent |= expected - listed
+        if absent:
+            raise RuntimeError(f"Averaged spectra missing from the shards (different settings or shard count?): {', '.join(sorted(absent))}")
+        # composite_spectrum() then only adds averaged spectra on path that no shard reduced, e.g. of removed files
+        save_accumulators(path, accumulators, settings.MZ_AXIS)
+        composite_spectrum(path, settings.MZ_AXIS, csv=csv)
+    with instrumentation.span("peaks", profile=True):
+        peaks = pick_peaks(path / "time_traces", settings.MZ_AXIS)
+
+    mark_stage(path, "average", **stage_params("average", csv))
+    mark_stage(path, "composite", **stage_params("composite", csv), spectra=averaged_spectra(path))
+    mark_stage(path, "peaks", **stage_params("peaks", csv), hashes={polarity: peaks_hash(table) for polarity, table in peaks.items()})
+    clear_stages(path, ["trace", "matrix"])
+
+def trace_shard(path: str, shard: int, n_shards: int, csv: bool = False, workers: int = 1):
+    '''
+    Computes the time traces of the mzML files of one shard with the peak tables saved by reduce(),
+    skipping the files already traced with them.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    shard, n_shards: int
+        Index of the shard, and number of shards.
+
+    csv: bool
+        If True, additionally exports the time traces to .csv files.
+
+    workers: int
+        Number of worker processes used for tracing the shard's files.
+
+    Returns
+    -------
+    None
+    '''
+    path = Path(path)
+    _prepare(path, "trace_{}of{}".format(shard, n_shards))
+    peaks = load_peaks(path / "time_traces")
+    if peaks is None:
+        raise RuntimeError(f"No peak tables found in {path / 'time_traces'}, run the reduce step first.")
+    files = [file.name for file in shard_files(path, shard, n_shards)]
+    with instrumentation.span("trace", profile=True):
+        time_trace(path / "time_traces", settings.MZ_AXIS, csv=csv, workers=workers, peaks=peaks, files=files)
+
+def matrix(path: str, csv: bool = False):
+    '''
+    Checks that the time traces of all mzML files are complete and current with the shared peak tables,
+    and writes the intensity matrix (see intensity_matrix.py).
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    csv: bool
+        If True, additionally writes the intensity matrix into intensity_matrix.csv.
+
+    Returns
+    -------
+    None
+    '''
+    path = Path(path)
+    _prepare(path, "matrix")
+    peaks = load_peaks(path / "time_traces")
+    if peaks is None:
+        raise RuntimeError(f"No peak tables found in {path / 'time_traces'}, run the reduce step first.")
+    missing = [file.name for file in shard_files(path, 0, 1) if not is_traced(path / "time_traces", file, peaks)]
+    if missing:
+        raise RuntimeError(f"Time traces missing or out of date, run the tracing shards first: {', '.join(missing)}")
+    mark_stage(path, "trace", **stage_params("trace", csv))
+    clear_stages(path, ["matrix"])
+    with instrumentation.span("matrix", profile=True):
+        intensity_matrix(path, csv=csv)
+    mark_stage(path, "matrix", **stage_params("matrix", csv))
+
+def local(path: str, n_shards: int, options: list):
+    '''
+    Local stand-in for a cluster: runs the shards of every step as n_shards separate processes at the same time,
+    which only share the file system, followed by the reduce and matrix steps.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the mzML files.
+
+    n_shards: int
+        Number of shards, and of processes run at the same time.
+
+    options: list
+        Command line options passed on to every step, e.g. ["--config", "config.toml"].
+
+    Returns
+    -------
+    None
+    '''
+    command = [sys.executable, str(Path(__file__).resolve())]
+    for step in ("average", "reduce", "trace", "matrix"):
+        if step in ("average", "trace"):
+            processes = [subprocess.Popen(command + [step, str(path), "--shard", f"{i}/{n_shards}"] + options) for i in range(n_shards)]
+        else:
+            processes = [subprocess.Popen(command + [step, str(path)] + (["--shards", str(n_shards)] if step == "reduce" else []) + options)]
+        failed = [process.args for process in processes if process.wait() != 0]
+        if failed:
+            raise RuntimeError(f"The {step} step failed: {failed}")
+
+parser = argparse.ArgumentParser(description="Sharded execution of the preprocessing pipeline, coordinated through the shared file system.")
+subparsers = parser.add_subparsers(dest="command", required=True)
+for name, help_text in (("average", "average the mzML files of one shard"), ("reduce", "merge the averaging shards and pick the peaks"),
+                        ("trace", "trace the mzML files of one shard"), ("matrix", "write the intensity matrix"),
+                        ("local", "run all steps locally, one process per shard")):
+    subparser = subparsers.add_parser(name, help=help_text)
+    subparser.add_argument("path", type=Path, help="path to the directory containing the .mzml files to be processed")
+    if name in ("average", "trace"):
+        subparser.add_argument("--shard", type=parse_shard, required=True, metavar="i/n", help="index i of this shard out of n shards, 0 <= i < n")
+        subparser.add_argument("--workers", type=int, default=1, metavar="N", help="number of worker processes within this shard (default: 1)")
+    if name in ("reduce", "local"):
+        subparser.add_argument("--shards", type=int, required=True, metavar="n", help="number of shards")
+    subparser.add_argument("--csv", action="store_true", help="additionally export the results to .csv files")
+    subparser.add_argument("--config", type=Path, help="TOML file overriding the defaults in settings.py, identical for all jobs")
+
+if __name__ == "__main__":
+    ARGS = parser.parse_args()
+    if ARGS.config:
+        settings.configure(**settings.load_config(ARGS.config))
+
+    if ARGS.command == "average":
+        average_shard(ARGS.path, *ARGS.shard, csv=ARGS.csv, workers=ARGS.workers)
+    elif ARGS.command == "reduce":
+        reduce(ARGS.path, ARGS.shards, csv=ARGS.csv)
+    elif ARGS.command == "trace":
+        trace_shard(ARGS.path, *ARGS.shard, csv=ARGS.csv, workers=ARGS.workers)
+    elif ARGS.command == "matrix":
+        matrix(ARGS.path, csv=ARGS.csv)
+    else:
+        local(ARGS.path, ARGS.shards, (["--csv"] if ARGS.csv else []) + (["--config", str(ARGS.config)] if ARGS.config else []))
@@ -0,0 +1,116 @@
+import os, tempfile
+import numpy as np
+from pathlib import Path
+
+# Name of the file holding the shared m/z axis, written once per spectrum directory
+AXIS_FILE = "mz_axis.npy"
+
+def save_axis(path: str, mz_axis: np.ndarray) -> Path:
+    '''
+    Saves the resampled m/z axis once into the given directory, so that the intensity vectors
+    stored next to it do not need to carry their own copy of the axis. The axis is written into a uniquely named
+    temporary file first, which then replaces the axis file, so that processes writing the same axis at the same time,
+    e.g. the averaging shards (see shard.py), never leave a partially written file for a reader.
+
+    Parameters
+    ----------
+    path: str
+        Directory in which the spectra are stored.
+
+    mz_axis: np.ndarray
+        Numpy NDArray containing the resampled m/z axis.
+
+    Returns
+    -------
+    axis_path: Path
+        Path to the written .npy file.
+    '''
+    axis_path = Path(path) / AXIS_FILE
+    fd, tmp = tempfile.mkstemp(dir=axis_path.parent, prefix=AXIS_FILE + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            np.save(tmp_file, mz_axis)
+        os.replace(tmp, axis_path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return axis_path
+
+def load_axis(path: str) -> np.memmap:
+    '''
+    Opens the m/z axis stored in the given directory as a read-only memory map.
+
+    Parameters
+    ----------
+    path: str
+        Directory in which the spectra are stored.
+
+    Returns
+    -------
+    mz_axis: np.memmap
+        Read-only, memory-mapped m/z axis.
+    '''
+    return np.load(Path(path) / AXIS_FILE, mmap_mode='r')
+
+def save_spectrum(file: str, intensities: np.ndarray, dtype=np.float64) -> Path:
+    '''
+    Writes a single intensity vector, resampled over the shared m/z axis, into a binary .npy file.
+
+    Parameters
+    ----------
+    file: str
+        Path to the .npy file to be written.
+
+    intensities: np.ndarray
+        Intensity vector of the same length as the m/z axis.
+
+    dtype: np.dtype
+        Storage data type of the intensity vector, float64 by default.
+
+    Returns
+    -------
+    file: Path
+        Path to the written .npy file.
+    '''
+    file = Path(file)
+    np.save(file, np.asarray(intensities, dtype=dtype))
+    return file
+
+def load_spectrum(file: str) -> np.memmap:
+    '''
+    Opens an intensity vector written by save_spectrum() as a read-only memory map, without copying it into memory.
+
+    Parameters
+    ----------
+    file: str
+        Path to the .npy file.
+
+    Returns
+    -------
+    intensities: np.memmap
+        Read-only, memory-mapped intensity vector.
+    '''
+    return np.load(Path(file), mmap_mode='r')
+
+def export_csv(file: str, mz_axis: np.ndarray, intensities: np.ndarray):
+    '''
+    Optional export of a spectrum into the legacy two-column .csv format: m/z value, intensity.
+
+    Parameters
+    ----------
+    file: str
+        Path to the .csv file to be written.
+
+    mz_axis: np.ndarray
+        Numpy NDArray containing the resampled m/z axis.
+
+    intensities: np.ndarray
+        Intensity vector of the same length as the m/z axis.
+
+    Returns
+    -------
+    None
+    '''
+    data_matrix = np.transpose(np.array((mz_axis, intensities), dtype=np.float64))
+    with open(file, "w+") as spectrum_csv:
+        np.savetxt(spectrum_csv, data_matrix, delimiter=",", encoding='utf-8')
@@ -0,0 +1,162 @@
+'''
+Writes synthetic mzML files for testing and benchmarking the preprocessing pipeline without real measurements.
+Every file holds a fixed set of Gaussian peaks eluting as a Gaussian over the run (or, with an elution width,
+each around its own retention time), on top of exponentially distributed noise, with zlib-compressed 64-bit binary arrays as written by common converters (e.g. ProteoWizard msConvert).
+
+Usage:
+    $ python3 synthetic_mzml.py path/to/output --files 4 --scans 200 --points 5000 --peaks 50
+'''
+
+import argparse, base64, zlib
+import numpy as np
+from pathlib import Path
+import settings
+
+def _encode(array: np.ndarray) -> str:
+    return base64.b64encode(zlib.compress(np.asarray(array, dtype=np.float64).tobytes())).decode()
+
+def write_mzml(file: str, n_scans: int = 100, n_points: int = 2000, n_peaks: int = 30, polarity: str = "positive",
+               noise: float = 50.0, ms2_every: int = 0, seed: int = 0, mz_min: float = None, mz_max: float = None,
+               elution_width: float = None) -> Path:
+    '''
+    Writes a synthetic mzML file. The peak positions and heights are drawn once per file, the noise once per scan.
+
+    Parameters
+    ----------
+    file: str
+        Path to the mzML file to be written.
+
+    n_scans: int
+        Number of spectra, MS1 and MS2.
+
+    n_points: int
+        Number of noise data points per scan, in addition to one data point at the apex of every peak.
+
+    n_peaks: int
+        Number of peaks.
+
+    polarity: str
+        "positive", "negative", or "switching" for alternating positive and negative scans.
+
+    noise: float
+        Mean intensity of the exponentially distributed noise.
+
+    ms2_every: int
+        If non-zero, every ms2_every-th spectrum is an MS2 scan.
+
+    seed: int
+        Seed of the random number generator; equal seeds give identical files.
+
+    mz_min, mz_max: float
+        m/z range of the scans, by default the range of the m/z axis in settings.py.
+
+    elution_width: float
+        If given, every peak elutes as a Gaussian with this standard deviation (in spectra) around its own, random apex.
+        By default, all peaks elute together over the whole run.
+
+    Returns
+    -------
+    file: Path
+        Path to the written mzML file.
+    '''
+    if polarity not in ("positive", "negative", "switching"):
+        raise ValueError("polarity must be 'positive', 'negative' or 'switching', got {!r}".format(polarity))
+    mz_min = settings.MZ_MIN if mz_min is None else mz_min
+    mz_max = settings.MZ_MAX if mz_max is None else mz_max
+    rng = np.random.default_rng(seed)
+    margin = 0.02 * (mz_max - mz_min)
+    centers = np.sort(rng.uniform(mz_min + margin, mz_max - margin, n_peaks))
+    heights = rng.uniform(1e4, 1e6, n_peaks)
+    apexes = None if elution_width is None else rng.uniform(0, n_scans, n_peaks)
+
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with open(file, "w", encoding="utf-8") as out:
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+                  '<cvList count="1"><cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo" version="4.1.0"/></cvList>\n'
+                  '<run id="{}">\n<spectrumList count="{}">\n'.format(file.stem, n_scans))
+        for i in range(n_scans):
+            ms_level = 2 if ms2_every and i % ms2_every == ms2_every - 1 else 1
+            mz = rng.uniform(mz_min, mz_max, n_points)
+            intensity = rng.exponential(noise, n_points)
+            if apexes is None:
+                elution = np.full(n_peaks, np.exp(-0.5 * ((i - n_scans / 2) / (n_scans / 6)) ** 2))
+            else:
+                elution = np.exp(-0.5 * ((i - apexes) / elution_width) ** 2)
+            # Every peak contributes to the noise points around it, plus one data point at its apex
+            for center, height, peak_elution in zip(centers, heights, elution):
+                intensity += height * peak_elution * np.exp(-0.5 * ((mz - center) / 0.002) ** 2)
+            mz = np.concatenate([mz, centers])
+            intensity = np.concatenate([intensity, heights * elution])
+            order = np.argsort(mz)
+            mz, intensity = mz[order], intensity[order]
+            out.write('<spectrum index="{}" id="scan={}" defaultArrayLength="{}">\n'.format(i, i + 1, len(mz)))
+            out.write('<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{}"/>\n'.format(ms_level))
+            scan_polarity = ("positive" if i % 2 == 0 else "negative") if polarity == "switching" else polarity
+            accession = "MS:1000130" if scan_polarity == "positive" else "MS:1000129"
+            out.write('<cvParam cvRef="MS" accession="{}" name="{} scan" value=""/>\n'.format(accession, scan_polarity))
+            out.write('<cvParam cvRef="MS" accession="MS:1000285" name="total ion current" value="{}"/>\n'.format(intensity.sum()))
+            out.write('<scanList count="1"><scan><cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="{}" '
+                      'unitAccession="UO:0000031" unitName="minute"/></scan></scanList>\n'.format(i * 0.01))
+            out.write('<binaryDataArrayList count="2">\n')
+            for array, name, array_accession in ((mz, "m/z array", "MS:1000514"), (intensity, "intensity array", "MS:1000515")):
+                encoded = _encode(array)
+                out.write('<binaryDataArray encodedLength="{}">'
+                          '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>'
+                          '<cvParam cvRef="MS" accession="MS:1000574" name="zlib compression" value=""/>'
+                          '<cvParam cvRef="MS" accession="{}" name="{}" value=""/>'
+                          '<binary>{}</binary></binaryDataArray>\n'.format(len(encoded), array_accession, name, encoded))
+            out.write('</binaryDataArrayList>\n</spectrum>\n')
+        out.write('</spectrumList>\n</run>\n</mzML>\n')
+    return file
+
+def write_dataset(path: str, n_files: int = 2, switching: bool = False, **kwargs) -> list:
+    '''
+    Writes n_files samples in both polarities, sample<k>_pos.mzML and sample<k>_neg.mzML, into path.
+    With switching, every sample is written into a single file acquired with polarity switching, sample<k>.mzML.
+
+    Parameters
+    ----------
+    path: str
+        Directory into which the mzML files are written.
+
+    n_files: int
+        Number of samples; 2 x n_files files are written, or n_files with switching.
+
+    switching: bool
+        If True, writes one file per sample with alternating positive and negative scans.
+
+    **kwargs:
+        Further arguments of write_mzml().
+
+    Returns
+    -------
+    files: list
+        Paths to the written mzML files.
+    '''
+    files = []
+    for k in range(n_files):
+        if switching:
+            files.append(write_mzml(Path(path) / "sample{}.mzML".format(k), polarity="switching", seed=k, **kwargs))
+            continue
+        files.append(write_mzml(Path(path) / "sample{}_pos.mzML".format(k), polarity="positive", seed=k, **kwargs))
+        files.append(write_mzml(Path(path) / "sample{}_neg.mzML".format(k), polarity="negative", seed=n_files + k, **kwargs))
+    return files
+
+parser = argparse.ArgumentParser(description="Writes synthetic mzML files, sample<k>_pos.mzML and sample<k>_neg.mzML.")
+parser.add_argument("path", type=Path, help="directory into which the mzML files are written")
+parser.add_argument("--files", type=int, default=2, help="number of samples, each written in both polarities (default: 2)")
+parser.add_argument("--scans", type=int, default=100, help="number of spectra per file (default: 100)")
+parser.add_argument("--points", type=int, default=2000, help="number of data points per scan (default: 2000)")
+parser.add_argument("--peaks", type=int, default=30, help="number of peaks per file (default: 30)")
+parser.add_argument("--noise", type=float, default=50.0, help="mean intensity of the noise (default: 50)")
+parser.add_argument("--ms2-every", type=int, default=0, metavar="N", help="make every N-th spectrum an MS2 scan (default: 0, MS1 only)")
+parser.add_argument("--elution-width", type=float, metavar="SCANS", help="elute every peak around its own apex with this width (default: all peaks over the whole run)")
+parser.add_argument("--switching", action="store_true", help="write every sample into one file with alternating positive and negative scans, sample<k>.mzML")
+
+if __name__ == "__main__":
+    ARGS = parser.parse_args()
+    for file in write_dataset(ARGS.path, ARGS.files, switching=ARGS.switching, n_scans=ARGS.scans, n_points=ARGS.points, n_peaks=ARGS.peaks,
+                              noise=ARGS.noise, ms2_every=ARGS.ms2_every, elution_width=ARGS.elution_width):
+        print(f"Written {file}.")
@@ -0,0 +1,45 @@
+import numpy as np
+from scipy.integrate import trapezoid
+from interpolate import interp_accumulate, window_union, interp_windows, trapezoid_pairs, integrate_windows, scan_integrator
+
+def _windows(rng: np.random.Generator, n_axis: int, n_windows: int) -> np.ndarray:
+    # Sorted, partly overlapping windows [left, right), including empty and single-point ones
+    left = np.sort(rng.integers(0, n_axis - 60, n_windows))
+    return np.stack([left, left + rng.integers(0, 60, n_windows)], axis=1)
+
+def test_interp_accumulate_matches_np_interp():
+    rng = np.random.default_rng(0)
+    mz_axis = np.linspace(100, 200, 20000)
+    expected, intensities = np.zeros(len(mz_axis)), np.zeros(len(mz_axis))
+    for _ in range(5):
+        mz_array = np.sort(rng.uniform(120, 180, 500))
+        intensity_array = rng.exponential(1000, 500)
+        expected += np.interp(mz_axis, mz_array, intensity_array, left=0, right=0)
+        interp_accumulate(intensities, mz_axis, mz_array, intensity_array)
+    np.testing.assert_allclose(intensities, expected, rtol=1e-12)
+
+def test_integrate_windows_matches_trapezoid():
+    rng = np.random.default_rng(0)
+    mz_axis = np.linspace(100, 200, 20000)
+    windows = _windows(rng, len(mz_axis), 300)
+    union, starts = window_union(windows)
+    pairs = trapezoid_pairs(windows, starts)
+    for _ in range(10):
+        mz_array = np.sort(rng.uniform(100, 200, 2000))
+        intensity_array = rng.exponential(1000, 2000)
+        int_interp = np.interp(mz_axis, mz_array, intensity_array)
+        expected = np.array([trapezoid(int_interp[left:right]) for left, right in windows])
+
+        integrals = integrate_windows(interp_windows(mz_axis[union], mz_array, intensity_array), pairs)
+        np.testing.assert_allclose(integrals, expected, rtol=1e-12)
+
+        out = np.empty(len(windows))
+        scan_integrator(mz_axis[union], pairs)(mz_array, intensity_array, out)
+        np.testing.assert_array_equal(out, integrals)
+
+def test_integrate_windows_empty_scan():
+    mz_axis = np.linspace(100, 200, 1000)
+    windows = np.array([[10, 20], [15, 16], [30, 30]])
+    union, starts = window_union(windows)
+    integrals = integrate_windows(interp_windows(mz_axis[union], np.empty(0), np.empty(0)), trapezoid_pairs(windows, starts))
+    np.testing.assert_array_equal(integrals, np.zeros(3))
@@ -0,0 +1,8 @@
+import pytest
+from kernels import validate
+
+def test_numba_kernels_match_numpy():
+    pytest.importorskip("numba")
+    report = validate(n_scans=40, points=5000, n_features=100)
+    assert report["accumulate_max_diff"] == 0
+    assert report["integrate_max_diff"] == 0
@@ -0,0 +1,36 @@
+import numpy as np
+from scipy.signal import find_peaks, peak_prominences, peak_widths
+from peak_pick import peak_pick, _segments
+
+HEIGHT, DISTANCE, REL_HEIGHT = 1000, 50, 0.9
+
+def _spectrum(rng: np.random.Generator, n_points: int = 100000, n_peaks: int = 200) -> np.ndarray:
+    # Noise with zero gaps, as on a composite spectrum, and Gaussian peaks of random heights and widths
+    intensity = rng.exponential(100, n_points) * (rng.random(n_points) > 0.5)
+    x = np.arange(n_points)
+    for center, height, width in zip(rng.uniform(0, n_points, n_peaks), rng.uniform(500, 1e5, n_peaks), rng.uniform(2, 30, n_peaks)):
+        lo, hi = int(max(center - 6 * width, 0)), int(min(center + 6 * width, n_points))
+        intensity[lo:hi] += height * np.exp(-0.5 * ((x[lo:hi] - center) / width) ** 2)
+    return intensity
+
+def _reference(intensity: np.ndarray) -> tuple:
+    # Single pass of SciPy over the whole spectrum
+    apex, properties = find_peaks(intensity, height=HEIGHT, distance=DISTANCE)
+    prominence = peak_prominences(intensity, apex)
+    widths, width_heights, left, right = peak_widths(intensity, apex, rel_height=REL_HEIGHT, prominence_data=prominence)
+    return apex, np.floor(left).astype(np.int64), np.ceil(right).astype(np.int64), properties["peak_heights"], prominence[0]
+
+def test_segmented_peak_pick_matches_single_pass():
+    rng = np.random.default_rng(0)
+    mz_axis = np.linspace(50, 500, 100000)
+    for _ in range(30):
+        intensity = _spectrum(rng)
+        assert len(_segments(intensity, 16, HEIGHT, DISTANCE)) > 1
+        peaks = peak_pick(intensity, mz_axis, height=HEIGHT, distance=DISTANCE, rel_height=REL_HEIGHT, segments=16, threads=4)
+        apex, left, right, height, prominence = _reference(intensity)
+        np.testing.assert_array_equal(peaks.apex, apex)
+        np.testing.assert_array_equal(peaks.left, left)
+        np.testing.assert_array_equal(peaks.right, right)
+        np.testing.assert_array_equal(peaks.height, height)
+        np.testing.assert_array_equal(peaks.prominence, prominence)
+        np.testing.assert_array_equal(peaks.apex_mz, mz_axis[apex])
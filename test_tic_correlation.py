@@ -0,0 +1,27 @@
+import numpy as np
+from tic_correlation import pearson, pearson_windows, tic_correlate_batch
+
+def test_pearson_matches_corrcoef():
+    rng = np.random.default_rng(0)
+    tic = rng.exponential(1e6, 200)
+    xics = rng.exponential(1e4, (50, 200)) + np.outer(rng.uniform(-1, 1, 50), tic) / 100
+    expected = np.array([np.corrcoef(tic, xic)[0, 1] for xic in xics])
+    np.testing.assert_allclose(pearson(tic, xics), expected, rtol=1e-12)
+    np.testing.assert_array_equal(tic_correlate_batch(tic, xics, threshold=0.5), expected > 0.5)
+
+def test_pearson_constant_signal_is_nan():
+    tic = np.arange(10.0)
+    r = pearson(tic, np.stack([np.full(10, 3.0), tic]))
+    assert np.isnan(r[0])
+    assert np.isclose(r[1], 1.0)
+
+def test_pearson_windows_matches_corrcoef():
+    rng = np.random.default_rng(0)
+    n_scans, n_features = 200, 50
+    tic = rng.exponential(1e6, n_scans)
+    start = rng.integers(0, n_scans - 2, n_features)
+    counts = np.minimum(rng.integers(2, 80, n_features), n_scans - start)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    values = rng.exponential(1e4, offsets[-1])
+    expected = np.array([np.corrcoef(tic[s:s + n], values[o:o + n])[0, 1] for s, n, o in zip(start, counts, offsets)])
+    np.testing.assert_allclose(pearson_windows(tic, values, start, offsets), expected, rtol=1e-10)
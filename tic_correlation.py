@@ -1,5 +1,83 @@
 import numpy as np
-import matplotlib.pyplot as plt
+import settings
+
+def pearson(tic: np.ndarray, xics: np.ndarray) -> np.ndarray:
+    '''
+    Computes Pearson's correlation coefficient between the total ion current and every extracted ion current
+    in one vectorized pass, from the dot products of the mean-centered signals.
+    
+    Parameters
+    ----------
+    tic: np.ndarray
+        The total ion current for the given mzML file (m scans).
+    xics: np.ndarray
+        The extracted ion currents of all features (n features x m scans).
+        
+    Returns
+    -------
+    r: np.ndarray
+        Pearson's correlation coefficient of every feature, NaN for constant signals.
+    '''
+    tic = np.asarray(tic, dtype=np.float64)
+    xics = np.atleast_2d(np.asarray(xics, dtype=np.float64))
+    tic_centered = tic - tic.mean()
+    xics_centered = xics - xics.mean(axis=1, keepdims=True)
+    covariance = xics_centered @ tic_centered
+    norm = np.sqrt(np.einsum('ij,ij->i', xics_centered, xics_centered) * (tic_centered @ tic_centered))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance / norm
+
+def pearson_windows(tic: np.ndarray, values: np.ndarray, start: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    '''
+    Computes Pearson's correlation coefficient between the total ion current and every extracted ion current
+    of a sparse time trace (see trace_store.SPARSE_COLUMNS), only within the elution window of every feature.
+    
+    Parameters
+    ----------
+    tic: np.ndarray
+        The total ion current for the given mzML file (m scans).
+    values: np.ndarray
+        The extracted ion currents of all features within their elution windows, back to back.
+    start: np.ndarray
+        First scan of the elution window of every feature.
+    offsets: np.ndarray
+        Position of the first value of every feature in values, followed by the number of values.
+        
+    Returns
+    -------
+    r: np.ndarray
+        Pearson's correlation coefficient of every feature, NaN for constant signals and empty windows.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.diff(offsets)
+    n = len(counts)
+    rows = np.repeat(np.arange(n), counts)
+    tic = np.asarray(tic, dtype=np.float64)[np.repeat(np.asarray(start) - offsets[:-1], counts) + np.arange(len(values))]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values_centered = values - (np.bincount(rows, values, n) / counts)[rows]
+        tic_centered = tic - (np.bincount(rows, tic, n) / counts)[rows]
+        covariance = np.bincount(rows, values_centered * tic_centered, n)
+        return covariance / np.sqrt(np.bincount(rows, values_centered**2, n) * np.bincount(rows, tic_centered**2, n))
+
+def tic_correlate_batch(tic: np.ndarray, xics: np.ndarray, threshold: float = None) -> np.ndarray:
+    '''
+    Tests for Pearson's correlation between the total ion current and every extracted ion current at once.
+    
+    Parameters
+    ----------
+    tic: np.ndarray
+        The total ion current for the given mzML file (m scans).
+    xics: np.ndarray
+        The extracted ion currents of all features (n features x m scans).
+    threshold: float
+        Minimum correlation coefficient, settings.MIN_TIC_CORRELATION by default.
+        
+    Returns
+    -------
+    Boolean array, True for every feature whose Pearson's correlation coefficient is above the threshold.
+    '''
+    threshold = settings.MIN_TIC_CORRELATION if threshold is None else threshold
+    return pearson(tic, xics) > threshold
 
 def tic_correlate(tic: np.ndarray, xic: np.ndarray) -> bool:
     '''
@@ -14,13 +92,8 @@ def tic_correlate(tic: np.ndarray, xic: np.ndarray) -> bool:
         
     Returns
     -------
-    True if Pearson's correlation coefficient is above 0.5. Otherwise returns False. 
+    True if Pearson's correlation coefficient is above settings.MIN_TIC_CORRELATION (0.5 by default). Otherwise returns False. 
     '''
     
-    r = np.corrcoef(xic, tic)[1,0]
-    
-    if r > 0.5:
-        return True
-    else:
-        return False
+    return bool(tic_correlate_batch(tic, xic)[0])
    
@@ -1,101 +1,407 @@
-from pyteomics import mzml
-import os, csv, time
+import os, time, shutil
 import numpy as np
-from scipy.integrate import trapezoid
-from peak_pick import peak_pick
+from peak_pick import peak_pick, PeakTable
 from pathlib import Path
 import settings
 from tqdm import tqdm
+from spectrum_store import load_spectrum
+from scan_store import open_scans, store_path, select_polarity, scan_polarities
+from parallel import run_parallel, QueueProgress
+from interpolate import window_union, trapezoid_pairs
+from kernels import scan_integrator
+from manifest import is_current, mark_done, clear_done, load_record, peaks_hash, window_settings
+from polarity import POLARITIES
+from trace_store import (trace_path, save_trace, save_features, save_peaks, peaks_path, create_intensity, create_sparse,
+                         is_written, load_trace, export_csv)
+import instrumentation
 
-# Log script execution time
-st = time.time()
-
-def trace(path: str, features: list, MZ_AXIS: np.ndarray) -> np.ndarray:
-    tic = []                            # Placeholder data structures 
-    scans = mzml.MzML(path)
-    data = np.empty((len(features)+1, len(scans)))
-
-    j = 0
-    with tqdm(total=len(scans), desc="Processing scans...") as pbar:
-        for scan in scans:
-            tic.append(scan['total ion current'])
-            mz_array = np.ndarray.tolist(scan['m/z array'])
-            intensity_array = np.ndarray.tolist(scan['intensity array'])
-            int_interp = np.interp(MZ_AXIS, mz_array, intensity_array) # Interpolate intensity linearly for each scan from mz_array and intensity_array onto MZ_AXIS
-            data[0][j] = scan['index']
-            i = 1
-            for feature in features:
-                if i < len(features)+2:
-                    data[i][0] = round(np.median(feature.mz), 4)
-                feature_int = int_interp[feature.width[0]:feature.width[1]]
-                time_trace = trapezoid(feature_int)
-                data[i][j] = time_trace
-                i += 1
-            j += 1
-            pbar.update(1)
-    trc = np.ndarray.tolist(data)
-
-    trc.insert(1, tic)
-
-    return trc
-
-def time_trace(path: str, MZ_AXIS: np.ndarray) -> np.ndarray:
+def trace(path, features: PeakTable, MZ_AXIS: np.ndarray, progress=None, out: np.ndarray = None) -> dict:
     '''
-    Takes an mzML file, a feature list, and a predefined m/z axis as arguments, and returns a time trace of these features. 
-    The time trace is produced by linearly interpolating the intensity of every scan onto a new, uniformly-spaced m/z axis provided as an argument to the function,
-    and integrating this intensity within the boundaries of m/z values of every feature in the feature list.
+    Computes the time traces of all features for a single mzML file. The scans are processed in batches of
+    settings.SCAN_BATCH scans, and the integrated intensities of every batch are written into out at once, 
+    so that only one batch is held in memory if out is a memory map (see trace_store.create_intensity()).
     
     Parameters
     ----------
     path: str
+        Path to the source mzML file of a single polarity, or its MS1 scans, e.g. held in memory (see scan_store.MemoryScans)
+        or of one polarity of the file (see scan_store.select_polarity()).
+    
+    features: PeakTable
+        Peak table of the features to be traced.
+    
+    MZ_AXIS: np.ndarray
+        m/z axis predefined at the top of the preprocessing script (preprocess.py).
+    
+    progress: Queue
+        Queue for reporting progress to the parent process, if run in a worker process.
+    
+    out: np.ndarray
+        n features x m scans array into which the integrated intensities are written. If None, it is allocated in memory.
+    
+    Returns
+    -------
+    trace: dict
+        m/z value of every feature, spectrum index, total ion current and retention time of every scan, and the intensities (out).
+    '''
+    # Replay the MS1 scans decoded during averaging
+    scans = open_scans(path) if isinstance(path, (str, Path)) else path
+    intensity = np.empty((len(features), len(scans))) if out is None else out
+
+    # Only the m/z values inside the peak boundaries are needed, evaluate the interpolation on their union
+    windows = features.windows
+    union, starts = window_union(windows)
+    mz_window = MZ_AXIS[union]
+    # Precompute the integration index arrays and the m/z value of every feature once, not on every scan
+    pairs = trapezoid_pairs(windows, starts)
+    integrate = scan_integrator(mz_window, pairs)
+    mz = features.mz
+
+    batch = np.empty((len(features), min(settings.SCAN_BATCH, len(scans))))
+    pbar = tqdm(total=len(scans), desc="Processing scans...") if progress is None else QueueProgress(progress, total=len(scans))
+    with pbar:
+        for start in range(0, len(scans), settings.SCAN_BATCH):
+            stop = min(start + settings.SCAN_BATCH, len(scans))
+            for j in range(start, stop):
+                mz_array, intensity_array = scans[j]
+                # Interpolate intensity linearly for each scan from mz_array and intensity_array onto the feature windows of MZ_AXIS,
+                # and integrate all features at once
+                integrate(mz_array, intensity_array, batch[:, j - start])
+                pbar.update(1)
+            # Write the batch, and flush it to disk if the intensities are memory-mapped
+            intensity[:, start:stop] = batch[:, :stop - start]
+            if isinstance(intensity, np.memmap):
+                intensity.flush()
+
+    return {"mz": mz, "scan_index": np.asarray(scans.index), "tic": np.asarray(scans.tic), "rt": np.asarray(scans.rt), "intensity": intensity}
+
+def elution_windows(scans, features: PeakTable, MZ_AXIS: np.ndarray, stride: int = None, threshold: float = None, margin: float = None) -> tuple:
+    '''
+    Detects the elution window of every feature in one file from a first, coarse pass over every stride-th scan (and the last one).
+    The window is the run of coarse scans around the apex of the feature's time trace in which it exceeds its baseline
+    (the median over the coarse scans) by more than threshold times its height above the baseline. It extends up to
+    the first coarse scans below that on both sides, as the boundaries lie between them, and by margin minutes of retention time.
+    
+    Parameters
+    ----------
+    scans: ScanStore
+        MS1 scans of the file, see scan_store.py.
+    
+    features: PeakTable
+        Peak table of the features to be traced.
+    
+    MZ_AXIS: np.ndarray
+        m/z axis predefined at the top of the preprocessing script (preprocess.py).
+    
+    stride, threshold, margin: float
+        By default settings.RT_STRIDE, RT_THRESHOLD and RT_MARGIN.
+    
+    Returns
+    -------
+    start, stop: np.ndarray
+        First scan, and the scan after the last one, of the elution window of every feature.
+    '''
+    stride = settings.RT_STRIDE if stride is None else stride
+    threshold = settings.RT_THRESHOLD if threshold is None else threshold
+    margin = settings.RT_MARGIN if margin is None else margin
+    n_scans = len(scans)
+    if not n_scans or not len(features):
+        return np.zeros(len(features), dtype=np.int64), np.zeros(len(features), dtype=np.int64)
+    
+    positions = np.unique(np.append(np.arange(0, n_scans, stride), n_scans - 1))
+    windows = features.windows
+    union, starts = window_union(windows)
+    integrate = scan_integrator(MZ_AXIS[union], trapezoid_pairs(windows, starts))
+    coarse = np.empty((len(features), len(positions)))
+    for column, j in enumerate(positions):
+        mz_array, intensity_array = scans[j]
+        integrate(mz_array, intensity_array, coarse[:, column])
+    
+    # Nearest coarse scans at or below the threshold on both sides of the apex
+    apex = np.argmax(coarse, axis=1)
+    baseline = np.median(coarse, axis=1)
+    height = coarse[np.arange(len(features)), apex]
+    below = coarse <= (baseline + threshold * (height - baseline))[:, None]
+    column = np.arange(len(positions))
+    lo = np.where(below & (column < apex[:, None]), column, 0).max(axis=1)
+    hi = np.where(below & (column > apex[:, None]), column, len(positions) - 1).min(axis=1)
+    start, stop = positions[lo], positions[hi] + 1
+    
+    rt = np.asarray(scans.rt, dtype=np.float64)
+    if margin > 0 and np.all(np.isfinite(rt)):
+        start = np.searchsorted(rt, rt[start] - margin, side="left")
+        stop = np.searchsorted(rt, rt[stop - 1] + margin, side="right")
+    return start.astype(np.int64), stop.astype(np.int64)
+
+def trace_windowed(path, features: PeakTable, MZ_AXIS: np.ndarray, progress=None, trace_dir: str = None) -> dict:
+    '''
+    Computes the time traces of all features for a single mzML file only within their elution windows (see elution_windows()),
+    as a sparse feature-by-scan structure (see trace_store.SPARSE_COLUMNS). The scans are processed in batches of
+    settings.SCAN_BATCH scans, in which only the features eluting within the batch are interpolated and integrated.
+    
+    Parameters
+    ----------
+    path: str
+        Path to the source mzML file of a single polarity, or its MS1 scans, e.g. held in memory (see scan_store.MemoryScans)
+        or of one polarity of the file (see scan_store.select_polarity()).
+    
+    features: PeakTable
+        Peak table of the features to be traced.
+    
+    MZ_AXIS: np.ndarray
+        m/z axis predefined at the top of the preprocessing script (preprocess.py).
+    
+    progress: Queue
+        Queue for reporting progress to the parent process, if run in a worker process.
+    
+    trace_dir: str
+        Directory of the time traces, into which the values are written batch by batch (see trace_store.create_sparse()).
+        If None, they are held in memory.
+    
+    Returns
+    -------
+    trace: dict
+        m/z value of every feature, spectrum index, total ion current and retention time of every scan, and the first scan (start)
+        and the offsets of the values of every feature's elution window.
+    '''
+    scans = open_scans(path) if isinstance(path, (str, Path)) else path
+    start, stop = elution_windows(scans, features, MZ_AXIS)
+    offsets = np.concatenate(([0], np.cumsum(stop - start)))
+    values = np.empty(offsets[-1]) if trace_dir is None else create_sparse(trace_dir, start, offsets)
+    windows = features.windows
+    
+    pbar = tqdm(total=len(scans), desc="Processing scans...") if progress is None else QueueProgress(progress, total=len(scans))
+    with pbar:
+        for batch_start in range(0, len(scans), settings.SCAN_BATCH):
+            batch_stop = min(batch_start + settings.SCAN_BATCH, len(scans))
+            active = np.flatnonzero((start < batch_stop) & (stop > batch_start))
+            if len(active):
+                # Interpolate only on the union of the windows of the features eluting within the batch
+                union, starts = window_union(windows[active])
+                integrate = scan_integrator(MZ_AXIS[union], trapezoid_pairs(windows[active], starts))
+                batch = np.empty((len(active), batch_stop - batch_start))
+                for j in range(batch_start, batch_stop):
+                    mz_array, intensity_array = scans[j]
+                    integrate(mz_array, intensity_array, batch[:, j - batch_start])
+                # Keep the scans of the batch within every feature's elution window
+                lo, hi = np.maximum(start[active], batch_start), np.minimum(stop[active], batch_stop)
+                counts = hi - lo
+                rows = np.repeat(np.arange(len(active)), counts)
+                scan = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+                values[np.repeat(offsets[active] - start[active], counts) + scan] = batch[rows, scan - batch_start]
+                if isinstance(values, np.memmap):
+                    values.flush()
+            pbar.update(batch_stop - batch_start)
+    
+    return {"mz": features.mz, "scan_index": np.asarray(scans.index), "tic": np.asarray(scans.tic), "rt": np.asarray(scans.rt),
+            "start": start, "offsets": offsets, "values": values}
+
+def trace_file(file: str, path: str, peaks: dict, MZ_AXIS: np.ndarray, csv: bool = False, progress=None) -> list:
+    '''
+    Computes the time traces of all features for a single mzML file, separately for the MS1 scans of every polarity
+    (see scan_store.select_polarity()) with the peak table of that polarity, and writes them, batch by batch, into the columnar
+    containers <sample>_<polarity>_trace on path (see trace_store.py), then records the completion and the peak lists used in the file's
+    manifest record. With settings.TRACE_MODE "windowed", only the elution windows are traced (see trace_windowed()).
+    Runs either in the main process or in a worker process of time_trace().
+    
+    Parameters
+    ----------
+    file: str
         Path to the source mzML file.
     
-    features: list
-        List of floats to be used for feature tracing.
-        
+    path: str
+        Directory in which the time traces are saved.
+    
+    peaks: dict
+        PeakTable of the features to be traced, keyed by polarity.
+    
     MZ_AXIS: np.ndarray
         m/z axis predefined at the top of the preprocessing script (preprocess.py).
     
+    csv: bool
+        If True, additionally exports the time traces to <sample>_<polarity>_trace.csv.
+    
+    progress: Queue
+        Queue for reporting progress to the parent process, if run in a worker process.
+    
+    Returns
+    -------
+    trace_dirs: list
+        Paths to the written time traces.
+    '''
+    file = Path(file)
+    with instrumentation.span("trace_file", profile=True, file=file.name) as measured:
+        clear_done(file.parent, file, "trace")
+        store = open_scans(file)
+        polarities = [polarity for polarity in scan_polarities(store) if polarity in peaks]
+        trace_dirs = []
+        for polarity in polarities:
+            # The intensities are written straight into the container, batch by batch, replacing a previous container of either mode
+            scans, features = select_polarity(store, polarity), peaks[polarity]
+            trace_dir = trace_path(path, file, polarity)
+            shutil.rmtree(trace_dir, ignore_errors=True)
+            if settings.TRACE_MODE == "windowed":
+                data = trace_windowed(scans, features, MZ_AXIS, progress, trace_dir=trace_dir)
+            else:
+                data = trace(scans, features, MZ_AXIS, progress, out=create_intensity(trace_dir, len(features), len(scans)))
+            save_trace(trace_dir, data["mz"], data["scan_index"], data["tic"], rt=data["rt"])
+            del data
+            if csv:
+                export_csv(trace_dir.with_suffix(".csv"), load_trace(trace_dir))
+            trace_dirs.append(trace_dir)
+        mark_done(file.parent, file, "trace", peaks={polarity: peaks_hash(peaks[polarity]) for polarity in polarities}, windows=window_settings())
+        measured.add(scans=len(store), bytes_read=instrumentation.size(store_path(file)),
+                     bytes_written=sum(instrumentation.size(trace_dir) for trace_dir in trace_dirs))
+    return trace_dirs
+
+def is_traced(path: str, file: str, peaks: dict) -> bool:
+    '''
+    Checks whether the time traces of every polarity of the given mzML file are written, and current with the file's content,
+    the peak tables and the trace mode (see manifest.window_settings()), according to its manifest record.
+
+    Parameters
+    ----------
+    path: str
+        Directory in which the time traces are saved.
+
+    file: str
+        Path to the source mzML file.
+
+    peaks: dict
+        PeakTable of every polarity.
+
     Returns
     -------
-    trc: np.ndarray
-        Numpy ndarray containing all the m/z values from features and their respective time traces.
-        First row is scan numbers, second row is the total ion current at each scan.
-        All subsequent rows are integrated feature intensities at each scan.
+    True if the time traces of the file do not need to be recomputed. Otherwise returns False.
+    '''
+    file = Path(file)
+    traced = load_record(file.parent, file).get("stages", {}).get("trace", {}).get("peaks")
+    if not isinstance(traced, dict) or not set(traced) <= set(peaks):
+        return False
+    return (all(is_written(trace_path(path, file, polarity)) for polarity in traced)
+            and is_current(file.parent, file, "trace", peaks={polarity: peaks_hash(peaks[polarity]) for polarity in traced}, windows=window_settings()))
+
+def pick_peaks(path: str, MZ_AXIS: np.ndarray) -> dict:
+    '''
+    Picks the peaks on the composite spectra of both polarities (an empty peak table for a polarity without composite spectrum),
+    and saves the peak tables (peaks_<polarity>.npz)
+    and the feature lists (features_<polarity>.npy, see trace_store.py) on path, which are shared by the time traces of all files.
+    
+    Parameters
+    ----------
+    path: str
+        Directory in which the time traces are saved, next to the composite spectra.
+    
+    MZ_AXIS: np.ndarray
+        m/z axis predefined at the top of the preprocessing script (preprocess.py).
+    
+    Returns
+    -------
+    peaks: dict
+        PeakTable of every polarity, keyed by "pos" and "neg".
     '''
     path = Path(path)
-    # Pick peaks on the composite spectra
     print("Performing peak picking...")
+    peaks = {}
+    for polarity in POLARITIES:
+        composite_path = path.parent.absolute() / "composite_spectrum_{}.npy".format(polarity)
+        if composite_path.exists():
+            peaks[polarity] = peak_pick(load_spectrum(composite_path), MZ_AXIS)
+            instrumentation.add(bytes_read=instrumentation.size(composite_path))
+        else:
+            # Without averaged spectra of a polarity, there is no composite spectrum and no peak to pick
+            peaks[polarity] = PeakTable(*(np.empty(0) for column in PeakTable.COLUMNS))
+        save_peaks(path, polarity, peaks[polarity])
+        # The feature lists define the feature IDs shared by all time traces of a polarity (see intensity_matrix.py)
+        save_features(path, polarity, peaks[polarity].mz)
+    return peaks
+
+def load_peaks(path: str) -> dict:
+    '''Loads the peak tables saved by pick_peaks() on path, keyed by polarity. Returns None if they are missing.'''
+    if not all(peaks_path(path, polarity).exists() for polarity in POLARITIES):
+        return None
+    return {polarity: PeakTable.load(peaks_path(path, polarity)) for polarity in POLARITIES}
+
+def time_trace(path: str, MZ_AXIS: np.ndarray, csv: bool = False, workers: int = 1, peaks: dict = None, files: list = None,
+               force: bool = False) -> list:
+    '''
+    Computes the time traces of all mzML files next to path with the peak tables of both polarities, and saves them on path.
+    The time trace of a file is produced by linearly interpolating the intensity of every scan onto the resampled (linear or ppm) m/z axis,
+    and integrating this intensity within the boundaries [left, right) of every peak in the peak table of the polarity of the scan.
+    With settings.TRACE_MODE "windowed", every feature is only integrated within its elution window (see trace_windowed()).
+    The MS1 scans are replayed from the scan store written during averaging; the mzML file is only parsed again if the store is missing or out of date.
+    Every file is traced separately for the MS1 scans of each polarity, so that a file acquired with polarity switching yields the time traces of both.
+    Files whose content and peak list have not changed since their time traces were written, according to the manifest (see manifest.py), are skipped.
+    
+    Parameters
+    ----------
+    path: str
+        Directory in which the time traces are saved (time_traces), next to the mzML files and the composite spectra.
+        
+    MZ_AXIS: np.ndarray
+        m/z axis predefined at the top of the preprocessing script (preprocess.py).
+    
+    csv: bool
+        If True, additionally exports the time traces to <sample>_<polarity>_trace.csv files.
     
-    composite_pos = np.genfromtxt(path.parent.absolute() / "composite_spectrum_pos.csv", delimiter=',')
-    composite_neg = np.genfromtxt(path.parent.absolute() / "composite_spectrum_neg.csv", delimiter=',')
+    workers: int
+        Number of worker processes across which the files are distributed. 1 (default) processes them serially.
+    
+    peaks: dict
+        PeakTable of every polarity, as returned by pick_peaks(). If None, the peaks are picked first.
+    
+    files: list
+        Names of the mzML files to be traced, e.g. one shard of them (see shard.py). If None, all mzML files next to path are traced.
+    
+    force: bool
+        If True, all files are traced again, even if their time traces are current according to the manifest.
+    
+    Returns
+    -------
+    traced: list
+        Paths to the mzML files whose time traces were (re)computed. For every polarity of the scans of every mzML file,
+        the columnar container <sample>_<polarity>_trace (see trace_store.py) is written on path, holding the m/z values of all features, the scan indices,
+        the total ion current at each scan and the n features x m scans matrix of integrated feature intensities.
+    '''
+    path = Path(path)
+    
+    # Log script execution time
+    st = time.time()
+    
+    # Pick peaks on the composite spectra
+    if peaks is None:
+        peaks = pick_peaks(path, MZ_AXIS)
+
+    # Find and list all the mzML files found on path
+    filelist = sorted(file for file in os.listdir(path.parent.absolute()) if file.lower().endswith(".mzml"))
+    if files is not None:
+        filelist = [file for file in filelist if file in {Path(name).name for name in files}]
 
-    peaklist_pos = peak_pick(composite_pos, MZ_AXIS)
-    peaklist_neg = peak_pick(composite_neg, MZ_AXIS)
+    # Every file is traced with the peak list of the polarity of each of its scans, see trace_file()
+    jobs = [(path.parent.absolute() / file, path, peaks, MZ_AXIS, csv) for file in filelist]
 
-    filelist = [file for file in os.listdir(path.parent.absolute()) if file.lower().endswith(".mzml")]
+    # Only recompute the time traces of new or changed files, or of files traced with a different peak list or trace mode
+    uptodate = [not force and is_traced(path, job[0], peaks) for job in jobs]
+    if any(uptodate):
+        print(f"Skipping {sum(uptodate)} unchanged files...")
+    jobs = [job for job, skip in zip(jobs, uptodate) if not skip]
 
     # Process the time traces for every peak found
-    counter = 0
-    for file in filelist:
-        counter += 1
-        print(f"Finding time traces for: {file}, {counter} out of {len(filelist)}...")
-        if "pos" in str(file):
-            data = trace(str(path.parent.absolute() / file), peaklist_pos, MZ_AXIS)
-            with open(path / "{}.csv".format(file.lower()).replace('.mzml', "_trace"), "w+", newline='') as trace_csv:
-                writer = csv.writer(trace_csv)
-                for item in data:
-                    writer.writerow(item)
-        elif "neg" in str(file):
-            data = trace(str(path.parent.absolute() / file), peaklist_neg, MZ_AXIS)
-            with open(path / "{}.csv".format(file.lower()).replace('.mzml', "_trace"), "w+", newline='') as trace_csv:
-                writer = csv.writer(trace_csv)
-                for item in data:
-                    writer.writerow(item)
+    if workers > 1:
+        print(f"Finding time traces for {len(jobs)} files on {workers} workers...")
+        run_parallel(trace_file, jobs, workers, desc="Processing scans...")
+    else:
+        counter = 0
+        for job in jobs:
+            counter += 1
+            print(f"Finding time traces for: {job[0].name}, {counter} out of {len(jobs)}...")
+            trace_file(*job)
 
     print("Done.")
 
-# Print execution time 
-et = time.time()
-elapsed_time = et - st
-print("Time traces written in: ", round(elapsed_time, 2), " seconds.")
+    # Print execution time 
+    et = time.time()
+    elapsed_time = et - st
+    print("Time traces written in: ", round(elapsed_time, 2), " seconds.")
+
+    return [job[0] for job in jobs]
@@ -0,0 +1,260 @@
+import os
+import numpy as np
+import csv
+from pathlib import Path
+from polarity import output_name
+
+# Arrays stored for every time trace, one .npy file each
+COLUMNS = ("mz", "scan_index", "tic", "rt", "intensity")
+# Arrays replacing the intensity of sparse time traces, which only hold every feature's elution window:
+# the intensities of feature k at scans start[k] to start[k] + offsets[k+1] - offsets[k] - 1 are values[offsets[k]:offsets[k+1]]
+SPARSE_COLUMNS = ("start", "offsets", "values")
+
+def trace_name(file: str, polarity: str) -> str:
+    '''Returns the name of the time traces of one polarity of the given mzML file, <sample>_<polarity>_trace in lower case (see polarity.py).'''
+    return "{}_trace".format(output_name(file, polarity).lower())
+
+def trace_path(path: str, file: str, polarity: str) -> Path:
+    '''
+    Returns the directory of the time traces of one polarity of the given mzML file, e.g. time_traces/sample_pos_trace.
+
+    Parameters
+    ----------
+    path: str
+        Directory in which the time traces are saved.
+
+    file: str
+        Path to the source mzML file.
+
+    polarity: str
+        Polarity of the time traces, "pos" or "neg".
+
+    Returns
+    -------
+    trace_path: Path
+        Directory of the time traces.
+    '''
+    return Path(path) / trace_name(file, polarity)
+
+def save_trace(trace_dir: str, mz: np.ndarray, scan_index: np.ndarray, tic: np.ndarray, intensity: np.ndarray = None, **arrays) -> Path:
+    '''
+    Saves the time traces of one mzML file into a columnar container: a directory with one binary .npy file per array,
+    so that readers can memory-map only the arrays they need. The intensities are stored feature by feature
+    (n features x m scans), so that every feature's time trace is contiguous.
+
+    Parameters
+    ----------
+    trace_dir: str
+        Directory of the time traces, see trace_path().
+
+    mz: np.ndarray
+        m/z value of every feature.
+
+    scan_index: np.ndarray
+        Spectrum index of every scan.
+
+    tic: np.ndarray
+        Total ion current of every scan.
+
+    intensity: np.ndarray
+        n x m matrix of integrated feature intensities at every scan. None if it was already written into
+        the array returned by create_intensity(), or for sparse time traces.
+
+    **arrays:
+        Further arrays, e.g. the retention time rt of every scan, or the start, offsets and values of a sparse time trace
+        (see SPARSE_COLUMNS) if they were not written by create_sparse().
+
+    Returns
+    -------
+    trace_dir: Path
+        Directory of the time traces.
+    '''
+    trace_dir = Path(trace_dir)
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    for column, array in {"mz": mz, "scan_index": scan_index, "tic": tic, "intensity": intensity, **arrays}.items():
+        if array is not None:
+            np.save(trace_dir / "{}.npy".format(column), array)
+    return trace_dir
+
+def create_intensity(trace_dir: str, n_features: int, n_scans: int) -> np.memmap:
+    '''
+    Creates the intensity array of a time trace container as a writable memory map of intensity.npy,
+    so that the time traces can be written into it batch by batch instead of being held in memory.
+
+    Parameters
+    ----------
+    trace_dir: str
+        Directory of the time traces, see trace_path().
+
+    n_features: int
+        Number of features.
+
+    n_scans: int
+        Number of scans.
+
+    Returns
+    -------
+    intensity: np.memmap
+        n_features x n_scans float64 array backed by intensity.npy.
+    '''
+    trace_dir = Path(trace_dir)
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    return np.lib.format.open_memmap(trace_dir / "intensity.npy", mode="w+", dtype=np.float64, shape=(n_features, n_scans))
+
+def create_sparse(trace_dir: str, start: np.ndarray, offsets: np.ndarray) -> np.memmap:
+    '''
+    Saves the layout of a sparse time trace (see SPARSE_COLUMNS), and creates its values as a writable memory map of values.npy,
+    so that the time traces can be written into it batch by batch.
+
+    Parameters
+    ----------
+    trace_dir: str
+        Directory of the time traces, see trace_path().
+
+    start: np.ndarray
+        First scan of the elution window of every feature.
+
+    offsets: np.ndarray
+        Position of the first value of every feature in values, followed by the number of values.
+
+    Returns
+    -------
+    values: np.memmap
+        float64 array of offsets[-1] values backed by values.npy.
+    '''
+    trace_dir = Path(trace_dir)
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    np.save(trace_dir / "start.npy", np.asarray(start, dtype=np.int64))
+    np.save(trace_dir / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    return np.lib.format.open_memmap(trace_dir / "values.npy", mode="w+", dtype=np.float64, shape=(int(offsets[-1]),))
+
+def is_sparse(trace_dir: str) -> bool:
+    '''Checks whether the time traces in trace_dir are stored sparsely, within the elution windows of the features.'''
+    return (Path(trace_dir) / "values.npy").exists()
+
+def is_written(trace_dir: str) -> bool:
+    '''Checks whether the intensities of the time traces in trace_dir were written, dense or sparse.'''
+    return (Path(trace_dir) / "intensity.npy").exists() or is_sparse(trace_dir)
+
+def dense_intensity(trace: dict) -> np.ndarray:
+    '''
+    Returns the n features x m scans intensities of a time trace; for a sparse time trace, the scans outside
+    the elution window of a feature are filled with zeros.
+    '''
+    if "values" not in trace:
+        return trace["intensity"]
+    counts = np.diff(trace["offsets"])
+    intensity = np.zeros((len(counts), len(trace["scan_index"])))
+    rows = np.repeat(np.arange(len(counts)), counts)
+    intensity[rows, np.repeat(trace["start"] - trace["offsets"][:-1], counts) + np.arange(len(rows))] = trace["values"]
+    return intensity
+
+def load_trace(trace_dir: str, columns: tuple = None) -> dict:
+    '''
+    Opens the requested arrays of a time trace container as read-only memory maps.
+
+    Parameters
+    ----------
+    trace_dir: str
+        Directory of the time traces, see trace_path().
+
+    columns: tuple
+        Names of the arrays to open, out of COLUMNS and SPARSE_COLUMNS. If None, all arrays stored in the container are opened.
+
+    Returns
+    -------
+    trace: dict
+        Memory-mapped arrays, keyed by their names.
+    '''
+    trace_dir = Path(trace_dir)
+    if columns is None:
+        columns = [column for column in COLUMNS + SPARSE_COLUMNS if (trace_dir / "{}.npy".format(column)).exists()]
+    return {column: np.load(trace_dir / "{}.npy".format(column), mmap_mode='r') for column in columns}
+
+def export_csv(file: str, trace: dict):
+    '''
+    Optional export of a time trace container into the legacy .csv format: the first row holds the scan indices,
+    the second row the total ion current, and every following row the m/z value of a feature followed by
+    its integrated intensity from the second scan onwards. Sparse time traces are exported with zeros outside the elution windows.
+
+    Parameters
+    ----------
+    file: str
+        Path to the .csv file to be written.
+
+    trace: dict
+        Arrays of the time trace, as returned by load_trace().
+
+    Returns
+    -------
+    None
+    '''
+    with open(file, "w+", newline='') as trace_csv:
+        writer = csv.writer(trace_csv)
+        writer.writerow(np.ndarray.tolist(np.asarray(trace["scan_index"], dtype=np.float64)))
+        writer.writerow(np.ndarray.tolist(np.asarray(trace["tic"])))
+        for mz, intensity in zip(trace["mz"], dense_intensity(trace)):
+            writer.writerow([float(mz)] + np.ndarray.tolist(np.asarray(intensity[1:])))
+
+def features_path(path: str, polarity: str) -> Path:
+    '''Returns the path to the feature list of the given polarity ("pos" or "neg"), shared by all time traces on path.'''
+    return Path(path) / "features_{}.npy".format(polarity)
+
+def save_features(path: str, polarity: str, mz: np.ndarray) -> Path:
+    '''
+    Saves the m/z values of the features picked on the composite spectrum of one polarity. The position of a feature
+    in this list is its feature ID, shared by the time traces of all files of that polarity.
+
+    Parameters
+    ----------
+    path: str
+        Directory in which the time traces are saved.
+
+    polarity: str
+        "pos" or "neg".
+
+    mz: np.ndarray
+        m/z value of every feature, in the order of the rows of the time traces.
+
+    Returns
+    -------
+    file: Path
+        Path to the written feature list.
+    '''
+    file = features_path(path, polarity)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    np.save(file, np.asarray(mz, dtype=np.float64))
+    return file
+
+def peaks_path(path: str, polarity: str) -> Path:
+    '''Returns the path to the peak table of the given polarity ("pos" or "neg"), shared by all time traces on path.'''
+    return Path(path) / "peaks_{}.npz".format(polarity)
+
+def save_peaks(path: str, polarity: str, peaks) -> Path:
+    '''
+    Saves the peak table picked on the composite spectrum of one polarity (see peak_pick.PeakTable). The table is written
+    into a temporary file first, which then replaces the previous one, so that an interrupted run never leaves behind
+    a partially written peak table.
+
+    Parameters
+    ----------
+    path: str
+        Directory in which the time traces are saved.
+
+    polarity: str
+        "pos" or "neg".
+
+    peaks: PeakTable
+        Peak table to be saved.
+
+    Returns
+    -------
+    file: Path
+        Path to the written peak table.
+    '''
+    file = peaks_path(path, polarity)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = file.with_name(file.name + ".tmp.npz")
+    peaks.save(tmp)
+    os.replace(tmp, file)
+    return file